@@ -1,16 +1,10 @@
+import os
+import time
 from flask import Flask
 from config import Config  # 数据库的配置信息
-from flask_sqlalchemy import SQLAlchemy  # ORM的工作就是将高级操作转换成数据库命令。
-from flask_migrate import Migrate
-# 第一次创建数据库时使用   数据库迁移增加了启动数据库时候的一些工作，
-# 这是一项困难的工作，因为关系数据库是以结构化数据为中心的，
-# 所以当结构发生变化时，数据库中的已有数据需要被迁移到修改后的结构中
+from app.db_tuning import TunedSQLAlchemy  # ORM的工作就是将高级操作转换成数据库命令。 在 Flask-SQLAlchemy 上加了连接调优
 from flask_login import LoginManager  # 用户登陆的  它处理在长时间内登录，注销和记住用户会话的常见任务。
-from flask_mail import Mail
-import logging
-from logging.handlers import SMTPHandler
-import os
-from logging.handlers import RotatingFileHandler
+from app.log_pipeline import setup_logging
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 
@@ -35,16 +29,94 @@ get_id()
         注意着 必须 是一个 unicode ——如果 ID 原本是 一个 int 或其它类型，你需要把它转换为 unicode 。
 '''
 
-app = Flask(__name__)  # 一个flask实例
-app.config.from_object(Config)
+"""
+应用工厂
+
+以前 import app 就建好全局的 app, 所有扩展、蓝图、迁移和邮件都在导入时初始化, 每个 worker、每条 flask 命令、
+每个测试都要付一遍, 测试也只能改同一个 app 的配置。现在扩展在模块里先建好但不绑定应用,
+create_app(config_class) 里再逐个 init_app、注册蓝图:
+    Flask-Migrate (连带 alembic) 只在 flask 命令里初始化, 网页进程用不到
+    Flask-Mail 等第一封邮件真正发出去时才导入 (mail_queue.mail_state()), jwt 等找回密码时才导入
+每一步花的时间记在 app.extensions['startup'] 里, flask startup-profile 会连同各个模块的导入时间一起打出来。
+"""
+
+db = TunedSQLAlchemy()  # 连接池、SQLite PRAGMA、只读副本 见 app/db_tuning.py
+login = LoginManager()
+login.login_view = 'auth.login'  # 如果未设定登入视图，会以 401 错误退 出。@login_require 判断未登录 跳到 auth.login
+bootstrap = Bootstrap()
+moment = Moment()
+
+from app.timeline import TimelineStore  # 要在 db 创建之后导入
+timeline = TimelineStore()  # 首页时间线 fan-out-on-write
+from app.last_seen import LastSeenTracker
+last_seen = LastSeenTracker()  # 缓冲 last_seen, 批量写回
+from app.user_cache import UserCache
+user_cache = UserCache()  # load_user 的缓存
+from app.avatars import Avatars
+avatars = Avatars()  # 头像 URL 缓存和本地 identicon
+from app.fragment_cache import FragmentCache
+fragment_cache = FragmentCache()  # 渲染好的动态 HTML 缓存
+from app.mail_queue import MailQueue
+mail_queue = MailQueue()  # 发件箱和发信线程池
+from app.metrics import Metrics
+metrics = Metrics()  # 每个请求的耗时、SQL、模板统计和慢查询日志
+from app.search import SearchIndex
+search_index = SearchIndex()  # 动态的全文索引
+from app.name_registry import NameRegistry
+name_registry = NameRegistry()  # 用户名/邮箱占用检查的布隆过滤器
+from app.passwords import PasswordHasher
+passwords = PasswordHasher()  # 密码哈希的算法、参数和线程池
+from app.rate_limit import RateLimiter
+rate_limiter = RateLimiter()  # 登录、找回密码按 IP 和用户名限流
+from app.stream import Broker
+broker = Broker()  # /stream/feed 的发布订阅
+from app.recommend import Recommender
+recommender = Recommender()  # "可能想关注的人"
+from app.trending import Trending
+trending = Trending()  # /explore?sort=trending 的活跃度和排行
+
+EXTENSIONS = (('db', db), ('login', login), ('bootstrap', bootstrap), ('moment', moment), ('timeline', timeline),
+              ('last_seen', last_seen), ('user_cache', user_cache), ('avatars', avatars),
+              ('fragment_cache', fragment_cache), ('mail_queue', mail_queue), ('metrics', metrics),
+              ('search_index', search_index), ('name_registry', name_registry), ('passwords', passwords),
+              ('rate_limiter', rate_limiter), ('broker', broker), ('recommender', recommender),
+              ('trending', trending))
+
+
+def create_app(config_class=Config):
+    app = Flask(__name__)  # 一个flask实例
+    app.config.from_object(config_class)
+    startup = app.extensions['startup'] = {}  # 名字 -> 秒
+
+    for name, extension in EXTENSIONS:
+        start = time.perf_counter()
+        extension.init_app(app)
+        startup[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from app.errors import bp as errors_bp
+    app.register_blueprint(errors_bp)
+    from app.routes import bp as main_bp
+    app.register_blueprint(main_bp)
+    from app.auth import bp as auth_bp  # 登录、注册、找回密码 见 app/auth.py
+    app.register_blueprint(auth_bp)
+    from app.api import bp as api_bp  # JSON API 见 app/api.py
+    app.register_blueprint(api_bp, url_prefix='/api/v1')
+    startup['blueprints'] = time.perf_counter() - start
+
+    if os.environ.get('FLASK_RUN_FROM_CLI'):  # flask db upgrade 之类的命令才需要迁移引擎
+        start = time.perf_counter()
+        from flask_migrate import Migrate
+        Migrate(app, db)  # 数据库迁移引擎migrate
+        startup['migrate'] = time.perf_counter() - start
+
+    if not app.debug and not app.testing:
+        setup_logging(app)  # 文件和错误邮件都在后台线程里写 见 app/log_pipeline.py
+        app.logger.info('Microblog startup')
+
+    return app
+
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)  # 数据库迁移引擎migrate
-login = LoginManager(app)
-login.login_view = 'login'  # 如果未设定登入视图，会以 401 错误退 出。@login_require 判断未登录 跳到 login 函数
-mail = Mail(app)
-bootstrap = Bootstrap(app)
-moment = Moment(app)
 """ 
 >>> from datetime import datetime
 >>> str(datetime.now())           时间模块
@@ -55,32 +127,4 @@ datetime.now()调用返回我所处位置的本地时间，而datetime.utcnow()
 但是无论位置如何，datetime.utcnow()总是会返回同一时间
 """
 
-if not app.debug:
-    if app.config['MAIL_SERVER']:
-        auth = None
-        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-        secure = None
-        if app.config['MAIL_USE_TLS']:
-            secure = ()
-        mail_handler = SMTPHandler(
-            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-            credentials=auth, secure=secure)
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
-
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240,
-                                       backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
-
-    app.logger.setLevel(logging.INFO)
-    app.logger.info('Microblog startup')
-
-from app import routes, models, errors
+from app import models  # noqa: E402,F401  模型要在 create_app() 之前注册到 db.metadata 上
@@ -0,0 +1,150 @@
+import hashlib
+from functools import wraps
+from flask import Blueprint, jsonify, request, url_for, current_app
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from app import db, timeline, last_seen, user_cache, broker
+from app.db_tuning import read_replica
+from app.models import User, Post
+from app.pagination import encode_cursor, decode_cursor, older_than, load_posts
+
+"""
+JSON API (/api/v1)
+
+以前别的客户端只能抓 HTML 页面, 每次轮询都要查询、渲染模板、传整页。现在:
+    GET    /api/v1/users/<username>          用户资料
+    GET    /api/v1/feed                      首页时间线 (当前用户)
+    GET    /api/v1/explore                   所有人的动态
+    PUT    /api/v1/users/<username>/follow   关注
+    DELETE /api/v1/users/<username>/follow   取关
+用网页登录后的 session cookie 认证, 没登录返回 401。关注用 PUT/DELETE 而不是 POST,
+跨站的表单发不出这两种请求, 所以不需要 CSRF token。
+
+动态列表用游标分页: ?before=<游标>&limit=N, 返回 {"items": [...], "next": 下一页的 URL 或 null}。
+GET 都带强 ETag, 客户端带上 If-None-Match 轮询时:
+    动态列表    先只查这一页的 (timestamp, id) (时间线或者 post 表上的覆盖索引), 由它们算出 ETag,
+                对得上直接返回 304, 不加载 Post 和作者, 也不序列化
+    用户资料    由资料和计数的列算出 ETag
+作者改名或者换头像不会让已有动态列表的 ETag 失效, 直到这一页有新的动态。
+"""
+
+bp = Blueprint('api', __name__)
+
+
+def api_login_required(f):  # 和 login_required 一样, 但是返回 401 而不是跳到登录页
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return error_response(401, 'Login required')
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def error_response(status, message):
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+@bp.errorhandler(404)  # app 上按状态码注册的处理函数优先, 404 要单独注册
+@bp.errorhandler(HTTPException)
+def http_error(error):  # 蓝图里的 abort() / first_or_404() 也返回 JSON
+    return error_response(error.code, error.description)
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(('v1',) + parts).encode('utf-8')).hexdigest()
+
+
+def conditional(etag, build):
+    """If-None-Match 对得上就返回 304, build() 只在对不上时调用"""
+    if request.if_none_match.contains_weak(etag):  # If-None-Match 按规范用弱比较
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # 每次都要带 If-None-Match 回来验证
+    return response
+
+
+def timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def post_to_dict(post):
+    return {'id': post.id, 'body': post.body, 'timestamp': timestamp(post.timestamp),
+            'author': post.author.username}
+
+
+def user_to_dict(user):
+    return {'username': user.username, 'about_me': user.about_me, 'last_seen': timestamp(user.last_seen),
+            'avatar': user.avatar(128), 'followers': user.follower_count, 'following': user.followed_count,
+            'posts': user.post_count}
+
+
+def page_args():
+    limit = request.args.get('limit', current_app.config['POSTS_PER_PAGE'], type=int)
+    return decode_cursor(request.args.get('before')), max(1, min(limit, current_app.config['API_MAX_PER_PAGE']))
+
+
+def post_keys(query, limit, before):
+    """query 只选 (timestamp, id), 返回这一页的键和后面还有没有"""
+    if before is not None:
+        query = query.filter(older_than(Post.timestamp, Post.id, before))
+    rows = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit + 1).all()
+    return [(row.timestamp, row.id) for row in rows[:limit]], len(rows) > limit
+
+
+def post_page(endpoint, keys, has_more, limit):
+    def build():
+        next_url = None
+        if has_more:
+            next_url = url_for(endpoint, before=encode_cursor(*keys[-1]), limit=limit)
+        return {'items': [post_to_dict(post) for post in load_posts([id for _, id in keys])], 'next': next_url}
+    return conditional(make_etag(endpoint, limit, keys, has_more), build)
+
+
+@bp.route('/feed')
+@api_login_required
+def feed():
+    before, limit = page_args()
+    keys, has_more = timeline.keys(current_user, limit, before=before)
+    return post_page('api.feed', keys, has_more, limit)
+
+
+@bp.route('/explore')
+@api_login_required
+@read_replica
+def explore():
+    before, limit = page_args()
+    keys, has_more = post_keys(db.session.query(Post.timestamp, Post.id), limit, before)
+    return post_page('api.explore', keys, has_more, limit)
+
+
+@bp.route('/users/<username>')
+@api_login_required
+@read_replica
+def get_user(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    last_seen.refresh(user)
+    etag = make_etag('user', user.id, user.username, user.about_me, user.avatar_hash, timestamp(user.last_seen),
+                     user.follower_count, user.followed_count, user.post_count)
+    return conditional(etag, lambda: user_to_dict(user))
+
+
+@bp.route('/users/<username>/follow', methods=['PUT', 'DELETE'])
+@api_login_required
+def follow(username):
+    user = User.query.filter_by(username=username).first_or_404()
+    if user == current_user:
+        return error_response(400, 'You cannot follow yourself')
+    if request.method == 'PUT':
+        current_user.follow(user)
+    else:
+        current_user.unfollow(user)
+    db.session.commit()
+    user_cache.invalidate(current_user)
+    user_cache.invalidate(user)
+    broker.follow(current_user, user, following=request.method == 'PUT')
+    return jsonify({'username': user.username, 'following': request.method == 'PUT',
+                    'followers': user.follower_count})
@@ -0,0 +1,122 @@
+from flask import Blueprint, render_template, flash, redirect, url_for, request, jsonify
+from sqlalchemy.exc import IntegrityError
+from flask_login import login_user, logout_user, current_user
+from werkzeug.urls import url_parse
+from app import db, user_cache, name_registry, passwords, rate_limiter
+from app.forms import LoginForm, RegistrationForm, ResetPasswordRequestForm, ResetPasswordForm
+from app.models import User
+from app.email import send_password_reset_email
+from app.rate_limit import by_ip, by_form
+
+bp = Blueprint('auth', __name__)  # 登录、注销、注册、找回密码
+
+
+@bp.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit('login-ip', '30/minute', key=by_ip)
+@rate_limiter.limit('login-username', '10/minute', key=by_form('username'))  # 换着 IP 撞同一个账号
+def login():  # 回调函数 生成了current_user 并提取cook
+    if current_user.is_authenticated:  # 一个用来表示用户是否通过登录认证的属性，用True和False表示。
+        return redirect(url_for('main.index'))  # 如果用户登陆回调到index
+    form = LoginForm()  # 一个表单
+    if form.validate_on_submit():  # 如果表单提交
+        user = User.query.filter_by(username=form.username.data).first()  # 返回一个User实例
+        if user is None or not user.check_password(form.password.data):  # 检验user 将user的密码摘要与数据库中的对比
+            flash('Invalid username or password')
+            return redirect(url_for('auth.login'))  # 回调
+        if passwords.needs_rehash(user.password_hash):  # 配置换了算法或参数, 趁有明文密码重新算
+            user.set_password(form.password.data)
+            db.session.commit()
+            passwords.note_rehash()
+        login_user(user, remember=form.remember_me.data)  # 登陆 设置cook
+        """“记住我”功能的实现很棘手。尽管如此，Flask-Login 几乎透明地实现了这
+        ——只需要向 login_user 调用传递 remember=True 。
+        一个 cookie 就会存储在用户的电脑上， 
+        且之后如果会话中没有用户 ID，Flask-Login 会自动从那个 cookie 上恢复用户 ID。
+         这个 cookie 是防篡改的，所以如果用户篡改了它（插入其它用户的 ID 来替代自己 的），
+         这个 cookie 只不过会被拒绝，就如同没有一样。"""
+        # Flask提供一个request变量，其中包含客户端随请求发送的所有信息。 特别是request.args属性
+        next_page = request.args.get('next')  # 如果用户是从其他界面重定向来login的 它会有一个next 参数 这可以取出原界面的url
+        if not next_page or url_parse(next_page).netloc != '':
+            next_page = url_for('main.index')  # 如果不是去index
+        return redirect(next_page)  # 回调 此时已有cook可直接登陆
+    return render_template('login.html', title='Sign In', form=form)
+
+
+"""
+如果登录URL中不含next参数，那么将会重定向到本应用的主页。
+如果登录URL中包含next参数，其值是一个相对路径（换句话说，该URL不含域名信息），那么将会重定向到本应用的这个相对路径。
+如果登录URL中包含next参数，其值是一个包含域名的完整URL，那么重定向到本应用的主页
+"""
+
+
+@bp.route('/logout')  # 登出 清空cook
+def logout():
+    logout_user()  # 好像是把服务器上对应的用户的cook删除
+    return redirect(url_for('main.index'))  # 重定向到index
+
+
+@bp.route('/register', methods=['GET', 'POST'])  # 注册用户
+def register():
+    if current_user.is_authenticated:  # current_user是User的一个实例 看用户是否登陆
+        return redirect(url_for('main.index'))  # 回调
+    form = RegistrationForm()  # 接收注册表单
+    if form.validate_on_submit():
+        user = User(username=form.username.data, email=form.email.data)  # 接收username and email
+        user.set_password(form.password.data)  # 生成摘要 摘要算法不可逆
+        db.session.add(user)  # 提交到数据库
+        """
+        session(会话)可以看成一个管理数据库持久连接的对象
+        session.add函数会把Model加入持久空间
+        """
+        try:
+            db.session.commit()  # 提交完毕
+        except IntegrityError:  # 表单检查之后被别人抢先注册了, 以唯一约束为准
+            db.session.rollback()
+            form.username.errors.append('Please use a different username or email address.')
+            return render_template('register.html', title='Register', form=form)
+        flash('Congratulations, you are now a registered user!')
+        return redirect(url_for('auth.login'))
+    return render_template('register.html', title='Register', form=form)
+
+
+@bp.route('/api/check_username')
+@rate_limiter.limit('check-username-ip', '60/minute', key=by_ip, methods=('GET',))  # 别让人拿来枚举用户名
+def check_username():  # 注册页面边输入边检查用户名能不能用, 大部分请求由布隆过滤器直接回答
+    username = request.args.get('username', '').strip()
+    if not username or len(username) > 64:
+        return jsonify(username=username, available=False, error='Usernames must be 1 to 64 characters.'), 400
+    return jsonify(username=username, available=not name_registry.exists('username', username))
+
+
+@bp.route('/reset_password_request', methods=['GET', 'POST'])
+@rate_limiter.limit('reset-ip', '10/hour', key=by_ip)
+@rate_limiter.limit('reset-email', '3/hour', key=by_form('email'))  # 别让人拿来给别人的邮箱刷信
+def reset_password_request():
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    form = ResetPasswordRequestForm()
+    if form.validate_on_submit():
+        user = User.query.filter_by(email=form.email.data).first()
+        if user:
+            send_password_reset_email(user)
+        flash('Check your email for the instructions to reset your password')
+        return redirect(url_for('auth.login'))
+    return render_template('reset_password_request.html',
+                           title='Reset Password', form=form)
+
+
+@bp.route('/reset_password/<token>', methods=['GET', 'POST'])
+def reset_password(token):
+    if current_user.is_authenticated:
+        return redirect(url_for('main.index'))
+    user = User.verify_reset_password_token(token)
+    if not user:
+        return redirect(url_for('main.index'))
+    form = ResetPasswordForm()
+    if form.validate_on_submit():
+        user.set_password(form.password.data)
+        db.session.commit()
+        user_cache.invalidate(user)
+        flash('Your password has been reset.')
+        return redirect(url_for('auth.login'))
+    return render_template('reset_password.html', form=form)
@@ -0,0 +1,73 @@
+import os
+import re
+from functools import lru_cache
+from hashlib import md5
+
+"""
+头像
+
+以前 User.avatar() 每次渲染都要对 email 算一次 md5, 一页 25 条动态就算 25 次。
+现在 md5 存在 user.avatar_hash 列里 (改 email 时自动更新), 头像 URL 按 (digest, size) 缓存。
+
+AVATAR_LOCAL = True 时头像不再指向 gravatar.com, 而是本站的 /avatar/<digest>/<size>,
+由 render_identicon() 生成 SVG 格子头像并缓存在 AVATAR_CACHE_DIR 里, 响应带很长的缓存时间,
+页面加载不用依赖 gravatar.com 的速度。
+"""
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+MAX_SIZE = 512
+
+
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+class Avatars(object):
+    def __init__(self, app=None):
+        self.local = False
+        self.cache_dir = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.local = app.config.get('AVATAR_LOCAL', False)
+        self.cache_dir = app.config.get('AVATAR_CACHE_DIR') or os.path.join(app.instance_path, 'avatars')
+        app.extensions['avatars'] = self
+
+    def url(self, digest, size):
+        return _avatar_url(digest, size, self.local)
+
+    def path(self, digest, size):
+        """返回缓存在磁盘上的头像文件名, 没有就先生成"""
+        name = '{}-{}.svg'.format(digest, size)
+        filename = os.path.join(self.cache_dir, name)
+        if not os.path.exists(filename):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = '{}.{}.tmp'.format(filename, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(render_identicon(digest, size))
+            os.replace(tmp, filename)  # 多个进程同时生成也不会读到半个文件
+        return name
+
+
+@lru_cache(maxsize=8192)
+def _avatar_url(digest, size, local):
+    if local:
+        return '/avatar/{}/{}'.format(digest, size)
+    return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
+
+
+def render_identicon(digest, size):
+    """和 gravatar 的 identicon 类似: 5x5 左右对称的格子, 颜色和格子都由 digest 决定"""
+    color = '#' + digest[-6:]
+    cell = size / 5.0
+    rects = []
+    for row in range(5):
+        for col in range(3):  # 只算左边三列, 右边两列镜像
+            if int(digest[row * 3 + col], 16) % 2 == 0:
+                for x in {col, 4 - col}:
+                    rects.append('<rect x="{:.2f}" y="{:.2f}" width="{:.2f}" height="{:.2f}"/>'.format(
+                        x * cell, row * cell, cell, cell))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{0}" viewBox="0 0 {0} {0}">'
+            '<rect width="{0}" height="{0}" fill="#f0f0f0"/><g fill="{1}">{2}</g></svg>').format(
+        size, color, ''.join(rects))
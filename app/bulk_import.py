@@ -0,0 +1,334 @@
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from app import db, passwords
+from app.avatars import email_digest
+from app.passwords import PasswordHasher
+
+"""
+批量导入用户、动态和关注关系
+
+以前造数据或者从别的系统搬数据只能一个一个 User(...)、set_password、db.session.add, 每步提交一次,
+几百万行要跑上几天。现在 flask import users|posts|follows 文件 (JSONL 或 CSV, - 表示标准输入):
+    读取    生成器一行一行读, 不把整个文件装进内存
+    校验    每 --batch-size 行一批, 缺字段、太长、重复 (和文件里前面的行或者数据库里已有的) 的行跳过并记下行号,
+            数据库里的重复一批只查一次 (IN); 动态按 (作者, timestamp, body) 判重, 没写 timestamp 的动态
+            每次导入时间都不一样, 重跑会再导入一遍
+    哈希    密码放进 --workers 个进程的进程池里算 (pbkdf2/scrypt 在一个进程里受 GIL 限制),
+            第 N 批在算哈希的时候第 N-1 批在写数据库; 已经是哈希的 (password_hash 列) 原样写入
+    写入    每批一条 executemany 的 INSERT, 一批一个事务, 中途失败的话前面的批已经提交, 修好文件重跑会跳过已导入的行
+    id      动态和关注用用户名指定, 用户名 -> id 的字典第一次用到时从 user 表读一遍, 之后不再查
+字段:
+    users    username, email, password 或 password_hash, about_me (可选)
+    posts    username, body, timestamp (可选, ISO 8601, 带时区的换算成 UTC, 不带的当作 UTC, 默认现在)
+    follows  follower, followed (都是用户名)
+直接写表不经过 ORM, 所以导入完再补上 ORM 事件做的事: 重新统计计数, 导入动态后重建全文索引,
+导入动态和关注后重建时间线 (--skip-timelines 跳过, 之后再跑 flask timeline rebuild)。
+别的进程里的用户名布隆过滤器要等下次重建 (NAME_BLOOM_REBUILD_INTERVAL) 才有新名字, 这期间注册撞名由唯一约束兜底。
+"""
+
+
+def read_records(stream, fmt):
+    """逐行读, 生成 (行号, dict); CSV 第一行是表头"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None  # 解析不了的行交给校验去跳过
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def text_field(record, name):
+    value = record.get(name)
+    return value.strip() if isinstance(value, str) else None
+
+
+def parse_timestamp(value):
+    if not value:
+        return datetime.utcnow()
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:  # 换算成 UTC 再去掉时区, 数据库里存的都是 UTC
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def hash_chunk(settings, plain):
+    """在进程池里算一组密码的哈希; settings 是 PasswordHasher 的算法和参数"""
+    hasher = PasswordHasher()
+    hasher.method, hasher.pbkdf2_iterations, hasher.scrypt_params, hasher.argon2_params = settings
+    return [hasher._hash(password) for password in plain]
+
+
+class ImportStats(object):
+    MAX_ERRORS = 20  # 只记前面几条, 别的只计数
+
+    def __init__(self):
+        self.read = 0
+        self.written = 0
+        self.skipped = 0
+        self.errors = []  # (行号, 原因)
+        self.started = time.perf_counter()
+
+    def skip(self, line, reason):
+        self.skipped += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rate(self):
+        return self.read / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class Importer(object):
+    """子类实现 validate(batch) -> 要写的行 和 table; prepare(rows) 可以把耗时的准备放到后台"""
+    table = None
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self.stats = ImportStats()
+        self._user_ids = None
+
+    def user_ids(self):
+        """用户名 -> id, 第一次用时分批读完整张 user 表"""
+        from app.models import User
+        if self._user_ids is None:
+            self._user_ids = dict(db.session.query(User.username, User.id).yield_per(10000))
+        return self._user_ids
+
+    def run(self, records, progress=None):
+        pending = None  # 上一批: 准备好之后返回要写的行
+        for batch in batches(records, self.batch_size):
+            self.stats.read += len(batch)
+            job = self.prepare(self.validate(batch))
+            if pending is not None:
+                self.write(pending())
+            pending = job
+            if progress is not None:
+                progress(self.stats)
+        if pending is not None:
+            self.write(pending())
+        self.close()
+        return self.stats
+
+    def prepare(self, rows):
+        return lambda: rows
+
+    def write(self, rows):
+        if rows:
+            db.session.execute(self.table.insert(), rows)
+            db.session.commit()
+            self.stats.written += len(rows)
+
+    def close(self):
+        pass
+
+
+class UserImporter(Importer):
+    def __init__(self, batch_size=5000, workers=None):
+        from app.models import User
+        Importer.__init__(self, batch_size)
+        self.table = User.__table__
+        self.settings = (passwords.method, passwords.pbkdf2_iterations, passwords.scrypt_params,
+                         passwords.argon2_params)
+        workers = os.cpu_count() if workers is None else workers
+        self.workers = workers
+        self._pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None  # 0: 在当前进程里算
+        self._usernames = set()
+        self._emails = set()
+
+    def validate(self, batch):
+        from app.models import User
+        rows = []
+        for line, record in batch:
+            if record is None:
+                self.stats.skip(line, 'not a JSON object')
+                continue
+            username, email = text_field(record, 'username'), text_field(record, 'email')
+            password, password_hash = record.get('password'), text_field(record, 'password_hash')
+            password = password if isinstance(password, str) else None
+            about_me = text_field(record, 'about_me') or None
+            if not username or len(username) > 64:
+                self.stats.skip(line, 'bad username')
+            elif not email or '@' not in email or len(email) > 120:
+                self.stats.skip(line, 'bad email')
+            elif not password and not password_hash:
+                self.stats.skip(line, 'no password')
+            elif about_me and len(about_me) > 140:
+                self.stats.skip(line, 'about_me too long')
+            elif username in self._usernames or email in self._emails:
+                self.stats.skip(line, 'duplicate username or email')
+            else:
+                self._usernames.add(username)
+                self._emails.add(email)
+                rows.append((line, {'username': username, 'email': email, 'avatar_hash': email_digest(email),
+                                    'password_hash': password_hash or None, 'about_me': about_me}, password))
+        if rows:  # 数据库里已经有的 (比如重跑) 一批查一次
+            names, emails = set(), set()
+            for username, email in db.session.query(User.username, User.email).filter(db.or_(
+                    User.username.in_([row['username'] for _, row, _ in rows]),
+                    User.email.in_([row['email'] for _, row, _ in rows]))):
+                names.add(username)
+                emails.add(email)
+            fresh = []
+            for line, row, password in rows:
+                if row['username'] in names or row['email'] in emails:
+                    self.stats.skip(line, 'username or email already exists')
+                else:
+                    fresh.append((line, row, password))
+            rows = fresh
+        return [(row, password) for _, row, password in rows]
+
+    def prepare(self, rows):
+        plain = [(row, password) for row, password in rows if not row['password_hash']]
+        if not plain:
+            return lambda: [row for row, _ in rows]
+        if self._pool is None:
+            for row, hashed in zip([row for row, _ in plain],
+                                   hash_chunk(self.settings, [password for _, password in plain])):
+                row['password_hash'] = hashed
+            return lambda: [row for row, _ in rows]
+        size = -(-len(plain) // self.workers)  # 每个进程一份
+        futures = [self._pool.submit(hash_chunk, self.settings, [password for _, password in plain[i:i + size]])
+                   for i in range(0, len(plain), size)]
+
+        def finish():
+            hashes = [hashed for future in futures for hashed in future.result()]
+            for (row, _), hashed in zip(plain, hashes):
+                row['password_hash'] = hashed
+            return [row for row, _ in rows]
+        return finish
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+class PostImporter(Importer):
+    def __init__(self, batch_size=5000):
+        from app.models import Post
+        Importer.__init__(self, batch_size)
+        self.table = Post.__table__
+        self._posts = set()  # 文件里已经见过的 (user_id, timestamp, body)
+
+    def validate(self, batch):
+        from app.models import Post
+        ids = self.user_ids()
+        rows = []
+        for line, record in batch:
+            if record is None:
+                self.stats.skip(line, 'not a JSON object')
+                continue
+            body = text_field(record, 'body')
+            author_id = ids.get(text_field(record, 'username'))
+            if author_id is None:
+                self.stats.skip(line, 'unknown username')
+            elif not body or len(body) > 140:
+                self.stats.skip(line, 'bad body')
+            else:
+                try:
+                    timestamp = parse_timestamp(record.get('timestamp'))
+                except (TypeError, ValueError):
+                    self.stats.skip(line, 'bad timestamp')
+                    continue
+                if (author_id, timestamp, body) in self._posts:
+                    self.stats.skip(line, 'duplicate post')
+                    continue
+                self._posts.add((author_id, timestamp, body))
+                rows.append((line, {'body': body, 'timestamp': timestamp, 'user_id': author_id}))
+        existing = set()
+        if rows:  # 数据库里已经有的 (比如重跑) 一批查一次, 走 (user_id, timestamp) 索引
+            existing = {tuple(row) for row in db.session.execute(
+                db.select([Post.user_id, Post.timestamp, Post.body])
+                .where(Post.user_id.in_({row['user_id'] for _, row in rows}))
+                .where(Post.timestamp.in_({row['timestamp'] for _, row in rows})))}
+        fresh = []
+        for line, row in rows:
+            if (row['user_id'], row['timestamp'], row['body']) in existing:
+                self.stats.skip(line, 'post already exists')
+            else:
+                fresh.append(row)
+        return fresh
+
+
+class FollowImporter(Importer):
+    def __init__(self, batch_size=5000):
+        from app.models import followers
+        Importer.__init__(self, batch_size)
+        self.table = followers
+        self._edges = set()
+
+    def validate(self, batch):
+        from app.models import followers
+        ids = self.user_ids()
+        edges = []
+        for line, record in batch:
+            if record is None:
+                self.stats.skip(line, 'not a JSON object')
+                continue
+            follower_id = ids.get(text_field(record, 'follower'))
+            followed_id = ids.get(text_field(record, 'followed'))
+            if follower_id is None or followed_id is None:
+                self.stats.skip(line, 'unknown username')
+            elif follower_id == followed_id:
+                self.stats.skip(line, 'cannot follow yourself')
+            elif (follower_id, followed_id) in self._edges:
+                self.stats.skip(line, 'duplicate follow')
+            else:
+                self._edges.add((follower_id, followed_id))
+                edges.append((line, (follower_id, followed_id)))
+        existing = set()
+        if edges:
+            # 只按主键的前缀 follower_id 查, 再加上 followed_id IN 的话 SQLite 会选错索引
+            existing = {tuple(row) for row in db.session.execute(
+                db.select([followers.c.follower_id, followers.c.followed_id])
+                .where(followers.c.follower_id.in_({edge[0] for _, edge in edges})))}
+        rows = []
+        for line, edge in edges:
+            if edge in existing:
+                self.stats.skip(line, 'already following')
+            else:
+                rows.append({'follower_id': edge[0], 'followed_id': edge[1]})
+        return rows
+
+
+IMPORTERS = {'users': UserImporter, 'posts': PostImporter, 'follows': FollowImporter}
+
+
+def open_input(path, fmt=None):
+    """返回 (文本流, 格式); 格式没给就看扩展名, 标准输入默认 JSONL"""
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline=''), fmt
+    return open(path, encoding='utf-8', newline=''), fmt
@@ -0,0 +1,242 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import click
+from sqlalchemy.engine.url import make_url
+from app import db, timeline, mail_queue, search_index, name_registry, recommender, trending
+from app.bulk_import import IMPORTERS, UserImporter, open_input, read_records
+from app.db_tuning import copy_sqlite_database
+from app.passwords import calibrate
+from app.models import User
+
+"""
+自定义的 flask 命令, 在 microblog.py 里注册:
+    flask timeline rebuild            重建所有用户的首页时间线
+    flask timeline rebuild -u susan   只重建一个用户
+    flask counters repair             重新统计粉丝数、关注数、动态数
+    flask replica sync                把 SQLite 主库复制到本地的副本文件
+    flask mail send                   不等后台线程, 直接把发件箱里到期的邮件发完
+    flask mail status                 发件箱里每种状态的邮件数
+    flask search reindex              重建动态的全文索引
+    flask passwords calibrate         找出验证一次密码大约花 --target 秒的哈希参数
+    flask recommend build             重算所有用户的 "可能想关注的人"
+    flask trending compact            删掉衰减完的活跃度, 重排 /explore?sort=trending 的排行 (放进 cron)
+    flask import users users.csv      批量导入用户 (还有 posts / follows), JSONL 或 CSV, 见 app/bulk_import.py
+    flask startup-profile             在新进程里冷启动一次 create_app(), 打出最慢的导入和每个扩展的初始化时间
+"""
+
+# 在子进程里跑, 这样导入都是冷的; 打出 create_app() 的总时间和每一步的时间
+STARTUP_SCRIPT = ('import json, time; start = time.perf_counter(); from app import create_app; app = create_app(); '
+                  'print(json.dumps({"total": time.perf_counter() - start, "steps": app.extensions["startup"]}))')
+
+
+def import_times(report):
+    """解析 python -X importtime 的输出, 按顶层包汇总各模块自身的导入时间 (微秒), 从慢到快排"""
+    totals = {}
+    for line in report.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3:
+            continue
+        try:
+            microseconds = int(parts[0].split(':')[1])  # 只算自身的, 累计时间会把子模块重复算进去
+        except ValueError:  # 表头
+            continue
+        package = parts[2].strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + microseconds
+    return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def register(app):
+    @app.cli.group('timeline')
+    def timeline_commands():
+        """Home timeline commands."""
+        pass
+
+    @timeline_commands.command()
+    @click.option('--username', '-u', default=None, help='Only rebuild this user.')
+    def rebuild(username):
+        """Rebuild home timelines from the followers and post tables."""
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.UsageError('User {} not found.'.format(username))
+            timeline.rebuild(user)
+            count = 1
+        else:
+            count = timeline.rebuild_all()
+        db.session.commit()
+        click.echo('Rebuilt {} timeline(s).'.format(count))
+
+    @app.cli.group('counters')
+    def counters_commands():
+        """Denormalized counter commands."""
+        pass
+
+    @counters_commands.command()
+    def repair():
+        """Recompute follower, followed and post counts for every user."""
+        User.repair_counters()
+        db.session.commit()
+        click.echo('Counters repaired.')
+
+    @app.cli.group('replica')
+    def replica_commands():
+        """Read replica commands."""
+        pass
+
+    @replica_commands.command()
+    def sync():
+        """Copy the SQLite primary database into the local replica file."""
+        primary = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        replica = make_url((app.config.get('SQLALCHEMY_BINDS') or {}).get('replica') or '')
+        if primary.drivername != 'sqlite' or replica.drivername != 'sqlite':
+            raise click.UsageError('Both DATABASE_URL and DATABASE_REPLICA_URL must be SQLite files.')
+        copy_sqlite_database(primary.database, replica.database)
+        click.echo('Copied {} to {}.'.format(primary.database, replica.database))
+
+    @app.cli.group('mail')
+    def mail_commands():
+        """Outgoing mail commands."""
+        pass
+
+    @mail_commands.command()
+    def send():
+        """Send every due message in the outbox now."""
+        click.echo('Sent {} message(s).'.format(mail_queue.drain()))
+
+    @mail_commands.command()
+    def status():
+        """Show how many outbox messages are in each state."""
+        counts = mail_queue.stats()
+        for state in ('pending', 'sending', 'sent', 'failed'):
+            click.echo('{:8} {}'.format(state, counts.get(state, 0)))
+
+    @app.cli.group('search')
+    def search_commands():
+        """Full-text search commands."""
+        pass
+
+    @search_commands.command()
+    def reindex():
+        """Rebuild the full-text index of all posts."""
+        count = search_index.reindex()
+        db.session.commit()
+        click.echo('Indexed {} post(s).'.format(count))
+
+    @app.cli.group('passwords')
+    def passwords_commands():
+        """Password hashing commands."""
+        pass
+
+    @passwords_commands.command('calibrate')
+    @click.option('--method', type=click.Choice(['pbkdf2', 'scrypt', 'argon2']),
+                  default=lambda: app.config['PASSWORD_HASH_METHOD'])
+    @click.option('--target', type=float, default=0.1, help='Seconds one verification should take.')
+    def calibrate_command(method, target):
+        """Find hashing parameters that take about --target seconds here."""
+        try:
+            params, elapsed = calibrate(method, target)
+        except RuntimeError as e:
+            raise click.UsageError(str(e))
+        click.echo('# {} takes about {:.3f}s per verification on this host'.format(method, elapsed))
+        click.echo("PASSWORD_HASH_METHOD = '{}'".format(method))
+        for key, value in params.items():
+            click.echo('{} = {}'.format(key, value))
+
+    @app.cli.group('recommend')
+    def recommend_commands():
+        """Follow suggestion commands."""
+        pass
+
+    @recommend_commands.command('build')
+    @click.option('--workers', type=int, default=None,
+                  help='Processes scoring shards in parallel (default: RECOMMEND_WORKERS).')
+    @click.option('--python', 'pure_python', is_flag=True, help='Do not use NumPy/SciPy even if installed.')
+    def recommend_build(workers, pure_python):
+        """Recompute "who to follow" suggestions for every user."""
+        try:
+            users, suggestions, elapsed = recommender.build(workers, vectorized=False if pure_python else None)
+        except RuntimeError as e:
+            raise click.UsageError(str(e))
+        click.echo('Stored {} suggestion(s) for {} user(s) in {:.1f}s.'.format(suggestions, users, elapsed))
+
+    @app.cli.group('trending')
+    def trending_commands():
+        """Trending ranking commands."""
+        pass
+
+    @trending_commands.command('compact')
+    def compact():
+        """Drop decayed author scores and rebuild the trending ranking."""
+        pruned, ranked = trending.compact()
+        click.echo('Pruned {} author score(s), ranked {} post(s).'.format(pruned, ranked))
+
+    @app.cli.command('startup-profile')
+    @click.option('--top', default=15, help='How many packages to show.')
+    def startup_profile(top):
+        """Time a cold create_app(): imports by package and each init step."""
+        env = dict(os.environ)
+        env.pop('FLASK_RUN_FROM_CLI', None)  # 按网页进程的样子启动, 不初始化迁移
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT],
+                                cwd=os.path.dirname(app.root_path), env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        if result.returncode != 0:
+            raise click.ClickException(result.stderr.strip().splitlines()[-1])
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        click.echo('create_app(): {:.1f} ms (imports included)'.format(timings['total'] * 1000))
+        click.echo('\n{:<24} {:>10}'.format('import', 'ms'))
+        for package, microseconds in import_times(result.stderr)[:top]:
+            click.echo('{:<24} {:>10.1f}'.format(package, microseconds / 1000))
+        click.echo('\n{:<24} {:>10}'.format('init step', 'ms'))
+        for name, seconds in sorted(timings['steps'].items(), key=lambda item: -item[1]):
+            click.echo('{:<24} {:>10.1f}'.format(name, seconds * 1000))
+
+    @app.cli.command('import')
+    @click.argument('kind', type=click.Choice(sorted(IMPORTERS)))
+    @click.argument('path')
+    @click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), default=None,
+                  help='Input format (default: from the file extension, JSONL for stdin).')
+    @click.option('--batch-size', default=5000, help='Rows per transaction.')
+    @click.option('--workers', type=int, default=None,
+                  help='Password hashing processes (default: CPU count, 0: hash in this process).')
+    @click.option('--skip-timelines', is_flag=True, help='Do not rebuild home timelines afterwards.')
+    def import_command(kind, path, fmt, batch_size, workers, skip_timelines):
+        """Bulk import users, posts or follows from a JSONL or CSV file ("-" for stdin)."""
+        if kind == 'users':
+            importer = UserImporter(batch_size, workers)
+        else:
+            importer = IMPORTERS[kind](batch_size)
+        reported = [time.monotonic()]
+
+        def progress(stats):  # 最多每两秒一行
+            if time.monotonic() - reported[0] >= 2:
+                reported[0] = time.monotonic()
+                click.echo('{}: {} read, {} written, {} skipped, {:.0f} rows/s'.format(
+                    kind, stats.read, stats.written, stats.skipped, stats.rate), err=True)
+
+        try:
+            stream, fmt = open_input(path, fmt)
+        except OSError as e:
+            raise click.UsageError(str(e))
+        with stream:
+            stats = importer.run(read_records(stream, fmt), progress)
+        for line, reason in stats.errors:
+            click.echo('line {}: {}'.format(line, reason), err=True)
+        if stats.skipped > len(stats.errors):
+            click.echo('... and {} more skipped line(s)'.format(stats.skipped - len(stats.errors)), err=True)
+        click.echo('Imported {} {} ({} skipped) in {:.1f}s, {:.0f} rows/s.'.format(
+            stats.written, kind, stats.skipped, stats.elapsed, stats.rate))
+
+        # 直接写的表, 补上 ORM 里做的事
+        User.repair_counters()
+        db.session.commit()
+        if kind == 'users':
+            name_registry.clear()
+        if kind == 'posts':
+            search_index.reindex()
+            db.session.commit()
+        if kind in ('posts', 'follows') and not skip_timelines:
+            click.echo('Rebuilt {} timeline(s).'.format(timeline.rebuild_all()))
+            db.session.commit()
@@ -0,0 +1,143 @@
+import re
+import sqlite3
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
+
+"""
+数据库连接调优
+
+以前用的是 Flask-SQLAlchemy 的默认设置: SQLite 文件每次都新开连接 (NullPool), 没有任何 PRAGMA,
+读请求要排在 before_request 的写后面。这里接管建引擎的过程, 全部由 config.py 控制:
+
+SQLite 文件库
+    连接池 SQLITE_POOL_SIZE 个连接, 每个新连接执行 SQLITE_PRAGMAS 里的 PRAGMA:
+    journal_mode=WAL (读不再被写阻塞), synchronous=NORMAL, mmap_size, cache_size, busy_timeout ...
+服务器数据库 (MySQL/PostgreSQL)
+    DATABASE_POOL_SIZE / DATABASE_MAX_OVERFLOW / DATABASE_POOL_RECYCLE / DATABASE_POOL_TIMEOUT / DATABASE_POOL_PRE_PING
+
+只读副本
+    配置了 DATABASE_REPLICA_URL 之后, 加了 @read_replica 的 GET 视图里的 SELECT 会走副本,
+    写入和 flush 永远走主库。某个浏览器刚写过数据的 REPLICA_STICKY_SECONDS 秒内, 它的请求都读主库,
+    这样发完动态、关注完之后马上能看到自己的修改。
+    text() 写的原始 SQL 以 SELECT 开头的算读; 其他只读的 (比如 WITH ...) 可以加
+    .execution_options(read_only=True), 反过来 read_only=False 强制走主库。
+    本地可以用第二个 SQLite 文件当副本, flask replica sync 把主库复制过去。
+"""
+
+
+_SELECT_RE = re.compile(r'\s*\(*\s*SELECT\b', re.IGNORECASE)
+
+
+def _is_read(clause):
+    """只读语句可以走副本; 分不清的一律当成写"""
+    if isinstance(clause, SelectBase):
+        return True
+    if isinstance(clause, TextClause):
+        read_only = clause.get_execution_options().get('read_only')
+        if read_only is not None:
+            return read_only
+        return _SELECT_RE.match(clause.text) is not None
+    return False
+
+
+def _is_sqlite_file(sa_url):
+    return sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:')
+
+
+class RoutingSession(SignallingSession):
+    """只读查询在 @read_replica 视图里走副本, 其他都走主库"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or (clause is not None and not _is_read(clause)):
+            if has_request_context():
+                g.db_write = True  # 这个请求写过数据库
+            return SignallingSession.get_bind(self, mapper, clause)
+        if clause is not None and _use_replica():
+            return self.db.get_engine(self.app, bind='replica')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def _use_replica():
+    return has_request_context() and g.get('use_replica', False) and not g.get('db_write', False)
+
+
+def read_replica(f):
+    """GET 请求里的查询走只读副本, 最近写过数据的浏览器除外"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET' and session.get('primary_until', 0) < time.time():
+            g.use_replica = 'replica' in (current_app.config.get('SQLALCHEMY_BINDS') or ())
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+
+        @app.after_request
+        def _stick_to_primary(response):
+            if g.get('db_write'):
+                session['primary_until'] = time.time() + app.config.get('REPLICA_STICKY_SECONDS', 5)
+            return response
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        if _is_sqlite_file(sa_url):
+            # 保持一个小连接池, 不用每次都重新打开文件、重新执行 PRAGMA (SQLite 文件默认是 NullPool)
+            options.setdefault('poolclass', QueuePool)
+            options.setdefault('pool_size', app.config.get('SQLITE_POOL_SIZE', 5))
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        elif sa_url.drivername != 'sqlite':
+            for option, key in (('pool_size', 'DATABASE_POOL_SIZE'),
+                                ('max_overflow', 'DATABASE_MAX_OVERFLOW'),
+                                ('pool_recycle', 'DATABASE_POOL_RECYCLE'),
+                                ('pool_timeout', 'DATABASE_POOL_TIMEOUT'),
+                                ('pool_pre_ping', 'DATABASE_POOL_PRE_PING')):
+                if app.config.get(key) is not None:
+                    options.setdefault(option, app.config[key])
+        SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if sa_url.drivername == 'sqlite':
+            pragmas = dict(self.get_app().config.get('SQLITE_PRAGMAS') or {})
+            if not _is_sqlite_file(sa_url):
+                pragmas.pop('journal_mode', None)  # 内存数据库没有 WAL
+                pragmas.pop('mmap_size', None)
+            if pragmas:
+                event.listen(engine, 'connect', _pragma_listener(pragmas))
+        return engine
+
+
+def _pragma_listener(pragmas):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+    return set_sqlite_pragmas
+
+
+def copy_sqlite_database(source, target):
+    """用 SQLite 的在线备份把主库复制到本地的副本文件"""
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        with dst:
+            src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
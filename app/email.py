@@ -1,26 +1,16 @@
-from flask_mail import Message
-from app import mail
-from flask import render_template
-from app import app
-from threading import Thread
+from flask import render_template, current_app
+from app import mail_queue
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
-
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+    # 放进发件箱就返回, 由发信线程池去发 见 app/mail_queue.py
+    mail_queue.enqueue(subject, sender, recipients, text_body, html_body)
 
 
 def send_password_reset_email(user):
     token = user.get_reset_password_token()
     send_email('[Microblog] Reset Your Password',
-               sender=app.config['ADMINS'][0],
+               sender=current_app.config['ADMINS'][0],
                recipients=[user.email],
                text_body=render_template('email/reset_password.txt',
                                          user=user, token=token),
@@ -1,13 +1,28 @@
-from flask import render_template
-from app import app, db
+from flask import Blueprint, render_template
+from app import db
+from app.passwords import HasherBusy
+from app.rate_limit import RateLimited
 
+bp = Blueprint('errors', __name__)
 
-@app.errorhandler(404)
+
+@bp.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
+
+
+@bp.app_errorhandler(HasherBusy)
+def hasher_busy_error(error):  # 同时登录的人太多, 密码哈希排不上队
+    db.session.rollback()
+    return render_template('503.html'), 503, {'Retry-After': '5'}
+
+
+@bp.app_errorhandler(RateLimited)
+def rate_limited_error(error):  # 在视图函数之前抛出, 没有要回滚的
+    return render_template('429.html'), 429, {'Retry-After': str(error.retry_after)}
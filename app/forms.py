@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField, TextAreaField  # 表单内容
 from wtforms.validators import ValidationError, DataRequired, Email, EqualTo, Length  # 表单内容的类型 格式
-from app.models import User  # 导入数据库类
+from app import name_registry  # 用户名/邮箱占用检查
 
 
 # 表单
@@ -22,16 +22,14 @@ class RegistrationForm(FlaskForm):  # 注册表单
     submit = SubmitField('Register')
 
     def validate_username(self, username):  # 不能相同
-        user = User.query.filter_by(username=username.data).first()  # 看数据库中有没有重名的
-        if user is not None:
+        if name_registry.exists('username', username.data):  # 布隆过滤器说没有就不查数据库
             raise ValidationError('Please use a different username.')  # 出现错误这句会输出到web页面上？？？？
 
         # {% for error in form.username.errors %}
         # <span style="color: red;">[{{ error }}]</span>
 
     def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()  # 每个email只可以注册一个用户
-        if user is not None:
+        if name_registry.exists('email', email.data):  # 每个email只可以注册一个用户
             raise ValidationError('Please use a different email address.')
 
         # {% for error in form.email.errors %}
@@ -58,8 +56,7 @@ class EditProfileForm(FlaskForm):  # 修改页面的表单
 
     def validate_username(self, username):  # 如果名字没有修改 则通过
         if username.data != self.original_username:
-            user = User.query.filter_by(username=self.username.data).first()  # 看数据库有没有重名
-            if user is not None:
+            if name_registry.exists('username', self.username.data):  # 看有没有重名
                 raise ValidationError('Please use a different username.')
 
 
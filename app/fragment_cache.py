@@ -0,0 +1,258 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from flask import render_template, Markup
+
+"""
+渲染结果缓存
+
+动态发出去之后就不会再变, 但 /explore 每次都要把 _post.html 渲染 25 遍。
+    render_post(post)   单条动态的 HTML, 键是 (post.id, post.timestamp, 作者版本)
+    page(key, render)   整块动态列表 (含翻页链接) 的 HTML, 给 /explore 用, 键里带游标
+
+作者版本由模板里用到的作者信息 (用户名、头像) 算出来, 作者改了资料键就变了, 旧的条目自然失效;
+动态列表另外还有一个代数 (generation), 有人改资料或者发新动态时换一个新值。
+用 ?before= 游标翻到的旧页面不会因为新动态而改变, 只跟着改资料的代数走。
+代数存在后端里: 共用的后端上一个进程换了代数, 别的进程下次读页面就用新的键。
+
+后端:
+    memory      每个进程自己的 LRU, 按字节数限制大小
+    filesystem  存在 FRAGMENT_CACHE_DIR 目录里, 多个进程共用; 每写 CLEANUP_EVERY 次清理一遍,
+                删掉过期的文件, 总大小超过 FRAGMENT_CACHE_MAX_BYTES 时从最早写入的开始删
+    none        不缓存
+"""
+
+
+class MemoryBackend(object):
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._generations = {}
+
+    def generation(self, name):
+        with self._lock:
+            return str(self._generations.get(name, 0))
+
+    def bump(self, name):
+        with self._lock:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (time.time() + ttl if ttl else None, value)
+            self.size += len(value)
+            while self.size > self.max_bytes and self._data:
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= len(item[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class FileSystemBackend(object):
+    """每个键一个文件, 过期时间写在文件第一行; 代数在 generations 目录里, 一个名字一个文件"""
+    CLEANUP_EVERY = 200
+
+    def __init__(self, directory, max_bytes=32 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name[:2], name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                expires = float(f.readline())
+                value = f.read()
+        except (OSError, ValueError):
+            return None
+        if expires and expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def _write(self, path, text):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)  # 别的进程要么读到旧文件要么读到新文件
+
+    def set(self, key, value, ttl=None):
+        self._write(self._path(key), '{}\n{}'.format(time.time() + ttl if ttl else 0, value))
+        with self._lock:
+            self._writes += 1
+            cleanup = self._writes % self.CLEANUP_EVERY == 0
+        if cleanup:
+            self.cleanup()
+
+    def generation(self, name):
+        try:
+            with open(os.path.join(self.directory, 'generations', name), encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return '0'
+
+    def bump(self, name):  # 换成一个新的随机值而不是加一, 两个进程同时换也不会有一个丢掉
+        self._write(os.path.join(self.directory, 'generations', name), uuid.uuid4().hex)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # 别的进程已经删了
+            pass
+
+    def cleanup(self):
+        """删掉过期的文件, 总大小还超过 max_bytes 就按写入时间从早到晚删; 返回删掉的文件数"""
+        now = time.time()
+        removed = 0
+        entries = []  # (写入时间, 大小, 路径)
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [d for d in dirs if d != 'generations']
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if name.endswith('.tmp'):  # 写到一半的进程挂了留下的
+                        expired = stat.st_mtime < now - 60
+                    else:
+                        with open(path, encoding='utf-8') as f:
+                            expires = float(f.readline())
+                        expired = bool(expires) and expires < now
+                except (OSError, ValueError):
+                    continue
+                if expired:
+                    self._remove(path)
+                    removed += 1
+                elif not name.endswith('.tmp'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(entry[1] for entry in entries)
+        for mtime, length, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            self._remove(path)
+            size -= length
+            removed += 1
+        return removed
+
+    def clear(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                os.remove(os.path.join(root, name))
+
+
+class FragmentCache(object):
+    def __init__(self, app=None):
+        self.backend = None
+        self.page_ttl = 30
+        self._lock = threading.Lock()
+        self._stats = {}  # 'post' / 'page' -> [命中次数, 未命中次数, 未命中时渲染花掉的秒数]
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config.get('FRAGMENT_CACHE_BACKEND', 'memory')
+        max_bytes = app.config.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+        if name == 'memory':
+            self.backend = MemoryBackend(max_bytes)
+        elif name == 'filesystem':
+            self.backend = FileSystemBackend(app.config.get('FRAGMENT_CACHE_DIR') or
+                                             os.path.join(app.instance_path, 'fragments'), max_bytes)
+        self.page_ttl = app.config.get('PAGE_CACHE_TTL', 30)
+        app.add_template_global(self.render_post, 'render_post')
+        app.extensions['fragment_cache'] = self
+
+    @staticmethod
+    def author_version(user):  # _post.html 里用到的作者信息变了, 版本就变了
+        return '{:08x}'.format(zlib.crc32('{}|{}'.format(user.username, user.avatar(70)).encode('utf-8')))
+
+    def _cached(self, kind, key, render, ttl=None):
+        if self.backend is None:
+            return Markup(render())
+        html = self.backend.get(key)
+        with self._lock:
+            stats = self._stats.setdefault(kind, [0, 0, 0.0])
+            if html is not None:
+                stats[0] += 1
+        if html is not None:
+            return Markup(html)
+        start = time.perf_counter()
+        html = render()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats[1] += 1
+            stats[2] += elapsed
+        self.backend.set(key, str(html), ttl)
+        return Markup(html)
+
+    def render_post(self, post):
+        """模板里用 {{ render_post(post) }} 代替 {% include '_post.html' %}"""
+        key = 'post:{}:{}:{}'.format(post.id, post.timestamp.isoformat(), self.author_version(post.author))
+        return self._cached('post', key, lambda: render_template('_post.html', post=post))
+
+    def page(self, key, render, stable=False):
+        """缓存一整块动态列表; stable=True 表示新动态不会改变这一页 (用 before 游标翻到的旧页)"""
+        if self.backend is None:
+            return Markup(render())
+        key = 'page:{}:{}'.format(key, self.backend.generation('profile'))
+        if not stable:
+            key += ':{}'.format(self.backend.generation('post'))
+        return self._cached('page', key, render, self.page_ttl)
+
+    def post_created(self):  # 有新动态, 第一页和往新翻的页都变了
+        if self.backend is not None:
+            self.backend.bump('post')
+
+    def profile_changed(self):  # 有人改了资料, 所有缓存的页都可能变了; 单条动态的键里带作者版本, 不用管
+        if self.backend is not None:
+            self.backend.bump('profile')
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """每种缓存的命中率和省下的渲染时间 (按未命中时的平均渲染时间估算)"""
+        result = {}
+        for kind, (hits, misses, seconds) in self._stats.items():
+            lookups = hits + misses
+            result[kind] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': hits / lookups if lookups else 0.0,
+                'render_seconds': seconds,
+                'render_seconds_saved': hits * seconds / misses if misses else 0.0,
+            }
+        return result
@@ -0,0 +1,121 @@
+import atexit
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db
+
+"""
+缓冲 last_seen 的写入
+
+以前 before_request 每个请求都 current_user.last_seen = ... 再 commit 一次,
+SQLite 只有一把写锁, 所有登录用户的请求都排队等它。
+现在请求里只把时间记在内存里, 同一个用户多次访问只保留最新的一次,
+由后台线程每 LAST_SEEN_FLUSH_INTERVAL 秒 (或者攒够 LAST_SEEN_FLUSH_THRESHOLD 个用户) 用一条批量 UPDATE 写回,
+进程退出时也会写一次。
+和数据库里的值相差不到 LAST_SEEN_GRANULARITY 秒的不写, 反正页面上看不出区别。
+"""
+
+
+class LastSeenTracker(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.granularity = timedelta(seconds=60)
+        self.flush_interval = 30
+        self.flush_threshold = 500
+        self._lock = threading.Lock()
+        self._seen = {}  # user_id -> 最近一次访问的时间, 给页面读
+        self._dirty = set()  # 需要写回数据库的 user_id
+        self._flushed = {}  # user_id -> 最近一次写回的值, user 对象可能来自缓存, 比数据库旧
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._exit_hook = False  # create_app() 可能调用多次, atexit 只注册一次
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.granularity = timedelta(seconds=app.config.get('LAST_SEEN_GRANULARITY', 60))
+        self.flush_interval = app.config.get('LAST_SEEN_FLUSH_INTERVAL', 30)
+        self.flush_threshold = app.config.get('LAST_SEEN_FLUSH_THRESHOLD', 500)
+        app.extensions['last_seen'] = self
+        if not self._exit_hook:
+            atexit.register(self.shutdown)
+            self._exit_hook = True
+
+    def touch(self, user, now=None):
+        """记录一次访问, 不碰数据库"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            persisted = max(filter(None, [user.last_seen, self._flushed.get(user.id)]), default=None)
+            self._seen[user.id] = now
+            if persisted is None or now - persisted >= self.granularity:
+                self._dirty.add(user.id)
+            pending = len(self._dirty)
+        if pending >= self.flush_threshold:
+            self._wakeup.set()
+        self._start()
+
+    def refresh(self, user):
+        """把缓冲里最新的 last_seen 放到 user 上给模板用, 不会把对象标记为已修改"""
+        last_seen = self._seen.get(user.id)
+        if last_seen is not None and last_seen != user.last_seen:
+            set_committed_value(user, 'last_seen', last_seen)
+        return user
+
+    def flush(self):
+        """把需要写回的 last_seen 用一条批量 UPDATE 写进数据库, 返回写了多少个用户"""
+        from app.models import User
+        with self._lock:
+            rows = [{'user_id': user_id, 'last_seen': self._seen[user_id]} for user_id in self._dirty]
+            self._dirty = set()
+            # 已经写回或者超过粒度的记录不用再留在内存里
+            horizon = datetime.utcnow() - self.granularity
+            self._seen = {k: v for k, v in self._seen.items() if v > horizon}
+            self._flushed = {k: v for k, v in self._flushed.items() if v > horizon}
+        if not rows:
+            return 0
+        table = User.__table__
+        try:
+            db.session.execute(table.update()
+                               .where(table.c.id == db.bindparam('user_id'))
+                               .values(last_seen=db.bindparam('last_seen')), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            with self._lock:  # 写失败了, 下次再试
+                for row in rows:
+                    self._seen.setdefault(row['user_id'], row['last_seen'])
+                    self._dirty.add(row['user_id'])
+            raise
+        with self._lock:
+            self._flushed.update((row['user_id'], row['last_seen']) for row in rows)
+        return len(rows)
+
+    def _start(self):
+        if self._thread is not None or not self.flush_interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='last-seen-flusher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush_in_context()
+
+    def _flush_in_context(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                db.session.rollback()
+                self.app.logger.exception('Failed to flush last_seen')
+            finally:
+                db.session.remove()
+
+    def shutdown(self):  # 进程退出前把缓冲写完
+        if self.app is not None and self._dirty:
+            self._flush_in_context()
@@ -0,0 +1,153 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+
+"""
+日志管道
+
+以前 app.logger 上直接挂 SMTPHandler 和 RotatingFileHandler:
+每条 ERROR 都在请求线程里同步连 SMTP 发一封信, 日志文件 10KB 就轮转一次, 写文件也在请求线程里。
+现在请求线程只把日志记录放进内存队列 (满了就丢弃并计数, 绝不阻塞),
+由 QueueListener 的后台线程写文件、发邮件:
+    文件    LOG_DIR/microblog.log, 每 LOG_MAX_BYTES 轮转, 保留 LOG_BACKUP_COUNT 个;
+            LOG_FORMAT = 'json' 时每行一个 JSON 对象, 方便日志系统收集
+    邮件    同样的错误 (消息第一行 + 异常最后一行相同) LOG_MAIL_WINDOW 秒内只发一封,
+            每个窗口最多发 LOG_MAIL_MAX_PER_WINDOW 封, 被压掉的次数写在下一封邮件里
+进程退出时停止 listener, 把队列里剩下的记录写完。
+"""
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """队列满了就丢弃, 请求线程不等"""
+
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # 和 QueueHandler.prepare 一样把参数和异常先格式化成字符串 (异常对象不能跨线程留着),
+        # 但异常放在 exc_text 里而不是拼进 msg, 后面的 JSON 格式可以单独成一个字段
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """相同的错误一个窗口内只发一封, 每个窗口的邮件总数也有上限"""
+
+    def __init__(self, *args, window=600, max_per_window=10, **kwargs):
+        SMTPHandler.__init__(self, *args, **kwargs)
+        self.window = window
+        self.max_per_window = max_per_window
+        self._lock = threading.Lock()
+        self._last_sent = {}  # 错误的键 -> 上次发信的时间
+        self._suppressed = {}  # 错误的键 -> 上次发信之后压掉了几次
+        self._window_start = 0.0
+        self._window_count = 0
+
+    @staticmethod
+    def key(record):
+        lines = (record.exc_text or '').strip().splitlines()
+        return (record.levelname, record.getMessage().split('\n', 1)[0], lines[-1] if lines else '')
+
+    def emit(self, record):
+        key = self.key(record)
+        now = time.time()
+        with self._lock:
+            if now - self._window_start >= self.window:
+                self._window_start, self._window_count = now, 0
+                self._last_sent = {k: v for k, v in self._last_sent.items() if now - v < self.window}
+            if now - self._last_sent.get(key, -self.window) < self.window or \
+                    self._window_count >= self.max_per_window:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._last_sent[key] = now
+            self._window_count += 1
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record = copy.copy(record)
+            record.msg = '{}\n\n({} more of this error suppressed since the last mail)'.format(
+                record.getMessage(), suppressed)
+            record.args = None
+        SMTPHandler.emit(self, record)
+
+
+def setup_logging(app):
+    """把文件和邮件日志放到 QueueListener 后面, app.logger 上只挂一个 QueueHandler"""
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure,
+            window=app.config.get('LOG_MAIL_WINDOW', 600),
+            max_per_window=app.config.get('LOG_MAIL_MAX_PER_WINDOW', 10))
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    log_dir = app.config.get('LOG_DIR', 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'microblog.log'),
+                                       maxBytes=app.config.get('LOG_MAX_BYTES', 10 * 1024 * 1024),
+                                       backupCount=app.config.get('LOG_BACKUP_COUNT', 10),
+                                       encoding='utf-8')
+    if app.config.get('LOG_FORMAT') == 'json':
+        file_handler.setFormatter(JSONFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    file_handler.setLevel(logging.INFO)
+    handlers.append(file_handler)
+
+    log_queue = queue.Queue(app.config.get('LOG_QUEUE_SIZE', 10000))
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # 退出前把队列里的日志写完
+    app.logger.addHandler(queue_handler)
+    app.logger.setLevel(logging.INFO)
+    app.extensions['log_listener'] = listener
+    return listener
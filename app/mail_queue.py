@@ -0,0 +1,211 @@
+import atexit
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from app import db
+
+"""
+发件箱和发信线程池
+
+以前 send_email() 每封邮件都新开一个线程, 线程里再新开一个 SMTP 连接;
+一阵 /reset_password_request 就能开出任意多个线程, 发送失败的邮件直接丢了。
+现在:
+    enqueue()   把邮件写进 outbox_message 表就返回, 和当前 session 里的修改一起提交
+    发信线程    固定 MAIL_WORKERS 个, 每次领 MAIL_BATCH_SIZE 封到期的邮件,
+                有活干的时候一直用同一个 SMTP 连接, 闲下来才断开
+    重试        临时性错误 (连不上、4xx) 按 MAIL_RETRY_BACKOFF 指数退避, 最多 MAIL_MAX_ATTEMPTS 次;
+                5xx 这种永久性错误直接标记为 failed
+    退出        进程退出时等发信线程把到期的邮件发完 (最多 MAIL_DRAIN_TIMEOUT 秒),
+                没发完的还在表里, 下次启动接着发
+领邮件时把状态改成 sending 并写上租约到期时间, 多个线程、多个进程不会重复领;
+进程中途挂掉的邮件租约到期后会被重新领走。
+flask mail send 可以不靠后台线程直接把到期的邮件发完。
+"""
+
+
+def _is_permanent(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+class MailQueue(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.batch_size = 20
+        self.max_attempts = 5
+        self.backoff = 30
+        self.lease = timedelta(seconds=300)
+        self.poll_interval = 10
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._exit_hook = False  # create_app() 可能调用多次, atexit 只注册一次
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', 20)
+        self.max_attempts = app.config.get('MAIL_MAX_ATTEMPTS', 5)
+        self.backoff = app.config.get('MAIL_RETRY_BACKOFF', 30)
+        self.lease = timedelta(seconds=app.config.get('MAIL_SEND_TIMEOUT', 300))
+        self.poll_interval = app.config.get('MAIL_POLL_INTERVAL', 10)
+        app.before_first_request(self._start)  # 上次没发完的邮件启动后接着发
+        app.extensions['mail_queue'] = self
+        if not self._exit_hook:
+            atexit.register(self.shutdown)
+            self._exit_hook = True
+
+    def enqueue(self, subject, sender, recipients, text_body, html_body):
+        """写进发件箱并提交, 由发信线程去发"""
+        from app.models import OutboxMessage
+        message = OutboxMessage(subject=subject, sender=sender, recipients=','.join(recipients),
+                                body=text_body, html=html_body)
+        db.session.add(message)
+        db.session.commit()
+        self._start()
+        self._wakeup.set()
+        return message
+
+    def _claim(self):
+        """领一批到期的邮件, 改成 sending 并写上租约"""
+        from app.models import OutboxMessage
+        now = datetime.utcnow()
+        due = db.and_(OutboxMessage.status.in_(('pending', 'sending')), OutboxMessage.next_attempt_at <= now)
+        ids = [row.id for row in db.session.query(OutboxMessage.id).filter(due)
+               .order_by(OutboxMessage.id).limit(self.batch_size)]
+        table = OutboxMessage.__table__
+        claimed = []
+        for message_id in ids:  # 逐条加条件更新, 被别的线程抢先领走的 rowcount 是 0
+            result = db.session.execute(table.update()
+                                        .where(db.and_(table.c.id == message_id, due))
+                                        .values(status='sending', next_attempt_at=now + self.lease))
+            if result.rowcount:
+                claimed.append(message_id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return OutboxMessage.query.filter(OutboxMessage.id.in_(claimed)).order_by(OutboxMessage.id).all()
+
+    def mail_state(self):
+        """Flask-Mail 的状态; 第一次发信时才导入、初始化 Flask-Mail, 不拖慢启动"""
+        state = self.app.extensions.get('mail')
+        if state is None:
+            from flask_mail import Mail
+            state = Mail().init_app(self.app)
+        return state
+
+    def _connect(self):
+        from flask_mail import Connection
+        connection = Connection(self.mail_state())
+        connection.__enter__()
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except (smtplib.SMTPException, OSError):
+                pass  # 连接已经断了
+        return None
+
+    def _deliver(self, messages, connection=None):
+        """用同一个连接把 messages 发出去; 返回还能继续用的连接, 出过错就返回 None"""
+        from flask_mail import Message
+        sent = 0
+        for message in messages:
+            try:
+                if connection is None:
+                    connection = self._connect()
+                connection.send(Message(message.subject, sender=message.sender,
+                                        recipients=message.recipients.split(','),
+                                        body=message.body, html=message.html))
+            except (smtplib.SMTPException, OSError) as e:
+                connection = self._close(connection)  # 出错之后连接的状态不可靠, 下一封重新连
+                self._failed(message, e)
+            else:
+                message.status = 'sent'
+                message.sent_at = datetime.utcnow()
+                message.attempts += 1
+                message.last_error = None
+                sent += 1
+            db.session.commit()  # 一封一提交, 中途挂掉也不会把发过的再发一遍
+        return connection, sent
+
+    def _failed(self, message, error):
+        message.attempts += 1
+        message.last_error = '{}: {}'.format(type(error).__name__, error)
+        if _is_permanent(error) or message.attempts >= self.max_attempts:
+            message.status = 'failed'
+            self.app.logger.error('Giving up on mail {} to {}: {}'.format(
+                message.id, message.recipients, message.last_error))
+        else:
+            message.status = 'pending'
+            delay = self.backoff * 2 ** (message.attempts - 1)
+            message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            self.app.logger.warning('Mail {} failed, retrying in {}s: {}'.format(
+                message.id, delay, message.last_error))
+
+    def drain(self):
+        """在当前线程里把所有到期的邮件发完, 返回发出去多少封"""
+        connection, total = None, 0
+        try:
+            while True:
+                messages = self._claim()
+                if not messages:
+                    return total
+                connection, sent = self._deliver(messages, connection)
+                total += sent
+        finally:
+            self._close(connection)
+
+    def _start(self):
+        if self._threads or self._stopping.is_set():
+            return
+        with self._lock:
+            if not self._threads:
+                for i in range(self.app.config.get('MAIL_WORKERS', 2)):
+                    thread = threading.Thread(target=self._run, name='mail-worker-{}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _run(self):
+        connection = None
+        while True:
+            messages = []
+            with self.app.app_context():
+                try:
+                    messages = self._claim()
+                    if messages:
+                        connection, _ = self._deliver(messages, connection)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Mail worker failed')
+                finally:
+                    db.session.remove()
+            if messages:
+                continue  # 还有活, 接着用这个连接
+            connection = self._close(connection)  # 闲下来就不占着 SMTP 连接
+            if self._stopping.is_set():
+                return
+            if self._wakeup.wait(self.poll_interval):
+                self._wakeup.clear()
+
+    def shutdown(self, timeout=None):
+        """让发信线程发完到期的邮件后退出"""
+        if timeout is None:
+            timeout = self.app.config.get('MAIL_DRAIN_TIMEOUT', 10) if self.app else 0
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self):
+        """发件箱里每种状态各有多少封"""
+        from app.models import OutboxMessage
+        rows = db.session.query(OutboxMessage.status, db.func.count()).group_by(OutboxMessage.status)
+        return dict(rows.all())
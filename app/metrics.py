@@ -0,0 +1,207 @@
+import threading
+import time
+from flask import g, has_app_context, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+请求性能统计和慢查询日志
+
+每个请求记录: 总耗时、SQL 条数和耗时 (SQLAlchemy 引擎事件)、模板渲染耗时 (嵌套的模板只算最外层)、响应字节数,
+按 endpoint 汇总在内存里, 由 /metrics 按 Prometheus 文本格式输出 (只有 ADMINS 里的用户或者带 METRICS_TOKEN 的请求能看)。
+超过 SLOW_QUERY_THRESHOLD 秒的 SQL 写到 app.slow_query 日志, 附带 EXPLAIN 的结果。
+其他模块的统计 (缓存命中率、发件箱) 用 @metrics.collector 注册, 输出时一起调用。
+"""
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.buckets = [0] * len(DURATION_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+    def add(self, seconds, sql_queries, sql_seconds, template_seconds, response_bytes, status):
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.sql_queries += sql_queries
+        self.sql_seconds += sql_seconds
+        self.template_seconds += template_seconds
+        self.response_bytes += response_bytes
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+class RequestTimings(object):
+    """一个请求里累计的数字, 放在 g._metrics 上"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_stack = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+class Metrics(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.slow_query_threshold = 0.1
+        self.explain = True
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._collectors = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.slow_query_threshold = app.config.get('SLOW_QUERY_THRESHOLD', 0.1)
+        self.explain = app.config.get('SLOW_QUERY_EXPLAIN', True)
+        self.slow_query_log = app.logger.getChild('slow_query')  # 跟着 app.logger 走日志管道
+        app.extensions['metrics'] = self
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        # 挂在 Engine 类上, 主库、副本和以后新建的引擎都算; 再次 init_app 时不重复挂
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def _current():
+        return g.get('_metrics') if has_app_context() else None
+
+    def _before_request(self):
+        g._metrics = RequestTimings()
+
+    def _after_request(self, response):
+        timings = g.pop('_metrics', None)
+        if timings is not None:
+            # 流式响应记 0; 对它调用 calculate_content_length() 会把整个生成器读进内存
+            size = 0 if response.is_streamed else response.calculate_content_length() or 0
+            self.record(request.endpoint or 'none', time.perf_counter() - timings.start, timings.sql_queries,
+                        timings.sql_seconds, timings.template_seconds, size, response.status_code)
+        return response
+
+    def record(self, endpoint, seconds, sql_queries=0, sql_seconds=0.0, template_seconds=0.0,
+               response_bytes=0, status=200):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.add(seconds, sql_queries, sql_seconds, template_seconds, response_bytes, status)
+
+    def _before_render(self, sender, template, context, **extra):
+        timings = self._current()
+        if timings is not None:
+            timings.template_stack.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        timings = self._current()
+        if timings is not None and timings.template_stack:
+            start = timings.template_stack.pop()
+            if not timings.template_stack:  # 只算最外层, 里面 include/render_post 的时间已经包含在内
+                timings.template_seconds += time.perf_counter() - start
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        timings = self._current()
+        if timings is not None:
+            timings.sql_queries += 1
+            timings.sql_seconds += elapsed
+        if elapsed >= self.slow_query_threshold:
+            self._log_slow_query(conn, statement, parameters, executemany, elapsed)
+
+    def _log_slow_query(self, conn, statement, parameters, executemany, elapsed):
+        with self._lock:
+            self.slow_queries += 1
+        plan = ''
+        head = statement.lstrip()[:6].upper()
+        if self.explain and not executemany and (head == 'SELECT' or head.startswith('WITH')):  # 只 EXPLAIN 读语句
+            plan = self.explain_plan(conn, statement, parameters)
+        self.slow_query_log.warning('Slow query ({:.3f}s) {}: {}\n{}{}'.format(
+            elapsed, request.path if has_request_context() else '-', statement, parameters,
+            '\n' + plan if plan else ''))
+
+    @staticmethod
+    def explain_plan(conn, statement, parameters):
+        """在同一个连接上跑 EXPLAIN, 不经过引擎事件, 免得又被统计一次"""
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        except Exception as e:
+            return 'EXPLAIN failed: {}'.format(e)
+        finally:
+            cursor.close()
+
+    def collector(self, f):
+        """注册一个函数, 返回 [(指标名, 类型, 说明, [(标签, 值), ...]), ...], /metrics 输出时调用"""
+        self._collectors.append(f)
+        return f
+
+    def render(self):
+        """Prometheus 文本格式"""
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            duration = []
+            for endpoint, stats in endpoints:
+                for bound, count in zip(DURATION_BUCKETS, stats.buckets):
+                    duration.append(('_bucket', (('endpoint', endpoint), ('le', bound)), count))
+                duration.append(('_bucket', (('endpoint', endpoint), ('le', '+Inf')), stats.count))
+                duration.append(('_sum', (('endpoint', endpoint),), stats.seconds))
+                duration.append(('_count', (('endpoint', endpoint),), stats.count))
+            lines.append('# HELP microblog_request_duration_seconds Request wall time.')
+            lines.append('# TYPE microblog_request_duration_seconds histogram')
+            for suffix, labels, value in duration:
+                lines.append('microblog_request_duration_seconds{}{} {}'.format(suffix, _labels(labels), value))
+            family('microblog_requests_total', 'counter', 'Requests by endpoint and status.',
+                   [((('endpoint', e), ('status', status)), n)
+                    for e, stats in endpoints for status, n in sorted(stats.statuses.items())])
+            for name, attr, help in (
+                    ('microblog_sql_queries_total', 'sql_queries', 'SQL statements executed.'),
+                    ('microblog_sql_seconds_total', 'sql_seconds', 'Time spent in SQL statements.'),
+                    ('microblog_template_seconds_total', 'template_seconds', 'Time spent rendering templates.'),
+                    ('microblog_response_bytes_total', 'response_bytes', 'Response body bytes.')):
+                family(name, 'counter', help, [((('endpoint', e),), getattr(stats, attr)) for e, stats in endpoints])
+            family('microblog_slow_queries_total', 'counter',
+                   'Statements slower than SLOW_QUERY_THRESHOLD.', [((), self.slow_queries)])
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                family(name, kind, help, samples)
+        return '\n'.join(lines) + '\n'
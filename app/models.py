@@ -1,11 +1,12 @@
 from datetime import datetime
 from app import db  # 导入数据库
-from werkzeug.security import generate_password_hash, check_password_hash  # hash摘要算法
-from app import login
+from app import login, timeline, user_cache, avatars, name_registry, passwords, trending  # passwords: hash摘要算法
+from app.avatars import email_digest
 from flask_login import UserMixin
-from hashlib import md5
-import jwt
-from app import app
+from sqlalchemy import event
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import get_history
+from flask import current_app
 from time import time
 ''' 作为一个附加手段，多次哈希相同的密码，你将得到不同的结果，
     所以这使得无法通过查看它们的哈希值来确定两个用户是否具有相同的密码。'''
@@ -22,18 +23,36 @@ Flask-Login插件需要在用户模型上实现某些属性和方法。
 下面演示了如何将mixin类添加到模型中
 """
 followers = db.Table('followers',
-                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+                     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                     # 主键 (follower_id, followed_id) 负责 "我关注了谁"、is_following, 也防止重复关注
+                     # 反向索引负责 "谁关注了我"、粉丝数
+                     db.Index('ix_followers_followed_follower', 'followed_id', 'follower_id')
                      )
 
+# 首页时间线, 发动态时推送进来 见 app/timeline.py
+timeline_entries = db.Table('timeline_entry',
+                            db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                            db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+                            db.Column('author_id', db.Integer, db.ForeignKey('user.id')),
+                            db.Column('timestamp', db.DateTime),
+                            db.Index('ix_timeline_entry_user_timestamp', 'user_id', 'timestamp', 'post_id')
+                            )
+
 
 class User(db.Model, UserMixin):  # 设置数据库User表
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32))  # email 的 md5, 生成头像 URL 用
     password_hash = db.Column(db.String(128))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # 冗余的计数, 在 follow/unfollow/发动态时和数据一起更新, 个人主页不用再 COUNT
+    # 对不上时用 flask counters repair 重新统计
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     posts = db.relationship('Post', backref='author', lazy='dynamic')
 
@@ -62,51 +81,91 @@ class User(db.Model, UserMixin):  # 设置数据库User表
         backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)  # 将password转换成hash字符串
+        self.password_hash = passwords.hash(password)  # 将password转换成hash字符串 算法和参数见 app/passwords.py
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)  # 用户输入用户名和密码
+        return passwords.verify(self.password_hash, password)  # 用户输入用户名和密码
         # 将数据库里用户的密码摘要,与用户输入的密码摘要对比
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
-    def avatar(self, size):  # 生成图片并返回
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()  # 生成唯一图片
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)  # 返回图片
+    @validates('email')
+    def validate_email(self, key, email):  # email 变了就重新算头像的 md5
+        self.avatar_hash = email_digest(email) if email else None
+        return email
+
+    def avatar(self, size):  # 返回头像 URL, md5 已经存在 avatar_hash 里, URL 按 (digest, size) 缓存
+        digest = self.avatar_hash or email_digest(self.email)
+        return avatars.url(digest, size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            timeline.follow(self, user)  # 把对方的动态补进自己的时间线 (会读 follower_count, 要在下面改计数之前)
+            # 用 SQL 表达式加一, 并发的关注也不会互相覆盖; flush 之后再读这两个属性会重新加载
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            trending.record_follow(self.id, user.id)  # 被关注的人活跃度加分, 反复关注只算一次 见 app/trending.py
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            timeline.unfollow(self, user)  # 从时间线里删掉对方的动态
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
 
     def is_following(self, user):  # 发出一个关于followed关系的查询来检查两个用户之间的关系是否已经存在
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0  # followers.c.follower_id表达式引用了该关系表中的follower_id
 
-    def followed_posts(self):  # 找出关注的人
-        return Post.query\
-            .join(followers,(followers.c.followed_id == Post.user_id)) \
-            .filter(followers.c.follower_id == self.id)\
-            .order_by(Post.timestamp.desc())
+    def followed_posts(self):  # 找出关注的人和自己的动态  首页现在读 timeline, 这里用于对照和重建
+        followed = Post.query\
+            .join(followers, (followers.c.followed_id == Post.user_id)) \
+            .filter(followers.c.follower_id == self.id)
+        own = Post.query.filter_by(user_id=self.id)
+        return followed.union(own).order_by(Post.timestamp.desc())
 
     def get_reset_password_token(self, expires_in=600):
+        import jwt  # 只有找回密码用到, 不在启动时导入
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
-            app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+            current_app.config['SECRET_KEY'], algorithm='HS256').decode('utf-8')
+
+    @staticmethod
+    def repair_counters():
+        """用一条 UPDATE 按 followers 和 post 表重新统计所有用户的计数"""
+        user = User.__table__
+        db.session.execute(user.update().values(
+            follower_count=db.select([db.func.count()]).where(
+                followers.c.followed_id == user.c.id).as_scalar(),
+            followed_count=db.select([db.func.count()]).where(
+                followers.c.follower_id == user.c.id).as_scalar(),
+            post_count=db.select([db.func.count()]).where(
+                Post.user_id == user.c.id).as_scalar()))
 
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
         try:
-            id = jwt.decode(token, app.config['SECRET_KEY'],
+            id = jwt.decode(token, current_app.config['SECRET_KEY'],
                             algorithms=['HS256'])['reset_password']
         except:
             return
         return User.query.get(id)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def remember_names(mapper, connection, user):  # 新名字加进 name_registry 的布隆过滤器 见 app/name_registry.py
+    for field in name_registry.FIELDS:
+        added, _, deleted = get_history(user, field)
+        for value in added or ():
+            name_registry.remember(field, value)
+            if not deleted:  # 改名前的值已经过期没加载, 不知道空出来的是哪个名字
+                name_registry.forget(field)
+        for value in deleted or ():
+            name_registry.forget(field, value)
 """
 followed_posts()函数已被扩展成通过联合查询来并入用户自己的动态：
 def followed_posts(self):
@@ -141,6 +200,11 @@ class Post(db.Model):  # 设置post表
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),  # 游标分页按 (timestamp, id) 排序
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),  # 某个用户的动态, followed_posts() 的 join
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
@@ -155,10 +219,59 @@ post表将具有必须的id、用户动态的body和timestamp字段。
 """
 
 
+class FollowSuggestion(db.Model):  # "可能想关注的人", 由 flask recommend build 离线算好 见 app/recommend.py
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 0 最靠前; 主键就是侧栏要的顺序
+    suggested_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    score = db.Column(db.Integer, nullable=False)  # 我关注的人里有几个关注了他
+
+    def __repr__(self):
+        return '<FollowSuggestion {} -> {}>'.format(self.user_id, self.suggested_id)
+
+
+class TrendingScore(db.Model):  # 作者的活跃度, 前向衰减之后取对数存 见 app/trending.py
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False, index=True)
+
+
+class TrendingFollow(db.Model):  # 最近加过分的关注, 同一对在 TRENDING_WINDOW 里只加一次
+    follower_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class TrendingEntry(db.Model):  # flask trending compact 排好的 /explore?sort=trending, 按 rank 翻页
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+class OutboxMessage(db.Model):  # 待发送的邮件 见 app/mail_queue.py
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(255))
+    recipients = db.Column(db.Text)  # 逗号分隔
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending / sending / sent / failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # sending 时是租约到期的时间
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),  # 找到期的邮件
+    )
+
+    def __repr__(self):
+        return '<OutboxMessage {} {}>'.format(self.id, self.status)
+
+
 # 装饰器来为用户加载功能注册函数
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    return user_cache.load(int(id))  # 命中缓存时不查数据库 见 app/user_cache.py
 
 
 '''
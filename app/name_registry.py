@@ -0,0 +1,192 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app import db
+
+"""
+用户名/邮箱是否已被占用
+
+注册表单和修改资料表单的 validate_username/validate_email 以前每次提交都要查一次数据库,
+加上 /api/check_username 边输入边检查之后查询会更多。现在先查内存里的布隆过滤器:
+    不在过滤器里    肯定没人用, 不查数据库
+    在过滤器里      可能被占用 (有 NAME_BLOOM_ERROR_RATE 的误判), 查 LRU, 没有再查数据库, 结果放进 LRU
+过滤器在应用处理第一个请求之前 (before_first_request) 从 user 表建好, 不在请求之外用到时 (命令行、测试)
+第一次检查时再建, 同时只有一个线程在建; 之后新用户插入、改名时由 models.py 里的事件加进去。
+每 NAME_BLOOM_REBUILD_INTERVAL 秒重建一次, 把别的进程新注册的名字也加进来: 在后台线程里建新的,
+建好之前旧的过滤器照常回答, 建的过程中本进程加进来的名字在换上新过滤器时补进去。
+过滤器和 LRU 都可能因为别的进程而过时, 所以最后还是以 user 表上的唯一约束为准,
+register() 提交时撞上唯一约束会当作名字已被占用处理。
+"""
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))  # 位数
+        self.hashes = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):  # 双重哈希: 从一个摘要里取两个 64 位整数, 组合出 k 个位置
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class NameRegistry(object):
+    FIELDS = ('username', 'email')
+
+    def __init__(self, app=None):
+        self.capacity = 100000
+        self.error_rate = 0.01
+        self.cache_size = 10000
+        self.cache_ttl = 60
+        self.rebuild_interval = 600
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()  # 第一次建的时候别的请求等着, 不要各自扫一遍 user 表
+        self._filters = None  # 字段 -> BloomFilter, None 表示还没建
+        self._built_at = 0
+        self._pending = None  # 重建过程中 remember() 的名字, 重建完补进新过滤器
+        self.rebuilding = None  # 后台重建的线程
+        self._cache = OrderedDict()  # (字段, 值) -> (过期时间, 是否被占用)
+        self.bloom_negatives = 0
+        self.cache_hits = 0
+        self.queries = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.capacity = app.config.get('NAME_BLOOM_CAPACITY', 100000)
+        self.error_rate = app.config.get('NAME_BLOOM_ERROR_RATE', 0.01)
+        self.cache_size = app.config.get('NAME_CACHE_SIZE', 10000)
+        self.cache_ttl = app.config.get('NAME_CACHE_TTL', 60)
+        self.rebuild_interval = app.config.get('NAME_BLOOM_REBUILD_INTERVAL', 600)
+        app.before_first_request(self._build_at_startup)
+        app.extensions['name_registry'] = self
+
+    def rebuild(self):
+        """从 user 表重建过滤器, 分批读, 不把所有用户一次装进内存"""
+        from app.models import User
+        with self._lock:
+            self._pending = []
+        count = db.session.query(db.func.count(User.id)).scalar()
+        capacity = max(self.capacity, 2 * count)  # 留出增长的余量
+        filters = {field: BloomFilter(capacity, self.error_rate) for field in self.FIELDS}
+        for username, email in db.session.query(User.username, User.email).yield_per(5000):
+            if username:
+                filters['username'].add(username)
+            if email:
+                filters['email'].add(email)
+        with self._lock:
+            for field, value in self._pending or ():
+                filters[field].add(value)
+            self._pending = None
+            self._filters = filters
+            self._built_at = time.time()
+            self._cache.clear()
+
+    def _build_at_startup(self):
+        try:
+            self._ensure_built()
+        except Exception:  # 比如还没跑迁移, 没有 user 表; 不影响请求, 第一次检查时再建
+            db.session.rollback()
+            current_app.logger.warning('Could not build the username bloom filter at startup', exc_info=True)
+
+    def _ensure_built(self):
+        filters = self._filters
+        if filters is None:
+            with self._build_lock:
+                if self._filters is None:
+                    self.rebuild()
+            return self._filters
+        if time.time() - self._built_at > self.rebuild_interval or \
+                any(f.count > f.capacity for f in filters.values()):  # 装满了误判率会上升
+            self._rebuild_in_background()
+        return filters
+
+    def _rebuild_in_background(self):
+        with self._lock:
+            if self.rebuilding is not None:
+                return
+            self.rebuilding = threading.Thread(target=self._background_rebuild,
+                                               args=(current_app._get_current_object(),),
+                                               name='name-registry-rebuild')
+            self.rebuilding.daemon = True
+        self.rebuilding.start()
+
+    def _background_rebuild(self, app):
+        try:
+            with app.app_context():
+                try:
+                    self.rebuild()
+                finally:
+                    db.session.remove()
+        except Exception:
+            app.logger.exception('Rebuilding the username bloom filter failed')
+            with self._lock:
+                self._pending = None
+                self._built_at = time.time()  # 过一个间隔再试, 不要每个请求都起一个线程
+        finally:
+            with self._lock:
+                self.rebuilding = None
+
+    def remember(self, field, value):
+        """新用户插入或者改名之后调用, 把新名字加进过滤器"""
+        with self._lock:
+            if self._filters is not None and value:
+                self._filters[field].add(value)
+            if self._pending is not None and value:
+                self._pending.append((field, value))
+            self._cache.pop((field, value), None)
+
+    def forget(self, field, value=None):  # 名字不再使用 (改名), 过滤器删不掉, 只清 LRU; 不知道是哪个就全清
+        with self._lock:
+            if value is not None:
+                self._cache.pop((field, value), None)
+            else:
+                for key in [key for key in self._cache if key[0] == field]:
+                    del self._cache[key]
+
+    def exists(self, field, value):
+        """value 有没有被别的用户用作 field"""
+        from app.models import User
+        if not value:
+            return False
+        if value not in self._ensure_built()[field]:
+            self.bloom_negatives += 1
+            return False
+        key = (field, value)
+        now = time.time()
+        with self._lock:
+            item = self._cache.get(key)
+            if item is not None and item[0] > now:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return item[1]
+        self.queries += 1
+        taken = db.session.query(db.exists().where(getattr(User, field) == value)).scalar()
+        with self._lock:
+            self._cache[key] = (now + self.cache_ttl, taken)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return taken
+
+    def clear(self):  # 下次检查时重建
+        with self._lock:
+            self._filters = None
+            self._cache.clear()
+
+    def stats(self):
+        return {'bloom_negatives': self.bloom_negatives, 'cache_hits': self.cache_hits, 'queries': self.queries}
@@ -0,0 +1,108 @@
+import base64
+import binascii
+from datetime import datetime
+from flask import request, url_for
+from app import db
+
+"""
+基于游标(keyset)的分页
+
+paginate(page, per_page) 用的是 OFFSET, 翻到越后面的页要跳过的行越多, 而且每一页还要额外跑一次 COUNT(*)。
+这里改成按 (timestamp, id) 这个键来翻页:
+    ?before=<游标>   比游标更早的动态 (Older posts)
+    ?after=<游标>    比游标更新的动态 (Newer posts)
+游标就是某条动态的 (timestamp, id), 编码成一个不透明的字符串, 数据库只需要沿着索引往下扫 per_page+1 行,
+多取的那一行用来判断还有没有下一页, 完全不需要 COUNT。
+
+旧的 ?page=N 链接还能用: 用 OFFSET 取出那一页 (同样不 COUNT), 之后的翻页链接就换成游标了。
+"""
+
+
+def encode_cursor(timestamp, id):
+    raw = '{}|{}'.format(timestamp.isoformat(), id).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):  # 游标不合法时返回 None, 当作第一页处理
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def older_than(timestamp_column, id_column, key):  # (timestamp, id) < key
+    return db.or_(timestamp_column < key[0],
+                  db.and_(timestamp_column == key[0], id_column < key[1]))
+
+
+def newer_than(timestamp_column, id_column, key):  # (timestamp, id) > key
+    return db.or_(timestamp_column > key[0],
+                  db.and_(timestamp_column == key[0], id_column > key[1]))
+
+
+def cursor_args():
+    """从 request.args 里取出 before / after 游标和旧的 page 参数"""
+    before = decode_cursor(request.args.get('before'))
+    after = decode_cursor(request.args.get('after')) if before is None else None
+    page = request.args.get('page', 1, type=int) if before is None and after is None else 1
+    return before, after, max(page, 1)
+
+
+class KeysetPage(object):
+    """一页动态, items 按时间倒序; has_older / has_newer 决定有没有翻页链接"""
+
+    def __init__(self, items, has_older, has_newer):
+        self.items = items
+        self.has_older = has_older and bool(items)
+        self.has_newer = has_newer and bool(items)
+
+    @property
+    def next_cursor(self):  # 更早的一页
+        if self.has_older:
+            return encode_cursor(self.items[-1].timestamp, self.items[-1].id)
+
+    @property
+    def prev_cursor(self):  # 更新的一页
+        if self.has_newer:
+            return encode_cursor(self.items[0].timestamp, self.items[0].id)
+
+    def next_url(self, endpoint, **kwargs):
+        if self.has_older:
+            return url_for(endpoint, before=self.next_cursor, **kwargs)
+
+    def prev_url(self, endpoint, **kwargs):
+        if self.has_newer:
+            return url_for(endpoint, after=self.prev_cursor, **kwargs)
+
+
+def keyset_paginate(query, per_page, before=None, after=None, page=1):
+    """对 Post 查询做游标分页, query 不要带 order_by"""
+    from app.models import Post
+    if after is not None:
+        items = query.filter(newer_than(Post.timestamp, Post.id, after)) \
+            .order_by(Post.timestamp.asc(), Post.id.asc()).limit(per_page + 1).all()
+        if not items:  # 已经是最新的了, 回到第一页
+            return keyset_paginate(query, per_page)
+        return KeysetPage(items[:per_page][::-1], has_older=True,
+                          has_newer=len(items) > per_page)
+    query = query.order_by(Post.timestamp.desc(), Post.id.desc())
+    if before is not None:
+        query = query.filter(older_than(Post.timestamp, Post.id, before))
+    elif page > 1:  # 兼容旧的 ?page=N 链接
+        query = query.offset((page - 1) * per_page)
+    items = query.limit(per_page + 1).all()
+    return KeysetPage(items[:per_page], has_older=len(items) > per_page,
+                      has_newer=before is not None or page > 1)
+
+
+def load_posts(ids):
+    """按 ids 的顺序取出 Post, 作者一起 JOIN 出来, 模板里 post.author 不会再一条条查"""
+    from app.models import Post
+    if not ids:
+        return []
+    posts = {p.id: p for p in Post.query.options(db.joinedload(Post.author)).filter(Post.id.in_(ids))}
+    return [posts[i] for i in ids if i in posts]
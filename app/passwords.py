@@ -0,0 +1,209 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+try:
+    import argon2
+except ImportError:  # 可选依赖, 没装就不能用 PASSWORD_HASH_METHOD = 'argon2'
+    argon2 = None
+
+"""
+密码哈希
+
+以前 set_password/check_password 直接用 werkzeug 的默认参数, 花多少 CPU 既不能配置也没有统计,
+一阵集中登录就能把所有 worker 占满。现在:
+    算法和参数在 Config 里选:
+        pbkdf2  werkzeug 的 pbkdf2:sha256, PASSWORD_PBKDF2_ITERATIONS 次迭代 (和旧的哈希格式一样)
+        scrypt  hashlib.scrypt, PASSWORD_SCRYPT_N / _R / _P, 格式 scrypt:n:r:p$盐$摘要
+        argon2  需要装 argon2-cffi, PASSWORD_ARGON2_TIME_COST / _MEMORY_COST / _PARALLELISM
+    计算放在 PASSWORD_HASH_WORKERS 个线程的池子里, 同时在算的加上排队的不超过 PASSWORD_HASH_MAX_PENDING 个,
+    排不上队的等 PASSWORD_HASH_TIMEOUT 秒还不行就抛 HasherBusy, 登录页返回 503, 别的请求不受影响。
+    (pbkdf2_hmac 和 scrypt 计算时会释放 GIL, 线程池里的几个计算能真正并行)
+    登录成功时如果旧哈希的算法或参数和现在的配置不一样, 用刚输入的密码重新算一次 (needs_rehash)。
+flask passwords calibrate 在本机上找出验证一次大约花 --target 秒的参数。
+"""
+
+
+class HasherBusy(Exception):
+    """排队的哈希计算太多了"""
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def scrypt_hash(password, n, r, p, salt=None):
+    salt = salt or os.urandom(16)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024,
+                            dklen=32)
+    return 'scrypt:{}:{}:{}${}${}'.format(n, r, p, _b64(salt), _b64(digest))
+
+
+def scrypt_verify(pwhash, password):
+    try:
+        params, salt, digest = pwhash.split('$')
+        _, n, r, p = params.split(':')
+        expected = scrypt_hash(password, int(n), int(r), int(p), _unb64(salt))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, pwhash)
+
+
+class PasswordHasher(object):
+    def __init__(self, app=None):
+        self.method = 'pbkdf2'
+        self.pbkdf2_iterations = 150000
+        self.scrypt_params = (2 ** 14, 8, 1)
+        self.argon2_params = (2, 102400, 8)
+        self.timeout = 10
+        self._pool = None
+        self._slots = None
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.busy = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2')
+        self.pbkdf2_iterations = app.config.get('PASSWORD_PBKDF2_ITERATIONS', 150000)
+        self.scrypt_params = (app.config.get('PASSWORD_SCRYPT_N', 2 ** 14), app.config.get('PASSWORD_SCRYPT_R', 8),
+                              app.config.get('PASSWORD_SCRYPT_P', 1))
+        self.argon2_params = (app.config.get('PASSWORD_ARGON2_TIME_COST', 2),
+                              app.config.get('PASSWORD_ARGON2_MEMORY_COST', 102400),
+                              app.config.get('PASSWORD_ARGON2_PARALLELISM', 8))
+        if self.method == 'argon2' and argon2 is None:
+            raise RuntimeError('PASSWORD_HASH_METHOD = "argon2" needs the argon2-cffi package')
+        workers = app.config.get('PASSWORD_HASH_WORKERS', 4)
+        self.timeout = app.config.get('PASSWORD_HASH_TIMEOUT', 10)
+        if self._pool is not None:  # 再次 init_app (比如测试里每次 create_app) 时关掉旧的池子
+            self._pool.shutdown(wait=False)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+        self._slots = threading.BoundedSemaphore(app.config.get('PASSWORD_HASH_MAX_PENDING', 4 * workers))
+        app.extensions['passwords'] = self
+
+    def _argon2(self):
+        time_cost, memory_cost, parallelism = self.argon2_params
+        return argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+    def _run(self, f, *args):
+        """放到线程池里算; 排队的太多就等一会儿, 还是排不上抛 HasherBusy"""
+        if self._pool is None:  # 没有 init_app 时直接在当前线程算
+            return f(*args)
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.busy += 1
+            raise HasherBusy()
+        try:
+            start = time.perf_counter()
+            result = self._pool.submit(f, *args).result()
+            with self._lock:
+                self.seconds += time.perf_counter() - start
+            return result
+        finally:
+            self._slots.release()
+
+    def _hash(self, password):
+        if self.method == 'scrypt':
+            return scrypt_hash(password, *self.scrypt_params)
+        if self.method == 'argon2':
+            return self._argon2().hash(password)
+        return generate_password_hash(password, method='pbkdf2:sha256:{}'.format(self.pbkdf2_iterations))
+
+    @staticmethod
+    def _verify(pwhash, password):
+        if pwhash.startswith('scrypt:'):
+            return scrypt_verify(pwhash, password)
+        if pwhash.startswith('$argon2'):
+            if argon2 is None:
+                return False
+            try:
+                return argon2.PasswordHasher().verify(pwhash, password)
+            except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHash):
+                return False
+        return check_password_hash(pwhash, password)  # pbkdf2 和 werkzeug 支持的旧格式
+
+    def hash(self, password):
+        with self._lock:
+            self.hashed += 1
+        return self._run(self._hash, password)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        with self._lock:
+            self.verified += 1
+        return self._run(self._verify, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """pwhash 的算法或参数和现在的配置不一样"""
+        if not pwhash:
+            return False
+        if self.method == 'scrypt':
+            return pwhash.split('$', 1)[0] != 'scrypt:{}:{}:{}'.format(*self.scrypt_params)
+        if self.method == 'argon2':
+            return not pwhash.startswith('$argon2') or self._argon2().check_needs_rehash(pwhash)
+        return pwhash.split('$', 1)[0] != 'pbkdf2:sha256:{}'.format(self.pbkdf2_iterations)
+
+    def note_rehash(self):
+        with self._lock:
+            self.rehashed += 1
+
+    def stats(self):
+        return {'hashed': self.hashed, 'verified': self.verified, 'rehashed': self.rehashed, 'busy': self.busy,
+                'seconds': self.seconds}
+
+
+def calibrate(method, target, password='correct horse battery staple'):
+    """把代价参数从小往大翻倍, 直到验证一次的时间 (取三次的中位数) 达到 target 秒, 返回 (配置项, 耗时)"""
+    def measure(hasher):
+        pwhash = hasher._hash(password)
+        times = []
+        for _ in range(3):
+            start = time.perf_counter()
+            hasher._verify(pwhash, password)
+            times.append(time.perf_counter() - start)
+        return sorted(times)[1]
+
+    hasher = PasswordHasher()
+    hasher.method = method
+    if method == 'scrypt':
+        n = 2 ** 10
+        while True:
+            hasher.scrypt_params = (n, 8, 1)
+            elapsed = measure(hasher)
+            if elapsed >= target or n >= 2 ** 20:
+                return {'PASSWORD_SCRYPT_N': n, 'PASSWORD_SCRYPT_R': 8, 'PASSWORD_SCRYPT_P': 1}, elapsed
+            n *= 2
+    if method == 'argon2':
+        if argon2 is None:
+            raise RuntimeError('argon2-cffi is not installed')
+        time_cost = 1
+        while True:
+            hasher.argon2_params = (time_cost, 65536, 2)
+            elapsed = measure(hasher)
+            if elapsed >= target or time_cost >= 64:
+                return {'PASSWORD_ARGON2_TIME_COST': time_cost, 'PASSWORD_ARGON2_MEMORY_COST': 65536,
+                        'PASSWORD_ARGON2_PARALLELISM': 2}, elapsed
+            time_cost *= 2
+    iterations = 10000
+    while True:
+        hasher.pbkdf2_iterations = iterations
+        elapsed = measure(hasher)
+        if elapsed >= target or iterations >= 10 ** 8:
+            # 翻倍会冲过头, 按比例缩回到接近 target
+            iterations = max(10000, int(iterations * target / elapsed)) if elapsed > target else iterations
+            return {'PASSWORD_PBKDF2_ITERATIONS': iterations}, elapsed * iterations / hasher.pbkdf2_iterations
+        iterations *= 2
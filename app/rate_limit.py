@@ -0,0 +1,198 @@
+import math
+import threading
+import time
+from functools import wraps
+from flask import request
+from werkzeug.exceptions import TooManyRequests
+
+"""
+登录、找回密码的限流
+
+以前 login() 和 reset_password_request() 来多少请求处理多少, 撞库时每次尝试都要查一次 user 表、算一次密码哈希。
+现在视图函数上加 @rate_limiter.limit(名字, '10/minute', key=...), 按 IP 或者表单里的用户名计数,
+超过限额直接抛 RateLimited (429, 带 Retry-After), 在视图函数之前返回, 不查数据库也不算哈希。
+
+计数用滑动窗口: 每个 key 只存当前和上一个固定窗口的次数, 估计值 = 上一个窗口 * 还没滑出去的比例 + 当前窗口,
+不会像固定窗口那样在窗口交界处放进两倍的请求。被拒绝的请求不计数, 等一会儿就能再试。
+先 INCR 当前窗口占一个名额, 再用 INCR 返回的值判断, 超了再 DECR 还回去; 并发的请求各自拿到不同的值,
+不会都读到同一个旧计数然后一起放进来。
+    memory  每个进程自己计数, 默认
+    shared  多个进程共用的计数器 (比如 Redis 的 INCR + EXPIRE), 这里用 SharedMemoryBackend 在本地代替
+RATE_LIMITS 可以按名字改限额, 比如 {'login-username': '20/minute'}。
+"""
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimited(TooManyRequests):
+    def __init__(self, limit, retry_after):
+        super(RateLimited, self).__init__()
+        self.limit = limit  # 触发的是哪个限额
+        self.retry_after = retry_after
+
+
+def parse_limit(limit):
+    """'10/minute' -> (10, 60)"""
+    count, _, period = limit.partition('/')
+    try:
+        return int(count), PERIODS[period.strip().rstrip('s')]
+    except (ValueError, KeyError):
+        raise ValueError('Bad rate limit {!r}, expected something like "10/minute"'.format(limit))
+
+
+def by_ip():
+    return request.remote_addr
+
+
+def by_form(field):
+    """按表单字段计数, 不区分大小写; 字段为空时不计数"""
+    def key():
+        value = request.form.get(field, '').strip().lower()
+        return value or None
+    return key
+
+
+class MemoryBackend(object):
+    """key -> (过期时间, 次数), 每 sweep_interval 秒清掉过期的"""
+
+    def __init__(self, sweep_interval=60):
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._swept_at = time.time()
+
+    def get(self, keys):
+        now = time.time()
+        with self._lock:
+            return [self._count(key, now) for key in keys]
+
+    def _count(self, key, now):
+        item = self._counters.get(key)
+        return item[1] if item is not None and item[0] > now else 0
+
+    def incr(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            count = self._count(key, now) + 1
+            self._counters[key] = (now + ttl, count)
+            if now - self._swept_at > self.sweep_interval:
+                self._counters = {k: v for k, v in self._counters.items() if v[0] > now}
+                self._swept_at = now
+        return count
+
+    def decr(self, key):
+        with self._lock:
+            item = self._counters.get(key)
+            if item is not None and item[1] > 0:
+                self._counters[key] = (item[0], item[1] - 1)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+
+class SharedMemoryBackend(object):
+    """共享计数器的本地替身: 接口和 Redis 的 MGET / INCR + EXPIRE / DECR 一样, 所有实例共用同一个字典"""
+    _store = {}
+    _lock = threading.Lock()
+
+    def __init__(self, prefix='ratelimit:'):
+        self.prefix = prefix
+
+    def get(self, keys):
+        now = time.time()
+        with self._lock:
+            items = [self._store.get(self.prefix + key) for key in keys]
+        return [item[1] if item is not None and item[0] > now else 0 for item in items]
+
+    def incr(self, key, ttl):
+        now = time.time()
+        with self._lock:
+            item = self._store.get(self.prefix + key)
+            count = (item[1] if item is not None and item[0] > now else 0) + 1
+            self._store[self.prefix + key] = (now + ttl, count)
+        return count
+
+    def decr(self, key):
+        with self._lock:
+            item = self._store.get(self.prefix + key)
+            if item is not None and item[1] > 0:
+                self._store[self.prefix + key] = (item[0], item[1] - 1)
+
+    def clear(self):
+        with self._lock:
+            for key in [k for k in self._store if k.startswith(self.prefix)]:
+                del self._store[key]
+
+
+class RateLimiter(object):
+    def __init__(self, app=None):
+        self.enabled = True
+        self.backend = MemoryBackend()
+        self.overrides = {}
+        self._lock = threading.Lock()
+        self.allowed = {}
+        self.rejected = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        if app.config.get('RATE_LIMIT_BACKEND') == 'shared':
+            self.backend = SharedMemoryBackend()
+        else:
+            self.backend = MemoryBackend()
+        self.overrides = dict(app.config.get('RATE_LIMITS') or {})
+        for limit in self.overrides.values():
+            parse_limit(limit)  # 配置写错了启动时就报错
+        app.extensions['rate_limiter'] = self
+
+    def hit(self, name, key, limit, now=None):
+        """记一次请求; 超过限额时不计数, 返回需要等待的秒数, 没超过返回 None"""
+        count, period = parse_limit(self.overrides.get(name, limit))
+        now = time.time() if now is None else now
+        window = int(now // period)
+        elapsed = now - window * period
+        base = '{}:{}:'.format(name, key)
+        previous = self.backend.get([base + str(window - 1)])[0]
+        current = self.backend.incr(base + str(window), 2 * period)  # 下一个窗口还要用它当 previous
+        weight = 1 - elapsed / period  # 上一个窗口还有多少比例在滑动窗口里
+        if previous * weight + current > count:
+            self.backend.decr(base + str(window))  # 被拒绝的不计数
+            self._count(self.rejected, name)
+            current -= 1  # 不算这一次
+            if current >= count or not previous:
+                return max(1, int(math.ceil(period - elapsed)))
+            # 等上一个窗口再滑出去一些, 让估计值加上这一次不超过限额
+            return max(1, int(math.ceil(period * (1 - (count - current - 1) / previous) - elapsed)))
+        self._count(self.allowed, name)
+        return None
+
+    def _count(self, counter, name):
+        with self._lock:
+            counter[name] = counter.get(name, 0) + 1
+
+    def limit(self, name, limit, key=by_ip, methods=('POST',)):
+        """视图函数装饰器, 放在 @app.route 下面; key() 返回 None 的请求不计数"""
+        parse_limit(limit)
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if self.enabled and request.method in methods:
+                    value = key()
+                    if value is not None:
+                        retry_after = self.hit(name, value, limit)
+                        if retry_after is not None:
+                            raise RateLimited(name, retry_after)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._lock:
+            return {name: {'allowed': self.allowed.get(name, 0), 'rejected': self.rejected.get(name, 0)}
+                    for name in set(self.allowed) | set(self.rejected)}
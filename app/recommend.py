@@ -0,0 +1,145 @@
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from app import db
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # 可选依赖, 没装就用纯 Python 算, 结果一样, 只是慢得多
+    np = sparse = None
+
+"""
+"可能想关注的人"
+
+以前除了 /username 的用户列表和 /explore 没有别的办法发现新的人, 而在请求里按 followers 表现算
+"朋友的朋友" 要对每个关注的人再查一遍他关注了谁, 关注多的用户一个页面就要扫几万行。
+现在由 flask recommend build 离线算好 (可以放进 cron), 存进 follow_suggestion 表:
+    分数    我关注的人里有几个关注了他 (二度关系的路径数), 去掉自己和已经关注的人, 每个用户留前 RECOMMEND_TOP_K 个
+    算法    装了 NumPy/SciPy 时把关注关系读成稀疏邻接矩阵 A (行关注列), 分数就是 A @ A,
+            按 RECOMMEND_SHARD_SIZE 个用户一片, 每片一次稀疏矩阵乘法加一次 lexsort 取前 K 个,
+            RECOMMEND_WORKERS > 0 时各片在进程池里并行算; 没装就用字典和集合一个一个用户算
+    读取    首页和个人主页的侧栏按主键 (user_id, rank) 读前 RECOMMEND_SHOW 个, 一次索引查找;
+            算完之后又关注了的人不显示
+重算时在一个事务里整表替换, 页面要么看到旧的要么看到新的。
+"""
+
+_matrix = None  # 进程池里每个进程各有一份 A, 由 _init_worker 设置
+
+
+def _init_worker(matrix):
+    global _matrix
+    _matrix = matrix
+
+
+def score_shard(start, stop, k, matrix=None):
+    """第 start 到 stop 行 (用户下标) 的前 k 个推荐, 返回 (行, 名次, 列, 分数) 四个数组"""
+    a = _matrix if matrix is None else matrix
+    rows = a[start:stop]
+    scores = (rows @ a).tocsr()
+    # 去掉自己和已经关注的: 和 (A 的这几行 + 单位阵的这几行) 重叠的位置清零
+    m, n = rows.shape
+    own = sparse.csr_matrix((np.ones(m, dtype=scores.dtype), (np.arange(m), np.arange(start, stop))), shape=(m, n))
+    scores = scores - scores.multiply((rows + own) > 0)
+    scores = scores.tocoo()
+    keep = scores.data > 0
+    row, col, data = scores.row[keep], scores.col[keep], scores.data[keep]
+    # 每行按分数从高到低、同分按用户 id 从小到大排, 取前 k 个
+    order = np.lexsort((col, -data, row))
+    row, col, data = row[order], col[order], data[order]
+    first = np.searchsorted(row, row)  # 每个元素所在行的第一个位置
+    rank = np.arange(len(row)) - first
+    top = rank < k
+    return row[top] + start, rank[top], col[top], data[top]
+
+
+class Recommender(object):
+    def __init__(self, app=None):
+        self.top_k = 10
+        self.show = 5
+        self.shard_size = 5000
+        self.workers = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.top_k = app.config.get('RECOMMEND_TOP_K', 10)
+        self.show = app.config.get('RECOMMEND_SHOW', 5)
+        self.shard_size = app.config.get('RECOMMEND_SHARD_SIZE', 5000)
+        self.workers = app.config.get('RECOMMEND_WORKERS', 0)
+        app.extensions['recommender'] = self
+
+    @staticmethod
+    def _edges():
+        from app.models import followers
+        return db.session.execute(db.select([followers.c.follower_id, followers.c.followed_id])).fetchall()
+
+    def compute(self, workers=None, vectorized=None):
+        """返回 [(user_id, 名次, suggested_id, 分数)]; vectorized 为 None 时有 NumPy/SciPy 就用"""
+        if vectorized is None:
+            vectorized = np is not None
+        if vectorized and np is None:
+            raise RuntimeError('Vectorized recommendations need numpy and scipy')
+        edges = self._edges()
+        if not edges:
+            return []
+        if not vectorized:
+            return self._compute_python(edges)
+        return self._compute_vectorized(edges, self.workers if workers is None else workers)
+
+    def _compute_python(self, edges):
+        following = defaultdict(set)
+        for follower_id, followed_id in edges:
+            following[follower_id].add(followed_id)
+        results = []
+        for user_id in sorted(following):
+            mine = following[user_id]
+            scores = defaultdict(int)
+            for followed_id in mine:
+                for candidate in following.get(followed_id, ()):
+                    if candidate != user_id and candidate not in mine:
+                        scores[candidate] += 1
+            top = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:self.top_k]
+            results.extend((user_id, rank, candidate, score) for rank, (candidate, score) in enumerate(top))
+        return results
+
+    def _compute_vectorized(self, edges, workers):
+        pairs = np.array(edges, dtype=np.int64)
+        ids = np.unique(pairs)  # 下标 -> 用户 id
+        rows, cols = np.searchsorted(ids, pairs[:, 0]), np.searchsorted(ids, pairs[:, 1])
+        n = len(ids)
+        matrix = sparse.csr_matrix((np.ones(len(pairs), dtype=np.int32), (rows, cols)), shape=(n, n))
+        shards = [(start, min(start + self.shard_size, n)) for start in range(0, n, self.shard_size)]
+        if workers > 0 and len(shards) > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(matrix,)) as pool:
+                starts, stops = zip(*shards)
+                parts = list(pool.map(score_shard, starts, stops, [self.top_k] * len(shards)))
+        else:
+            parts = [score_shard(start, stop, self.top_k, matrix) for start, stop in shards]
+        results = []
+        for row, rank, col, data in parts:
+            results.extend(zip(ids[row].tolist(), rank.tolist(), ids[col].tolist(), data.tolist()))
+        return results
+
+    def build(self, workers=None, vectorized=None):
+        """重算所有用户的推荐, 整表替换; 返回 (有推荐的用户数, 推荐条数, 秒)"""
+        from app.models import FollowSuggestion
+        start = time.perf_counter()
+        results = self.compute(workers, vectorized)
+        table = FollowSuggestion.__table__
+        db.session.execute(table.delete())
+        for i in range(0, len(results), 10000):
+            db.session.execute(table.insert(), [
+                {'user_id': user_id, 'rank': rank, 'suggested_id': suggested_id, 'score': score}
+                for user_id, rank, suggested_id, score in results[i:i + 10000]])
+        db.session.commit()
+        return len({row[0] for row in results}), len(results), time.perf_counter() - start
+
+    def suggestions(self, user, limit=None):
+        """侧栏用: [(User, 分数)], 按名次排"""
+        from app.models import User, FollowSuggestion, followers
+        s = FollowSuggestion
+        followed = db.select([followers.c.followed_id]).where(followers.c.follower_id == user.id)
+        return db.session.query(User, s.score).join(s, s.suggested_id == User.id) \
+            .filter(s.user_id == user.id, ~User.id.in_(followed)) \
+            .order_by(s.rank).limit(limit or self.show).all()
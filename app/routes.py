@@ -1,20 +1,24 @@
-from datetime import datetime
-from flask import render_template, flash, redirect, url_for, request
-from flask_login import login_user, logout_user, current_user, login_required
-from werkzeug.urls import url_parse
-from app import app, db
-from app.forms import LoginForm, RegistrationForm, EditProfileForm, PostForm, ResetPasswordRequestForm, \
-    ResetPasswordForm
+import csv
+import io
+from flask import Blueprint, render_template, flash, redirect, url_for, request, abort, send_from_directory, \
+    Markup, Response, stream_with_context, current_app
+from sqlalchemy.exc import IntegrityError
+from flask_login import current_user, login_required
+from app import db, timeline, last_seen, user_cache, avatars, fragment_cache, mail_queue, metrics, search_index, \
+    name_registry, passwords, rate_limiter, broker, recommender, trending
+from app.avatars import DIGEST_RE, MAX_SIZE
+from app.db_tuning import read_replica
+from app.forms import EditProfileForm, PostForm
 from app.models import User, Post
-from app.email import send_password_reset_email
-from app.forms import ResetPasswordRequestForm
+from app.pagination import KeysetPage, cursor_args, keyset_paginate
 
+bp = Blueprint('main', __name__)  # 登录、注册、找回密码在 app/auth.py 的 auth 蓝图里
 
-@app.before_request
-def before_request():  # 每次请求前执行 设置时间
+
+@bp.before_app_request
+def before_request():  # 每次请求前执行 记录访问时间 只记在内存里, 由 last_seen 批量写回数据库
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user)
 
 
 # 判断用户是否登陆 如果没有跳到登陆界面
@@ -25,106 +29,66 @@ def before_request():  # 每次请求前执行 设置时间
 # 浏览器现在被指示发送GET请求来获取重定向中指定的页面，所以现在最后一个请求不再是'POST'请求了，
 # 刷新命令就能以更可预测的方式工作。这个简单的技巧叫做Post/Redirect/Get模式。
 # 它避免了用户在提交网页表单后无意中刷新页面时插入重复的动态
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
+@bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
         post = Post(body=form.post.data, author=current_user)
+        current_user.post_count = User.post_count + 1
         db.session.add(post)
+        db.session.flush()  # 先拿到 post.id
+        timeline.push(post)  # 推送到粉丝的时间线, 和动态在同一个事务里提交
+        search_index.add(post)  # 全文索引也在同一个事务里
+        trending.record(current_user.id, 'post')  # 作者的活跃度 见 app/trending.py
         db.session.commit()
+        user_cache.invalidate(current_user)  # 缓存里的 post_count 旧了
+        fragment_cache.post_created()
+        broker.publish_post(post)  # 通知在线的粉丝 见 app/stream.py
         flash('Your post is now live!')
-        return redirect(url_for('index'))  # 提交post后 重定向
-    page = request.args.get('page', 1, type=int)
-    print(page, "===========================")
-    posts = current_user.followed_posts().paginate(page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('index', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title='Home', form=form,
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
-
-
-""" 
-Flask-SQLAlchemy的paginate()方法原生就支持分页。
-例如，我想要获取用户关注的前20个动态，我可以将all()结束调用替换成如下的查询：
->>> user.followed_posts().paginate(1, 20, False).items
-
-has_next: 当前页之后存在后续页面时为真
-has_prev: 当前页之前存在前置页面时为真
-next_num: 下一页的页码
-prev_num: 上一页的页码
-"""
-
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():  # 回调函数 生成了current_user 并提取cook
-    if current_user.is_authenticated:  # 一个用来表示用户是否通过登录认证的属性，用True和False表示。
-        return redirect(url_for('index'))  # 如果用户登陆回调到index
-    form = LoginForm()  # 一个表单
-    if form.validate_on_submit():  # 如果表单提交
-        user = User.query.filter_by(username=form.username.data).first()  # 返回一个User实例
-        if user is None or not user.check_password(form.password.data):  # 检验user 将user的密码摘要与数据库中的对比
-            flash('Invalid username or password')
-            return redirect(url_for('login'))  # 回调
-        login_user(user, remember=form.remember_me.data)  # 登陆 设置cook
-        """“记住我”功能的实现很棘手。尽管如此，Flask-Login 几乎透明地实现了这
-        ——只需要向 login_user 调用传递 remember=True 。
-        一个 cookie 就会存储在用户的电脑上， 
-        且之后如果会话中没有用户 ID，Flask-Login 会自动从那个 cookie 上恢复用户 ID。
-         这个 cookie 是防篡改的，所以如果用户篡改了它（插入其它用户的 ID 来替代自己 的），
-         这个 cookie 只不过会被拒绝，就如同没有一样。"""
-        # Flask提供一个request变量，其中包含客户端随请求发送的所有信息。 特别是request.args属性
-        next_page = request.args.get('next')  # 如果用户是从其他界面重定向来login的 它会有一个next 参数 这可以取出原界面的url
-        if not next_page or url_parse(next_page).netloc != '':
-            next_page = url_for('index')  # 如果不是去index
-        return redirect(next_page)  # 回调 此时已有cook可直接登陆
-    return render_template('login.html', title='Sign In', form=form)
+        return redirect(url_for('main.index'))  # 提交post后 重定向
+    before, after, page = cursor_args()
+    per_page = current_app.config['POSTS_PER_PAGE']
+    # 首页从时间线读取, 不再每次 JOIN followers
+    items, has_more = timeline.read(current_user, per_page, before=before, after=after,
+                                    offset=(page - 1) * per_page)
+    if after is not None:
+        posts = KeysetPage(items, has_older=True, has_newer=has_more)
+    else:
+        posts = KeysetPage(items, has_older=has_more, has_newer=before is not None or page > 1)
+    posts_html = Markup(render_template('_posts.html', posts=posts.items, next_url=posts.next_url('main.index'),
+                                        prev_url=posts.prev_url('main.index')))
+    return render_template('index.html', title='Home', form=form, posts_html=posts_html,
+                           suggestions=recommender.suggestions(current_user))  # 侧栏 见 app/recommend.py
 
 
 """
-如果登录URL中不含next参数，那么将会重定向到本应用的主页。
-如果登录URL中包含next参数，其值是一个相对路径（换句话说，该URL不含域名信息），那么将会重定向到本应用的这个相对路径。
-如果登录URL中包含next参数，其值是一个包含域名的完整URL，那么重定向到本应用的主页
+翻页用的是 app/pagination.py 里的游标分页, 不再用 Flask-SQLAlchemy 的 paginate():
+paginate() 每一页都要 OFFSET 跳过前面的行, 还要额外 COUNT(*) 一次。
+游标分页记住上一页最后一条动态的 (timestamp, id), 下一页直接从索引的这个位置往后读。
+    next_url: 更早的动态 ?before=<游标>
+    prev_url: 更新的动态 ?after=<游标>
 """
 
 
-@app.route('/logout')  # 登出 清空cook
-def logout():
-    logout_user()  # 好像是把服务器上对应的用户的cook删除
-    return redirect(url_for('index'))  # 重定向到index
-
-
-@app.route('/register', methods=['GET', 'POST'])  # 注册用户
-def register():
-    if current_user.is_authenticated:  # current_user是User的一个实例 看用户是否登陆
-        return redirect(url_for('index'))  # 回调
-    form = RegistrationForm()  # 接收注册表单
-    if form.validate_on_submit():
-        user = User(username=form.username.data, email=form.email.data)  # 接收username and email
-        user.set_password(form.password.data)  # 生成摘要 摘要算法不可逆
-        db.session.add(user)  # 提交到数据库
-        """
-        session(会话)可以看成一个管理数据库持久连接的对象
-        session.add函数会把Model加入持久空间
-        """
-        db.session.commit()  # 提交完毕
-        flash('Congratulations, you are now a registered user!')
-        return redirect(url_for('login'))
-    return render_template('register.html', title='Register', form=form)
-
-
-@app.route('/edit_profile', methods=['GET', 'POST'])  # 修改
+@bp.route('/edit_profile', methods=['GET', 'POST'])  # 修改
 @login_required
 def edit_profile():
     form = EditProfileForm(current_user.username)  # 只有登陆了才可以修改资料
     if form.validate_on_submit():  # current_user.username这里表示正在登陆的用户名
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:  # 用户名刚被别人占了
+            db.session.rollback()
+            form.username.errors.append('Please use a different username.')
+            return render_template('edit_profile.html', title='Edit Profile', form=form)
+        user_cache.invalidate(current_user)
+        fragment_cache.profile_changed()  # 缓存的动态列表里可能有旧的用户名
         flash('Your changes have been saved.')
-        return redirect(url_for('edit_profile'))  # 当为POST请求时
+        return redirect(url_for('main.edit_profile'))  # 当为POST请求时
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -132,98 +96,230 @@ def edit_profile():
                            form=form)
 
 
-@app.route('/unfollow/<username>')
+@bp.route('/unfollow/<username>')
 @login_required
 def unfollow(username):  # 取注
     user = User.query.filter_by(username=username).first()
     if user is None:  # 如果用户不存在
         flash('User {} not found.'.format(username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user == current_user:  # 不可取关自己
         flash('You cannot unfollow yourself!')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.unfollow(user)  # 取关
     db.session.commit()
+    user_cache.invalidate(current_user)
+    user_cache.invalidate(user)
+    broker.follow(current_user, user, following=False)
     flash('You are not following {}.'.format(username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
 
 
-@app.route('/follow/<username>')
+@bp.route('/follow/<username>')
 @login_required
 def follow(username):  # 关注
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('User {} not found.'.format(username))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user == current_user:
         flash('You cannot follow yourself!')
-        return redirect(url_for('user', username=username))
+        return redirect(url_for('main.user', username=username))
     current_user.follow(user)
     db.session.commit()
+    user_cache.invalidate(current_user)
+    user_cache.invalidate(user)
+    broker.follow(current_user, user)
     flash('You are following {}!'.format(username))
-    return redirect(url_for('user', username=username))
+    return redirect(url_for('main.user', username=username))
 
 
+@bp.route('/stream/feed')
 @login_required
-@app.route('/username', methods=['POST', "GET"])
-def username():
-    user_list = User.query.all()  # 返回一个列表 列表重是User的实例
-    return render_template("user_list.html", user_list=user_list)
+def stream_feed():  # 首页的 EventSource 连到这里, 关注的人发动态时推送 见 app/stream.py
+    subscription = broker.subscribe(current_user)
+    if subscription is None:
+        return Response('Too many connections\n', status=503, mimetype='text/plain', headers={'Retry-After': '30'})
+    response = Response(broker.events(subscription), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})  # 别让 nginx 攒着
+    response.call_on_close(lambda: broker.unsubscribe(subscription))  # 响应体还没开始读客户端就走了也要登记
+    return response
 
 
-@app.route('/explore')
+@bp.route('/username')
+@login_required
+def username():  # 用户目录: 按用户名排序, 游标翻页, 可以按前缀搜索; ?format=csv 流式导出
+    prefix = request.args.get('q', '').strip()
+    query = db.session.query(User.username)
+    if prefix:
+        query = query.filter(*username_prefix(prefix))
+    if request.args.get('format') == 'csv':
+        return Response(stream_with_context(export_users(query)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=users.csv'})
+    after = request.args.get('after')
+    if after:
+        query = query.filter(User.username > after)
+    per_page = current_app.config['USERS_PER_PAGE']
+    usernames = [row.username for row in query.order_by(User.username).limit(per_page + 1)]
+    next_url = None
+    if len(usernames) > per_page:
+        usernames = usernames[:per_page]
+        next_url = url_for('main.username', q=prefix or None, after=usernames[-1])
+    return render_template('user_list.html', title='Users', usernames=usernames, q=prefix, next_url=next_url)
+
+
+def username_prefix(prefix):
+    """username 以 prefix 开头, 写成范围条件走 username 上的索引 (LIKE 在 SQLite 里不区分大小写, 用不上索引)"""
+    return User.username >= prefix, User.username < prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def export_users(query):
+    """一行一行地生成 CSV, yield_per 分批从数据库取, 内存占用和用户数无关"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['username', 'last_seen', 'followers', 'following', 'posts'])
+    query = query.add_columns(User.last_seen, User.follower_count, User.followed_count, User.post_count)
+    for i, row in enumerate(query.order_by(User.username).yield_per(1000)):
+        writer.writerow([row.username, row.last_seen.isoformat() if row.last_seen else '',
+                         row.follower_count, row.followed_count, row.post_count])
+        if i % 100 == 99:  # 攒 100 行发一次, 不用每行一个 chunk
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@bp.route('/explore')
 @login_required  # 返回规定个数的post
+@read_replica  # 只读页面, 查询走只读副本
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template("index.html", title='Explore', posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    before, after, page = cursor_args()
+    sort = 'trending' if request.args.get('sort') == 'trending' else 'recent'
+    rank = request.args.get('rank', 0, type=int)
+    per_page = current_app.config['POSTS_PER_PAGE']
+
+    def render_posts():  # 缓存没命中时才查数据库、渲染
+        if sort == 'trending':  # 排好的名次表, 按 rank 翻页 见 app/trending.py
+            posts, next_rank = trending.page(rank, per_page)
+            next_url = url_for('main.explore', sort='trending', rank=next_rank) if next_rank else None
+            return render_template('_posts.html', posts=posts, next_url=next_url, next_label='More posts')
+        # 作者用 joinedload 一次 JOIN 出来, 避免 _post.html 里每条动态都查一次 post.author (N+1)
+        posts = keyset_paginate(Post.query.options(db.joinedload(Post.author)), per_page, before, after, page)
+        return render_template('_posts.html', posts=posts.items, next_url=posts.next_url('main.explore'),
+                               prev_url=posts.prev_url('main.explore'))
+
+    # 同一个游标的页面所有人看到的都一样, 整块缓存; 排行在压缩之后最多晚 PAGE_CACHE_TTL 秒显示
+    # 键只由决定内容的参数组成, 随便加的查询参数不会挤出新的缓存项
+    if sort == 'trending':
+        key = 'explore:trending:{}'.format(rank)
+    else:
+        key = 'explore:recent:{}:{}:{}'.format(before, after, page)
+    posts_html = fragment_cache.page(key, render_posts, stable=sort == 'recent' and before is not None)
+    return render_template("index.html", title='Explore', posts_html=posts_html, sort=sort)
+
+
+@bp.route('/search')
+@login_required
+@read_replica
+def search():  # 全文搜索动态, 按相关度或时间排序, 游标翻页
+    q = request.args.get('q', '').strip()
+    sort = 'recent' if request.args.get('sort') == 'recent' else 'relevance'
+    results = search_index.search(q, current_app.config['POSTS_PER_PAGE'], sort, request.args.get('cursor'))
+    next_url = url_for('main.search', q=q, sort=sort, cursor=results.next_cursor) if results.next_cursor else None
+    return render_template('search.html', title='Search', q=q, sort=sort, posts=results.items,
+                           next_url=next_url)
 
 
-@app.route('/user/<username>')
+@bp.route('/user/<username>')
 @login_required
+@read_replica
 def user(username):  # 你登陆后 由此路由进入其他用户的主页
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    # paginate()的返回是Pagination类的实例
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(page, app.config['POSTS_PER_PAGE'], False)
-    # 判断下一页是否存在 如果存在 给一个链接
-    next_url = url_for('user', username=user.username, page=posts.next_num) if posts.has_next else None
-    # 判断上一页是否存在 如果存在 给一个链接
-    prev_url = url_for('user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    last_seen.refresh(user)  # 显示缓冲里最新的访问时间
+    before, after, page = cursor_args()
+    # keyset_paginate()的返回是KeysetPage类的实例
+    # 这里的动态作者都是 user, 已经在 session 的 identity map 里, post.author 直接取不会再查询
+    posts = keyset_paginate(user.posts, current_app.config['POSTS_PER_PAGE'], before, after, page)
+    # 下一页/上一页存在时才给链接
+    next_url = posts.next_url('main.user', username=user.username)
+    prev_url = posts.prev_url('main.user', username=user.username)
     return render_template('user.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
-
-
-@app.route('/reset_password_request', methods=['GET', 'POST'])
-def reset_password_request():
-    if current_user.is_authenticated:
-        return redirect(url_for('index'))
-    form = ResetPasswordRequestForm()
-    if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if user:
-            send_password_reset_email(user)
-        flash('Check your email for the instructions to reset your password')
-        return redirect(url_for('login'))
-    return render_template('reset_password_request.html',
-                           title='Reset Password', form=form)
-
-
-@app.route('/reset_password/<token>', methods=['GET', 'POST'])
-def reset_password(token):
-    if current_user.is_authenticated:
-        return redirect(url_for('index'))
-    user = User.verify_reset_password_token(token)
-    if not user:
-        return redirect(url_for('index'))
-    form = ResetPasswordForm()
-    if form.validate_on_submit():
-        user.set_password(form.password.data)
-        db.session.commit()
-        flash('Your password has been reset.')
-        return redirect(url_for('login'))
-    return render_template('reset_password.html', form=form)
+                           next_url=next_url, prev_url=prev_url, suggestions=recommender.suggestions(current_user))
+
+
+@bp.route('/avatar/<digest>/<int:size>')
+def avatar(digest, size):  # 本地生成的 identicon 头像, 浏览器可以缓存一年
+    if not DIGEST_RE.match(digest) or not 0 < size <= MAX_SIZE:
+        abort(404)
+    return send_from_directory(avatars.cache_dir, avatars.path(digest, size),
+                               mimetype='image/svg+xml',
+                               cache_timeout=current_app.config['AVATAR_CACHE_TIMEOUT'])
+
+
+@bp.route('/metrics')
+def metrics_view():  # Prometheus 抓取的统计, 只给管理员或者带 METRICS_TOKEN 的请求看
+    token = current_app.config['METRICS_TOKEN']
+    if not (token and request.headers.get('Authorization') == 'Bearer ' + token):
+        if not current_user.is_authenticated or current_user.email not in current_app.config['ADMINS']:
+            abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics.collector
+def cache_metrics():
+    stats = user_cache.stats()
+    yield ('microblog_user_cache_lookups_total', 'counter', 'load_user cache lookups by result.',
+           [((('result', 'hit'),), stats['hits']), ((('result', 'shared_hit'),), stats['shared_hits']),
+            ((('result', 'miss'),), stats['misses'])])
+    yield ('microblog_user_cache_invalidations_total', 'counter', 'load_user cache invalidations.',
+           [((), stats['invalidations'])])
+    names = name_registry.stats()
+    yield ('microblog_name_checks_total', 'counter', 'Username/email checks by how they were answered.',
+           [((('answered_by', 'bloom'),), names['bloom_negatives']), ((('answered_by', 'cache'),), names['cache_hits']),
+            ((('answered_by', 'database'),), names['queries'])])
+    kinds = sorted(fragment_cache.stats().items())
+    yield ('microblog_fragment_cache_hits_total', 'counter', 'Rendered fragment cache hits.',
+           [((('kind', kind),), s['hits']) for kind, s in kinds])
+    yield ('microblog_fragment_cache_misses_total', 'counter', 'Rendered fragment cache misses.',
+           [((('kind', kind),), s['misses']) for kind, s in kinds])
+    yield ('microblog_fragment_cache_render_seconds_total', 'counter', 'Time spent rendering on cache misses.',
+           [((('kind', kind),), s['render_seconds']) for kind, s in kinds])
+
+
+@metrics.collector
+def outbox_metrics():
+    yield ('microblog_outbox_messages', 'gauge', 'Outbox messages by status.',
+           [((('status', status),), count) for status, count in sorted(mail_queue.stats().items())])
+
+
+@metrics.collector
+def password_metrics():
+    stats = passwords.stats()
+    yield ('microblog_password_hashes_total', 'counter', 'Password hash computations by operation.',
+           [((('operation', 'hash'),), stats['hashed']), ((('operation', 'verify'),), stats['verified'])])
+    yield ('microblog_password_hash_seconds_total', 'counter', 'Time spent hashing passwords, queueing included.',
+           [((), stats['seconds'])])
+    yield ('microblog_password_rehashes_total', 'counter', 'Stored hashes upgraded on login.',
+           [((), stats['rehashed'])])
+    yield ('microblog_password_busy_total', 'counter', 'Hash requests rejected because the pool was full.',
+           [((), stats['busy'])])
+
+
+@metrics.collector
+def rate_limit_metrics():
+    stats = sorted(rate_limiter.stats().items())
+    yield ('microblog_rate_limit_allowed_total', 'counter', 'Requests counted by a rate limit and let through.',
+           [((('limit', name),), s['allowed']) for name, s in stats])
+    yield ('microblog_rate_limit_rejected_total', 'counter', 'Requests rejected by a rate limit.',
+           [((('limit', name),), s['rejected']) for name, s in stats])
+
+
+@metrics.collector
+def stream_metrics():
+    stats = broker.stats()
+    yield ('microblog_stream_connections', 'gauge', 'Open /stream/feed connections in this process.',
+           [((), stats['connections'])])
+    yield ('microblog_stream_rejected_total', 'counter', 'Connections refused because the process was full.',
+           [((), stats['rejected'])])
+    yield ('microblog_stream_events_total', 'counter', 'Post events by outcome.',
+           [((('result', 'delivered'),), stats['delivered']), ((('result', 'dropped'),), stats['dropped'])])
\ No newline at end of file
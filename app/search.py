@@ -0,0 +1,205 @@
+import base64
+import binascii
+import math
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import DDL, event, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql import column, table
+from app import db
+
+"""
+动态全文搜索
+
+以前想找一条动态只能在 /explore 里一页一页往后翻。现在 Post.body 建了倒排索引, /search?q=... 直接查:
+    fts5    SQLite 的 FTS5 虚拟表 post_fts (外部内容表, 只存索引, 正文还在 post 表里), SQLite 上默认用它
+    memory  进程内的倒排索引, 只给开发和测试用: 每个进程各建各的, flask search reindex 只填满 CLI 自己的进程,
+            web 进程启动时是空的, 只能搜到之后发的动态
+    none    不建索引, /search 返回空; 别的数据库上默认用它, 配了 fts5 也退回到它 (post_fts 表只有 SQLite 上有,
+            发动态时往里写会让整个事务失败)
+后端都实现 add(post) / reindex() / search(terms, limit, sort, after) / clear(), 换成别的搜索引擎只要照着写一个。
+
+发动态时 index() 在同一个事务里调用 search_index.add(post); flask search reindex 全量重建。
+结果按相关度 (bm25) 或者时间排序, 用 (分数, id) 做游标分页, 不用 OFFSET。
+FTS5 的 ORDER BY rank 走索引里的统计信息, 一百万条动态里查询也只要几毫秒。
+"""
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+post_fts = table('post_fts', column('rowid'), column('rank'))
+
+
+def tokenize(body):
+    return [token.lower() for token in TOKEN_RE.findall(body or '')]
+
+
+def encode_cursor(score, id):
+    raw = '{!r}|{}'.format(float(score), id).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):  # 游标不合法时返回 None, 当作第一页处理
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        score, id = raw.rsplit('|', 1)
+        return float(score), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class FTS5Backend(object):
+    """分数就是 FTS5 的 rank (bm25, 越小越相关); 按时间排序时分数是 -id"""
+    _listening = set()  # 已经挂上 DDL 的分词器, create_app() 每次都会新建后端, 同样的 DDL 只挂一次
+
+    def __init__(self, tokenizer='unicode61'):
+        self.tokenizer = tokenizer
+        if tokenizer not in FTS5Backend._listening:
+            FTS5Backend._listening.add(tokenizer)
+            # 跟着 db.create_all() / db.drop_all() 建表、删表, 线上的库由迁移 1e8c4b7d6f30 建
+            event.listen(db.metadata, 'after_create', DDL(self.create_sql()).execute_if(dialect='sqlite'))
+            event.listen(db.metadata, 'before_drop',
+                         DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite'))
+
+    def create_sql(self):
+        return ("CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+                "body, content='post', content_rowid='id', tokenize='{}')".format(self.tokenizer))
+
+    def add(self, post):
+        db.session.execute(text('INSERT INTO post_fts (rowid, body) VALUES (:id, :body)'),
+                           {'id': post.id, 'body': post.body})
+
+    def reindex(self):
+        db.session.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+        return db.session.execute(text('SELECT count(*) FROM post')).scalar()
+
+    @staticmethod
+    def match_expression(terms):  # 每个词都加引号, 用户输入里的 AND/OR/NEAR/* 不会被当成语法
+        return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+    def search(self, terms, limit, sort='relevance', after=None):
+        # 用 select() 而不是 text(), 这样 @read_replica 的页面里还是读语句, 会走副本
+        match = text('post_fts MATCH :match').bindparams(match=self.match_expression(terms))
+        rowid, rank = post_fts.c.rowid, post_fts.c.rank
+        if sort == 'recent':
+            query = db.select([-rowid, rowid]).where(match).order_by(rowid.desc())
+            if after is not None:
+                query = query.where(rowid < after[1])
+        else:
+            query = db.select([rank, rowid]).where(match).order_by(rank, rowid)
+            if after is not None:
+                query = query.where(db.or_(rank > after[0], db.and_(rank == after[0], rowid > after[1])))
+        return [tuple(row) for row in db.session.execute(query.limit(limit))]
+
+    def clear(self):
+        db.session.execute(text("INSERT INTO post_fts (post_fts) VALUES ('delete-all')"))
+
+
+class MemoryBackend(object):
+    """词 -> {post_id: 出现次数}; 分数是负的 tf-idf 之和, 和 bm25 一样越小越相关"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)
+        self._documents = set()
+
+    def add(self, post):
+        with self._lock:
+            self._documents.add(post.id)
+            for token in tokenize(post.body):
+                postings = self._postings[token]
+                postings[post.id] = postings.get(post.id, 0) + 1
+
+    def reindex(self):
+        from app.models import Post
+        self.clear()
+        count = 0
+        for post in db.session.query(Post.id, Post.body).yield_per(1000):
+            self.add(post)
+            count += 1
+        return count
+
+    def search(self, terms, limit, sort='relevance', after=None):
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not postings or not all(postings):
+                return []
+            total = len(self._documents)
+            ids = set.intersection(*(set(p) for p in postings))
+            scores = {}
+            for id in ids:
+                scores[id] = -sum(p[id] * math.log(1 + total / len(p)) for p in postings)
+        if sort == 'recent':
+            results = sorted(((-id, id) for id in ids))
+        else:
+            results = sorted((score, id) for id, score in scores.items())
+        if after is not None:
+            results = [r for r in results if r > tuple(after)]
+        return results[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+
+
+class NullBackend(object):
+    def add(self, post):
+        pass
+
+    def reindex(self):
+        return 0
+
+    def search(self, terms, limit, sort='relevance', after=None):
+        return []
+
+    def clear(self):
+        pass
+
+
+class SearchResults(object):
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+
+class SearchIndex(object):
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        sqlite = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() == 'sqlite'
+        name = app.config.get('SEARCH_BACKEND') or ('fts5' if sqlite else 'none')
+        if name == 'fts5' and not sqlite:
+            app.logger.warning('SEARCH_BACKEND fts5 needs SQLite, full-text search is disabled')
+            name = 'none'
+        self.backend = NullBackend()
+        if name == 'fts5':
+            self.backend = FTS5Backend(app.config.get('SEARCH_TOKENIZER', 'unicode61'))
+        elif name == 'memory':
+            self.backend = MemoryBackend()
+        app.extensions['search_index'] = self
+
+    def add(self, post):
+        """在发动态的事务里调用, post 要已经 flush 拿到 id"""
+        self.backend.add(post)
+
+    def reindex(self):
+        return self.backend.reindex()
+
+    def search(self, query, per_page, sort='relevance', cursor=None):
+        """返回 SearchResults, items 是带作者的 Post, next_cursor 是下一页的游标 (没有下一页时为 None)"""
+        from app.models import Post
+        terms = tokenize(query)
+        if not terms:
+            return SearchResults([], None)
+        hits = self.backend.search(terms, per_page + 1, sort, decode_cursor(cursor))
+        page = hits[:per_page]
+        posts = {post.id: post for post in Post.query.options(db.joinedload(Post.author))
+                 .filter(Post.id.in_([id for _, id in page]))} if page else {}
+        items = [posts[id] for _, id in page if id in posts]
+        next_cursor = encode_cursor(*page[-1]) if len(hits) > per_page else None
+        return SearchResults(items, next_cursor)
@@ -0,0 +1,231 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from app import db
+
+"""
+首页实时更新 (Server-Sent Events)
+
+以前想看有没有新动态只能刷新 /index, 大部分刷新都是白查一遍时间线、白渲染一次页面。
+现在首页用 EventSource 连着 /stream/feed, 关注的人发了动态服务器就推一条 post 事件, 页面上提示有几条新动态,
+点一下再刷新。
+
+index() 提交新动态之后调用 broker.publish_post(post), follow/unfollow 之后调用 broker.follow(...)。
+每个连接是一个 Subscription, 连接时查一次关注的人, 之后按作者 id 分发, 不再碰数据库。
+后端:
+    local   只在当前进程里分发, 单进程部署用, 默认
+    shared  发到所有进程 (比如 Redis 的 PUBLISH/SUBSCRIBE), 这里用 SharedMemoryBackend 在本地代替,
+            每个进程起一个线程收消息再在本进程里分发
+连接上的保护:
+    心跳        每 STREAM_HEARTBEAT 秒发一行注释, 免得代理把空闲连接断掉, 也能发现客户端已经走了
+    背压        每个连接最多积压 STREAM_QUEUE_SIZE 条, 满了 (客户端读得太慢) 就发一个 reset 事件让页面提示刷新, 然后断开
+    连接数      每个进程最多 STREAM_MAX_CONNECTIONS 个连接, 超过返回 503, 浏览器过一会儿会自己重连
+    连接时长    连了 STREAM_MAX_AGE 秒主动断开, 浏览器按 retry 重连, 顺便拿到新的关注列表
+每个连接占一个线程, 要用多线程 (或者 gevent) 的 worker 跑。
+"""
+
+
+class Subscription(object):
+    def __init__(self, user_id, authors, size):
+        self.user_id = user_id
+        self.authors = set(authors)
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+            return False
+        return True
+
+
+class LocalBackend(object):
+    """发布就是直接在本进程里分发"""
+
+    def __init__(self):
+        self._deliver = None
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, message):
+        if self._deliver is not None:
+            self._deliver(message)
+
+    def stop(self):
+        self._deliver = None
+
+
+class SharedMemoryBackend(object):
+    """跨进程发布订阅的本地替身: 和 Redis 一样只传字符串, 所有实例共用一个消息日志, 每个实例一个收消息的线程"""
+    _log = deque(maxlen=1000)  # (序号, 消息)
+    _seq = 0
+    _changed = threading.Condition()
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._thread = None
+        self._stopped = False
+
+    def start(self, deliver):
+        with self._changed:
+            since = SharedMemoryBackend._seq  # 只收订阅之后发的
+        self._thread = threading.Thread(target=self._listen, args=(deliver, since), name='stream-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, message):
+        with self._changed:
+            SharedMemoryBackend._seq += 1
+            self._log.append((SharedMemoryBackend._seq, json.dumps(message)))
+            self._changed.notify_all()
+
+    def _listen(self, deliver, since):
+        while not self._stopped:
+            with self._changed:
+                self._changed.wait_for(lambda: SharedMemoryBackend._seq > since or self._stopped,
+                                       self.poll_interval)
+                messages = [(seq, raw) for seq, raw in self._log if seq > since]
+            for seq, raw in messages:
+                since = seq
+                deliver(json.loads(raw))
+
+    def stop(self):
+        self._stopped = True
+        with self._changed:
+            self._changed.notify_all()
+
+
+class Broker(object):
+    def __init__(self, app=None):
+        self.backend = None
+        self.heartbeat = 15
+        self.queue_size = 100
+        self.max_connections = 100
+        self.max_age = 300
+        self.retry = 5000
+        self._lock = threading.Lock()
+        self._by_author = {}  # 作者 id -> 订阅了他的 Subscription
+        self._by_user = {}  # 用户 id -> 这个用户的 Subscription (一个用户可以开好几个页面)
+        self.connections = 0
+        self.rejected = 0
+        self.delivered = 0
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.heartbeat = app.config.get('STREAM_HEARTBEAT', 15)
+        self.queue_size = app.config.get('STREAM_QUEUE_SIZE', 100)
+        self.max_connections = app.config.get('STREAM_MAX_CONNECTIONS', 100)
+        self.max_age = app.config.get('STREAM_MAX_AGE', 300)
+        self.retry = app.config.get('STREAM_RETRY', 5000)
+        if self.backend is not None:  # 再次 init_app 时停掉旧后端的收消息线程
+            self.backend.stop()
+        if app.config.get('STREAM_BACKEND') == 'shared':
+            self.backend = SharedMemoryBackend()
+        else:
+            self.backend = LocalBackend()
+        self.backend.start(self._deliver)
+        app.extensions['broker'] = self
+
+    # 发布 -----------------------------------------------------------------
+
+    def publish_post(self, post):
+        """在动态提交之后调用"""
+        self.backend.publish({'type': 'post', 'author_id': post.author.id, 'post': {
+            'id': post.id, 'author': post.author.username, 'timestamp': post.timestamp.isoformat() + 'Z'}})
+
+    def follow(self, user, author, following=True):
+        """关注、取关提交之后调用, 更新所有进程里 user 的连接"""
+        self.backend.publish({'type': 'follow', 'user_id': user.id, 'author_id': author.id,
+                              'following': following})
+
+    def _deliver(self, message):
+        with self._lock:
+            if message['type'] == 'follow':
+                author_id = message['author_id']
+                for subscription in self._by_user.get(message['user_id'], ()):
+                    if message['following']:
+                        subscription.authors.add(author_id)
+                        self._by_author.setdefault(author_id, set()).add(subscription)
+                    else:
+                        subscription.authors.discard(author_id)
+                        self._remove(self._by_author, author_id, subscription)
+                return
+            subscriptions = list(self._by_author.get(message['author_id'], ()))
+        event = ('post', message['post'])
+        delivered = sum(1 for subscription in subscriptions if subscription.put(event))
+        with self._lock:
+            self.delivered += delivered
+            self.dropped += len(subscriptions) - delivered
+
+    # 订阅 -----------------------------------------------------------------
+
+    def subscribe(self, user):
+        """查出 user 关注的人, 登记一个连接; 连接数满了返回 None"""
+        from app.models import followers
+        with self._lock:
+            if self.connections >= self.max_connections:
+                self.rejected += 1
+                return None
+            self.connections += 1
+        try:
+            authors = [row[0] for row in db.session.execute(
+                db.select([followers.c.followed_id]).where(followers.c.follower_id == user.id))]
+        except Exception:
+            with self._lock:
+                self.connections -= 1
+            raise
+        subscription = Subscription(user.id, authors, self.queue_size)
+        with self._lock:
+            self._by_user.setdefault(user.id, set()).add(subscription)
+            for author_id in subscription.authors:
+                self._by_author.setdefault(author_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """连接结束时调用, 调用多次也没关系"""
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self._remove(self._by_user, subscription.user_id, subscription)
+            for author_id in subscription.authors:
+                self._remove(self._by_author, author_id, subscription)
+            self.connections -= 1
+
+    @staticmethod
+    def _remove(index, key, subscription):
+        subscriptions = index.get(key)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del index[key]
+
+    def events(self, subscription):
+        """SSE 响应体; 不碰数据库, 也不需要应用上下文"""
+        started = time.monotonic()
+        try:
+            yield 'retry: {}\n\n'.format(self.retry)
+            while time.monotonic() - started < self.max_age:
+                try:
+                    kind, data = subscription.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(data['id'], kind, json.dumps(data))
+                if subscription.overflowed and subscription.queue.empty():  # 积压的发完了, 丢掉的让页面刷新补回来
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        return {'connections': self.connections, 'rejected': self.rejected, 'delivered': self.delivered,
+                'dropped': self.dropped}
@@ -0,0 +1,273 @@
+import bisect
+import threading
+import time
+from app import db
+from app.pagination import older_than, newer_than, load_posts
+
+"""
+首页时间线 (fan-out-on-write)
+
+以前每次打开 /index 都要跑一遍 followed_posts() 里的 Post JOIN followers 再排序,
+关注的人越多、动态越多就越慢。现在在发动态的时候就把 post_id 推送(fan-out)到每个粉丝的时间线里,
+读首页时只需要按 user_id 做一次范围扫描。
+
+时间线里的每一条记录是 (timestamp, post_id, author_id), 按 (timestamp, post_id) 倒序读取。
+粉丝特别多的作者 (粉丝数 >= TIMELINE_FANOUT_LIMIT) 不再推送, 而是在读的时候再拉取 (混合模式),
+否则一条动态就要写几万行。
+
+后端可以替换:
+    database  时间线存在 timeline_entry 表里, 和业务数据在同一个事务中; 迁移 3d2f6a1c9b80 给已有的用户建好,
+              之后只由写入维护, 读首页不会写数据库
+    memory    进程内的有序列表, 接口模仿 Redis 的 sorted set, 可作为 Redis 的本地替身;
+              进程里还没有的时间线在第一次读时从 post 和 followers 表重建
+两种后端每个用户都只保留最新的 TIMELINE_MAX_LENGTH 条。
+"""
+
+
+class DatabaseTimelineBackend(object):
+    """时间线存在 timeline_entry 表里, 推送用 INSERT ... SELECT 一条语句完成"""
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    @property
+    def table(self):
+        from app.models import timeline_entries
+        return timeline_entries
+
+    def exists(self, user_id):  # 一直随写入维护, 没有记录就是空的时间线, 不用按需重建
+        return True
+
+    def add_from(self, rows):  # rows 是一个 select, 列依次为 user_id, post_id, author_id, timestamp
+        t = self.table
+        db.session.execute(t.insert().from_select(
+            ['user_id', 'post_id', 'author_id', 'timestamp'], rows))
+        self._trim(rows)
+
+    def _trim(self, rows):
+        """rows 涉及的用户, 时间线超过 max_length 的把更旧的删掉; 和插入在同一个事务里"""
+        t = self.table
+        users = db.select([list(rows.alias().c)[0].label('user_id')]).distinct().alias()
+
+        def nth(column):  # 第 max_length + 1 新的那条, 没有就是 NULL
+            return db.select([column]).where(t.c.user_id == users.c.user_id) \
+                .order_by(t.c.timestamp.desc(), t.c.post_id.desc()) \
+                .limit(1).offset(self.max_length).as_scalar()
+        cutoffs = [{'uid': user_id, 'ts': timestamp, 'pid': post_id} for user_id, timestamp, post_id in
+                   db.session.execute(db.select([users.c.user_id, nth(t.c.timestamp), nth(t.c.post_id)]))
+                   if post_id is not None]
+        if cutoffs:  # 一条 executemany, 每个超长的用户删掉 (timestamp, post_id) <= 截断点的
+            db.session.execute(t.delete().where(t.c.user_id == db.bindparam('uid')).where(
+                db.not_(newer_than(t.c.timestamp, t.c.post_id, (db.bindparam('ts'), db.bindparam('pid'))))),
+                cutoffs)
+
+    def remove_author(self, user_id, author_id):
+        t = self.table
+        db.session.execute(t.delete().where(
+            db.and_(t.c.user_id == user_id, t.c.author_id == author_id)))
+
+    def clear(self, user_id):
+        t = self.table
+        db.session.execute(t.delete().where(t.c.user_id == user_id))
+
+    def range(self, user_id, before=None, after=None, limit=25):
+        t = self.table
+        query = db.select([t.c.timestamp, t.c.post_id]).where(t.c.user_id == user_id)
+        if after is not None:  # 往新的方向翻: 正序取离游标最近的 limit 条
+            query = query.where(newer_than(t.c.timestamp, t.c.post_id, after)) \
+                .order_by(t.c.timestamp.asc(), t.c.post_id.asc()).limit(limit)
+            return [(r.timestamp, r.post_id) for r in db.session.execute(query)][::-1]
+        if before is not None:
+            query = query.where(older_than(t.c.timestamp, t.c.post_id, before))
+        query = query.order_by(t.c.timestamp.desc(), t.c.post_id.desc()).limit(limit)
+        return [(r.timestamp, r.post_id) for r in db.session.execute(query)]
+
+
+class MemoryTimelineBackend(object):
+    """进程内时间线: user_id -> 按 (timestamp, post_id) 升序排列的列表
+
+    只在当前进程有效, 重启后由 TimelineStore 按需重建。
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self._lock = threading.Lock()
+        self._lines = {}
+
+    def exists(self, user_id):
+        return user_id in self._lines
+
+    def add_from(self, rows):
+        rows = db.session.execute(rows).fetchall()
+        with self._lock:
+            for user_id, post_id, author_id, timestamp in rows:
+                line = self._lines.get(user_id)
+                if line is None:  # 这个进程里还没建过 (比如刚重启), 留给下次读时整个重建, 免得只有这一条
+                    continue
+                entry = (timestamp, post_id, author_id)
+                i = bisect.bisect_left(line, entry)
+                if i < len(line) and line[i][:2] == entry[:2]:
+                    continue
+                line.insert(i, entry)
+                if len(line) > self.max_length:
+                    del line[:len(line) - self.max_length]
+
+    def remove_author(self, user_id, author_id):
+        with self._lock:
+            line = self._lines.get(user_id)
+            if line is not None:
+                line[:] = [e for e in line if e[2] != author_id]
+
+    def clear(self, user_id):
+        with self._lock:
+            self._lines[user_id] = []
+
+    def range(self, user_id, before=None, after=None, limit=25):
+        with self._lock:
+            line = self._lines.get(user_id, [])
+            if after is not None:  # post_id 是整数, (timestamp, id + 1) 之后的都比游标新
+                start = bisect.bisect_left(line, (after[0], after[1] + 1))
+                end = min(start + limit, len(line))
+            else:
+                end = len(line) if before is None else bisect.bisect_left(line, tuple(before))
+                start = max(end - limit, 0)
+            return [(e[0], e[1]) for e in reversed(line[start:end])]
+
+
+class TimelineStore(object):
+    backends = {
+        'database': DatabaseTimelineBackend,
+        'memory': MemoryTimelineBackend,
+    }
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.fanout_limit = None
+        self.celebrity_ttl = 300
+        self._celebrities = frozenset()
+        self._celebrities_loaded = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        max_length = app.config.get('TIMELINE_MAX_LENGTH', 800)
+        self.backend = self.backends[app.config.get('TIMELINE_BACKEND', 'database')](max_length)
+        self.fanout_limit = app.config.get('TIMELINE_FANOUT_LIMIT')
+        self.celebrity_ttl = app.config.get('TIMELINE_CELEBRITY_TTL', 300)
+        app.extensions['timeline'] = self
+
+    # 写入 -----------------------------------------------------------------
+
+    def is_celebrity(self, user):  # 粉丝太多的作者不推送
+        return self.fanout_limit is not None and user.follower_count >= self.fanout_limit
+
+    def push(self, post):
+        """发动态时调用: 推送到作者自己和所有粉丝的时间线"""
+        from app.models import followers
+        author_id = post.author.id
+        columns = [db.literal(post.id), db.literal(author_id), db.literal(post.timestamp)]
+        rows = db.select([db.literal(author_id)] + columns)
+        if not self.is_celebrity(post.author):
+            rows = db.union(rows, db.select([followers.c.follower_id] + columns)
+                            .where(followers.c.followed_id == author_id))
+        else:
+            self._celebrities = self._celebrities | {author_id}
+        self.backend.add_from(rows)
+
+    def follow(self, user, followed):
+        """关注后把对方最近的动态补进自己的时间线 (大V在读时拉取, 不用补)"""
+        from app.models import Post
+        if self.is_celebrity(followed):
+            return
+        self.backend.add_from(
+            db.select([db.literal(user.id), Post.id, Post.user_id, Post.timestamp])
+            .where(Post.user_id == followed.id)
+            .order_by(Post.timestamp.desc())
+            .limit(self.backend.max_length))
+
+    def unfollow(self, user, followed):
+        self.backend.remove_author(user.id, followed.id)
+
+    def rebuild(self, user):
+        """根据 followers 和 post 表重建某个用户的时间线"""
+        self._rebuild(user.id)
+
+    def rebuild_all(self):
+        from app.models import User
+        user_ids = [r[0] for r in db.session.query(User.id).order_by(User.id)]
+        for user_id in user_ids:
+            self._rebuild(user_id)
+        return len(user_ids)
+
+    def _rebuild(self, user_id):
+        from app.models import Post, followers
+        authors = db.select([followers.c.followed_id]).where(followers.c.follower_id == user_id)
+        self.backend.clear(user_id)
+        self.backend.add_from(
+            db.select([db.literal(user_id), Post.id, Post.user_id, Post.timestamp])
+            .where(db.or_(Post.user_id.in_(authors), Post.user_id == user_id))
+            .order_by(Post.timestamp.desc())
+            .limit(self.backend.max_length))
+
+    # 读取 -----------------------------------------------------------------
+
+    def celebrities(self):
+        """粉丝数超过阈值的作者 id, 每 celebrity_ttl 秒刷新一次"""
+        from app.models import User
+        if self.fanout_limit is None:
+            return frozenset()
+        now = time.time()
+        if now - self._celebrities_loaded > self.celebrity_ttl:
+            rows = db.session.query(User.id).filter(User.follower_count >= self.fanout_limit)
+            self._celebrities = frozenset(r[0] for r in rows)
+            self._celebrities_loaded = now
+        return self._celebrities
+
+    def _pull(self, user, before, after, limit):  # 混合模式: 关注的大V的动态在读时拉取
+        from app.models import Post, followers
+        celebrities = self.celebrities()
+        if not celebrities:
+            return []
+        authors = [r[0] for r in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == user.id,
+            followers.c.followed_id.in_(celebrities))]
+        if not authors:
+            return []
+        query = db.session.query(Post.timestamp, Post.id).filter(Post.user_id.in_(authors))
+        if after is not None:
+            query = query.filter(newer_than(Post.timestamp, Post.id, after)) \
+                .order_by(Post.timestamp.asc(), Post.id.asc())
+        else:
+            if before is not None:
+                query = query.filter(older_than(Post.timestamp, Post.id, before))
+            query = query.order_by(Post.timestamp.desc(), Post.id.desc())
+        return [(r.timestamp, r.id) for r in query.limit(limit)]
+
+    def keys(self, user, limit, before=None, after=None, offset=0):
+        """只取首页这一页的 (timestamp, post_id), 不加载 Post; 返回 (keys, has_more)
+
+        before / after 是游标对应的 (timestamp, post_id), 按键做范围扫描,
+        has_more 表示沿着翻页方向还有没有更多;
+        offset 只是给旧的 ?page=N 链接用的。
+        """
+        wanted = offset + limit + 1
+        keys = self.backend.range(user.id, before, after, wanted)
+        if not keys and not self.backend.exists(user.id):  # 内存后端: 这个进程里还没建过, 只读数据库
+            self.rebuild(user)
+            keys = self.backend.range(user.id, before, after, wanted)
+        pulled = self._pull(user, before, after, wanted)
+        if pulled:
+            keys = sorted(set(keys) | set(pulled), reverse=True)
+        if after is not None:  # 只要离游标最近的那几条
+            has_more = len(keys) > limit
+            keys = keys[-limit:]
+        else:
+            keys = keys[offset:wanted]
+            has_more = len(keys) > limit
+            keys = keys[:limit]
+        return keys, has_more
+
+    def read(self, user, limit, before=None, after=None, offset=0):
+        """读取首页: 返回 (posts, has_more), posts 按时间倒序, 参数同 keys()"""
+        keys, has_more = self.keys(user, limit, before, after, offset)
+        return load_posts([post_id for _, post_id in keys]), has_more
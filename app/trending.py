@@ -0,0 +1,153 @@
+import math
+import sqlite3
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from app import db
+
+"""
+/explore?sort=trending 的排行
+
+以前 /explore 只能按时间倒序看所有动态, 想按热度排就得在请求里按作者聚合 post 和 followers 表。
+现在每个作者有一个随时间衰减的活跃度, 在写入时增量更新:
+    发一条动态      TRENDING_POST_WEIGHT
+    被关注一次      TRENDING_FOLLOW_WEIGHT
+    半衰期          TRENDING_HALF_LIFE 秒, 过了一个半衰期的事件只算一半
+存的是前向衰减 (forward decay) 的对数: 时刻 t 的事件记为 (t - EPOCH) / tau + ln(权重), 同一个作者的多次事件用
+logaddexp 累加。所有作者的分数都按同一个 EPOCH 放大, 比较大小不用先衰减, 也就不用定时改写每一行;
+取对数之后一直是线性增长的小数, 不会溢出。当前的实际值是 exp(分数 - (now - EPOCH) / tau)。
+logaddexp 在 SQLite 上是注册到每个连接的 Python 函数, 在 PostgreSQL 上由迁移 9f3a6c2e5d18 建成 SQL 函数,
+所以加分就是一条 INSERT ... ON CONFLICT DO UPDATE SET score = logaddexp(score, :分数) (SQLite 3.24+ 和
+PostgreSQL 写法一样), 作者第一次有分数时两个请求同时插入也不会撞主键; 和动态、关注在同一个事务里提交。
+同一对 (粉丝, 作者) 在 TRENDING_WINDOW 秒里只有第一次关注加分, 记在 trending_follow 表里,
+反复关注、取关刷不上去。
+
+flask trending compact (放进 cron, 每几分钟一次) 做两件事:
+    删掉衰减到 TRENDING_MIN_SCORE 以下的作者
+    取分数最高的作者最近 TRENDING_WINDOW 秒的动态, 每人最多 TRENDING_POSTS_PER_AUTHOR 条 (同一个作者的第二条
+    分数减半, 第三条再减半, 免得一页都是一个人), 排好名次整表写进 trending_entry
+页面按主键 rank 翻页 (?sort=trending&rank=上一页最后的名次), 一条查询, 和按时间的游标翻页一样便宜。
+排行在两次压缩之间不变; 取关不扣分。
+"""
+
+EPOCH = datetime(2020, 1, 1)
+
+
+def logaddexp(a, b):
+    """ln(exp(a) + exp(b)), 不会溢出"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+def _register_functions(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('logaddexp', 2, logaddexp)
+
+
+class Trending(object):
+    def __init__(self, app=None):
+        self.tau = 6 * 3600 / math.log(2)
+        self.weights = {'post': 1.0, 'follow': 3.0}
+        self.min_score = 0.01
+        self.window = timedelta(hours=48)
+        self.max_posts = 500
+        self.posts_per_author = 3
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.tau = app.config.get('TRENDING_HALF_LIFE', 6 * 3600) / math.log(2)
+        self.weights = {'post': app.config.get('TRENDING_POST_WEIGHT', 1.0),
+                        'follow': app.config.get('TRENDING_FOLLOW_WEIGHT', 3.0)}
+        self.min_score = app.config.get('TRENDING_MIN_SCORE', 0.01)
+        self.window = timedelta(seconds=app.config.get('TRENDING_WINDOW', 48 * 3600))
+        self.max_posts = app.config.get('TRENDING_MAX_POSTS', 500)
+        self.posts_per_author = app.config.get('TRENDING_POSTS_PER_AUTHOR', 3)
+        if not event.contains(Engine, 'connect', _register_functions):  # 每个新连接都注册 logaddexp
+            event.listen(Engine, 'connect', _register_functions)
+        app.extensions['trending'] = self
+
+    def scale(self, when):
+        """时刻 when 的事件在对数分数里的基数"""
+        return (when - EPOCH).total_seconds() / self.tau
+
+    def current(self, score, now=None):
+        """对数分数在 now 时的实际值"""
+        return math.exp(score - self.scale(now or datetime.utcnow()))
+
+    # 写入 -----------------------------------------------------------------
+
+    def record(self, user_id, kind, when=None):
+        """给作者记一次 kind ('post' / 'follow') 事件, 在调用方的事务里, 由调用方提交"""
+        value = self.scale(when or datetime.utcnow()) + math.log(self.weights[kind])
+        db.session.execute(text(
+            'INSERT INTO trending_score (user_id, score) VALUES (:user_id, :score) '
+            'ON CONFLICT (user_id) DO UPDATE SET score = logaddexp(trending_score.score, excluded.score)'),
+            {'user_id': user_id, 'score': value})
+
+    def record_follow(self, follower_id, followed_id, when=None):
+        """关注时调用: 这一对在 window 之内第一次关注才给 followed_id 加分"""
+        when = when or datetime.utcnow()
+        first = db.session.execute(text(
+            'INSERT INTO trending_follow (follower_id, followed_id, timestamp) '
+            'VALUES (:follower_id, :followed_id, :timestamp) '
+            'ON CONFLICT (follower_id, followed_id) DO UPDATE SET timestamp = excluded.timestamp '
+            'WHERE trending_follow.timestamp < :cutoff')
+            .bindparams(db.bindparam('timestamp', type_=db.DateTime), db.bindparam('cutoff', type_=db.DateTime)),
+            {'follower_id': follower_id, 'followed_id': followed_id, 'timestamp': when,
+             'cutoff': when - self.window}).rowcount
+        if first:
+            self.record(followed_id, 'follow', when)
+
+    # 压缩 -----------------------------------------------------------------
+
+    def compact(self, now=None):
+        """删掉衰减完的作者, 重排 trending_entry; 返回 (删掉的作者数, 排行里的动态数)"""
+        from app.models import Post, TrendingScore, TrendingEntry, TrendingFollow
+        now = now or datetime.utcnow()
+        scores = TrendingScore.__table__
+        pruned = db.session.execute(scores.delete().where(
+            scores.c.score < self.scale(now) + math.log(self.min_score))).rowcount
+        follows = TrendingFollow.__table__
+        db.session.execute(follows.delete().where(follows.c.timestamp < now - self.window))
+        authors = dict(db.session.execute(
+            db.select([scores.c.user_id, scores.c.score]).order_by(scores.c.score.desc()).limit(self.max_posts)).fetchall())
+        ranked = []
+        if authors:
+            rows = db.session.execute(
+                db.select([Post.id, Post.user_id, Post.timestamp])
+                .where(Post.user_id.in_(list(authors))).where(Post.timestamp >= now - self.window)
+                .order_by(Post.user_id, Post.timestamp.desc(), Post.id.desc()))
+            taken = {}
+            for post_id, author_id, timestamp in rows:
+                n = taken.get(author_id, 0)
+                if n < self.posts_per_author:
+                    taken[author_id] = n + 1
+                    # 同一个作者每多一条分数减半
+                    ranked.append((authors[author_id] - n * math.log(2), timestamp, post_id))
+        ranked.sort(reverse=True)
+        entries = TrendingEntry.__table__
+        db.session.execute(entries.delete())
+        if ranked:
+            db.session.execute(entries.insert(), [{'rank': rank, 'post_id': post_id, 'score': score}
+                                                  for rank, (score, _, post_id) in
+                                                  enumerate(ranked[:self.max_posts], 1)])
+        db.session.commit()
+        return pruned, min(len(ranked), self.max_posts)
+
+    # 读取 -----------------------------------------------------------------
+
+    def page(self, after_rank, limit):
+        """名次在 after_rank 之后的 limit 条动态 (作者一起 JOIN 出来), 和下一页从哪个名次之后开始 (没有时为 None)"""
+        from app.models import Post, TrendingEntry
+        rows = db.session.query(Post, TrendingEntry.rank) \
+            .join(TrendingEntry, TrendingEntry.post_id == Post.id) \
+            .options(db.joinedload(Post.author)) \
+            .filter(TrendingEntry.rank > after_rank) \
+            .order_by(TrendingEntry.rank).limit(limit + 1).all()
+        next_rank = rows[limit - 1][1] if len(rows) > limit else None
+        return [post for post, _ in rows[:limit]], next_rank
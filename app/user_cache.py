@@ -0,0 +1,191 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from app import db
+
+"""
+Flask-Login 的 user_loader 缓存
+
+以前每个请求 load_user() 都要 User.query.get(id) 查一次数据库。
+现在把用户的列(不含 password_hash)缓存起来, 命中时直接构造一个 User 对象
+用 session.merge(load=False) 挂到当前 session 上, 不发任何 SELECT, 之后访问关系属性也照常工作。
+
+两级缓存:
+    local   每个进程自己的 LRU, 带 TTL
+    shared  多个进程共用的缓存 (比如 Redis), 这里用 SharedMemoryBackend 在本地代替
+USER_CACHE_BACKEND = 'shared' 时先查本进程的 LRU, 没有再查共享缓存, 都没有才查数据库。
+修改资料、重置密码、关注/取关之后要调用 invalidate()。
+invalidate() 只能删掉当前进程的 LRU, 所以共享缓存里还给每个用户记一个版本号 (Redis 的 INCR),
+invalidate() 时加一; 两级缓存的条目都带着缓存时的版本号, 本地命中时先读一次版本号, 对不上就当作没命中,
+别的进程里的旧用户名、旧计数不会再用到 TTL 过期。
+"""
+
+
+class LocalBackend(object):
+    """进程内 LRU, 每个条目过了 ttl 秒就失效"""
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedMemoryBackend(object):
+    """共享缓存的本地替身: 和 Redis 一样只存字节串, 所有实例共用同一个字典"""
+    _store = {}
+    _versions = {}  # 版本号不过期, clear() 也不清, 免得别的进程里旧版本的条目又对上
+    _lock = threading.Lock()
+
+    def __init__(self, ttl=300, prefix='user:'):
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        with self._lock:
+            item = self._store.get(self.prefix + str(key))
+        if item is None or item[0] < time.time():
+            return None
+        return pickle.loads(item[1])
+
+    def set(self, key, value):
+        with self._lock:
+            self._store[self.prefix + str(key)] = (time.time() + self.ttl, pickle.dumps(value))
+
+    def delete(self, key):
+        with self._lock:
+            self._store.pop(self.prefix + str(key), None)
+
+    def version(self, key):
+        with self._lock:
+            return self._versions.get(self.prefix + str(key), 0)
+
+    def bump(self, key):  # INCR
+        with self._lock:
+            key = self.prefix + str(key)
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+    def clear(self):
+        with self._lock:
+            for key in [k for k in self._store if k.startswith(self.prefix)]:
+                del self._store[key]
+
+
+class UserCache(object):
+    def __init__(self, app=None):
+        self.local = None
+        self.shared = None
+        self._lock = threading.Lock()  # 保护下面几个计数
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config.get('USER_CACHE_TTL', 300)
+        self.local = LocalBackend(app.config.get('USER_CACHE_SIZE', 10000), ttl)
+        if app.config.get('USER_CACHE_BACKEND') == 'shared':
+            self.shared = SharedMemoryBackend(ttl)
+        app.extensions['user_cache'] = self
+
+    @staticmethod
+    def _state(user):  # 要缓存的列, 密码摘要不放进缓存
+        return {c.key: getattr(user, c.key) for c in user.__table__.columns
+                if c.key != 'password_hash'}
+
+    def _attach(self, state):  # 用缓存的列构造 User, 挂到 session 上而不查询
+        from app.models import User
+        user = User()
+        for key, value in state.items():
+            setattr(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def load(self, user_id):
+        # 版本号要在查数据库之前读, 查的时候别的进程 invalidate() 了的话存进去的就是旧版本, 下次对不上
+        version = self.shared.version(user_id) if self.shared is not None else 0
+        item = self.local.get(user_id)
+        if item is not None and item[0] == version:
+            self._count('hits')
+            return self._attach(item[1])
+        if self.shared is not None:
+            item = self.shared.get(user_id)
+            if item is not None and item[0] == version:
+                self._count('shared_hits')
+                self.local.set(user_id, item)
+                return self._attach(item[1])
+        self._count('misses')
+        from app.models import User
+        user = User.query.get(user_id)
+        if user is not None:
+            self.set(user, version)
+        return user
+
+    def set(self, user, version=None):
+        if version is None:
+            version = self.shared.version(user.id) if self.shared is not None else 0
+        item = (version, self._state(user))
+        self.local.set(user.id, item)
+        if self.shared is not None:
+            self.shared.set(user.id, item)
+
+    def invalidate(self, user):
+        user_id = getattr(user, 'id', user)
+        self._count('invalidations')
+        self.local.delete(user_id)
+        if self.shared is not None:
+            self.shared.bump(user_id)  # 别的进程本地 LRU 里的条目版本对不上了
+            self.shared.delete(user_id)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        with self._lock:
+            hits, shared_hits, misses, invalidations = self.hits, self.shared_hits, self.misses, self.invalidations
+        lookups = hits + shared_hits + misses
+        return {
+            'hits': hits,
+            'shared_hits': shared_hits,
+            'misses': misses,
+            'invalidations': invalidations,
+            'hit_ratio': (hits + shared_hits) / lookups if lookups else 0.0,
+        }
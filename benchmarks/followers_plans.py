@@ -0,0 +1,143 @@
+"""
+对比 followers 表加主键和索引前后的查询计划和耗时 (迁移 5b7e0d9c4a16)
+
+直接用 sqlite3 造一份合成数据: N 个用户, 幂律分布的关注关系 (少数人有大量粉丝), 若干条动态,
+先用旧的表结构 (followers 没有主键和索引) 跑一遍, 再按迁移里的步骤去重、加主键和索引后再跑一遍,
+打印每条查询的 EXPLAIN QUERY PLAN 和平均耗时。
+
+    python benchmarks/followers_plans.py --users 100000
+"""
+import argparse
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+OLD_SCHEMA = '''
+CREATE TABLE user (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR(64), email VARCHAR(120),
+                   password_hash VARCHAR(128), about_me VARCHAR(140), last_seen DATETIME);
+CREATE UNIQUE INDEX ix_user_username ON user (username);
+CREATE UNIQUE INDEX ix_user_email ON user (email);
+CREATE TABLE post (id INTEGER NOT NULL PRIMARY KEY, body VARCHAR(140), timestamp DATETIME,
+                   user_id INTEGER REFERENCES user (id));
+CREATE INDEX ix_post_timestamp ON post (timestamp);
+CREATE INDEX ix_post_timestamp_id ON post (timestamp, id);
+CREATE TABLE followers (follower_id INTEGER REFERENCES user (id),
+                        followed_id INTEGER REFERENCES user (id));
+'''
+
+# 和迁移 5b7e0d9c4a16 的 upgrade() 做的事情一样
+MIGRATION = '''
+CREATE TABLE followers_new (follower_id INTEGER NOT NULL REFERENCES user (id),
+                            followed_id INTEGER NOT NULL REFERENCES user (id),
+                            PRIMARY KEY (follower_id, followed_id));
+INSERT INTO followers_new (follower_id, followed_id)
+    SELECT DISTINCT follower_id, followed_id FROM followers
+    WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL;
+DROP TABLE followers;
+ALTER TABLE followers_new RENAME TO followers;
+CREATE INDEX ix_followers_followed_follower ON followers (followed_id, follower_id);
+CREATE INDEX ix_post_user_id_timestamp ON post (user_id, timestamp);
+ANALYZE;
+'''
+
+# 和 models.py / routes.py 里 SQLAlchemy 生成的语句形状一致
+QUERIES = [
+    ('is_following',
+     'SELECT count(*) FROM user, followers WHERE user.id = followers.followed_id '
+     'AND followers.follower_id = :a AND followers.followed_id = :b'),
+    ('followers.count()',
+     'SELECT count(*) FROM user, followers WHERE user.id = followers.follower_id '
+     'AND followers.followed_id = :b'),
+    ('followed.count()',
+     'SELECT count(*) FROM user, followers WHERE user.id = followers.followed_id '
+     'AND followers.follower_id = :a'),
+    ('followed_posts()',
+     'SELECT * FROM (SELECT post.* FROM post JOIN followers ON followers.followed_id = post.user_id '
+     'WHERE followers.follower_id = :a UNION SELECT post.* FROM post WHERE post.user_id = :a) '
+     'ORDER BY timestamp DESC LIMIT 26'),
+    ('user posts page',
+     'SELECT * FROM post WHERE post.user_id = :b ORDER BY post.timestamp DESC, post.id DESC LIMIT 26'),
+]
+
+
+def seed(conn, users, follows_per_user, posts, duplicates):
+    rnd = random.Random(42)
+    conn.executemany('INSERT INTO user (id, username, email) VALUES (?, ?, ?)',
+                     ((i, 'user{}'.format(i), 'user{}@example.com'.format(i))
+                      for i in range(1, users + 1)))
+
+    def popular():  # 幂律: 编号越小越容易被关注
+        return int(users * rnd.random() ** 3) + 1
+
+    edges = set()
+    for follower in range(1, users + 1):
+        for _ in range(rnd.randint(0, 2 * follows_per_user)):
+            followed = popular()
+            if followed != follower:
+                edges.add((follower, followed))
+    edges = list(edges)
+    # 旧表没有约束, 模拟线上已经存在的重复关注
+    edges += rnd.sample(edges, min(duplicates, len(edges)))
+    conn.executemany('INSERT INTO followers (follower_id, followed_id) VALUES (?, ?)', edges)
+
+    start = datetime(2019, 1, 1)
+    conn.executemany('INSERT INTO post (body, timestamp, user_id) VALUES (?, ?, ?)',
+                     (('post {}'.format(i), str(start + timedelta(seconds=i)), popular())
+                      for i in range(posts)))
+    conn.commit()
+    return len(edges)
+
+
+def run(conn, label, samples):
+    print('\n=== {} ==='.format(label))
+    rnd = random.Random(7)
+    params = [{'a': rnd.randint(1, samples[0]), 'b': rnd.randint(1, 100)} for _ in range(samples[1])]
+    results = {}
+    for name, sql in QUERIES:
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, params[0]).fetchall()
+        t0 = time.perf_counter()
+        for p in params:
+            conn.execute(sql, p).fetchall()
+        elapsed = (time.perf_counter() - t0) / len(params) * 1000
+        results[name] = elapsed
+        print('\n{}  {:.3f} ms/query'.format(name, elapsed))
+        for row in plan:
+            print('    ' + row[-1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=10, help='average follows per user')
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--duplicates', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=50, help='queries timed per statement')
+    parser.add_argument('--db', default=':memory:')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.executescript(OLD_SCHEMA)
+    t0 = time.perf_counter()
+    edges = seed(conn, args.users, args.follows, args.posts, args.duplicates)
+    print('seeded {} users, {} follow rows, {} posts in {:.1f}s'.format(
+        args.users, edges, args.posts, time.perf_counter() - t0))
+
+    before = run(conn, 'before (no primary key, no indexes)', (args.users, args.samples))
+    t0 = time.perf_counter()
+    conn.executescript(MIGRATION)
+    rows = conn.execute('SELECT count(*) FROM followers').fetchone()[0]
+    print('\nmigration: {} follow rows after dedupe ({} duplicates removed) in {:.1f}s'.format(
+        rows, edges - rows, time.perf_counter() - t0))
+    after = run(conn, 'after (primary key + reverse index + post(user_id, timestamp))',
+                (args.users, args.samples))
+
+    print('\n{:<20} {:>12} {:>12} {:>10}'.format('query', 'before ms', 'after ms', 'speedup'))
+    for name, _ in QUERIES:
+        print('{:<20} {:>12.3f} {:>12.3f} {:>9.0f}x'.format(
+            name, before[name], after[name], before[name] / max(after[name], 1e-6)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+压测首页、发现页、个人主页和关注的延迟
+
+用 User / Post / followers 造一份合成数据: N 个用户, 幂律分布的关注关系 (少数人有大量粉丝), M 条动态,
+统计好计数器、建好时间线之后, 用 Flask 的 test client 以登录用户的身份反复请求
+/index、/explore、/user/<username>、/follow/<username>,
+报告每个页面的 p50/p95/p99 延迟、每个请求的 SQL 条数和吞吐量, 结果写成 JSON。
+
+    python benchmarks/load.py --users 2000 --posts 50000 --output results.json
+    python benchmarks/load.py --compare baseline.json --max-regression 0.25   # p95 变慢超过 25% 就返回 1, 给 CI 用
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from config import Config  # noqa: E402
+from app import create_app, db, timeline, search_index, passwords, rate_limiter  # noqa: E402
+from app.avatars import email_digest  # noqa: E402
+from app.models import User, Post, followers  # noqa: E402
+
+PASSWORD = 'benchmark'
+SCENARIOS = ('index', 'explore', 'user', 'follow')
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def seed(users, follows_per_user, posts, seed_value=42):
+    """造数据, 返回关注关系的条数"""
+    rnd = random.Random(seed_value)
+    password_hash = passwords.hash(PASSWORD)  # 算一次, 所有用户共用; 用当前配置, 登录时不会触发重新哈希
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+         'avatar_hash': email_digest('user{}@example.com'.format(i)), 'password_hash': password_hash}
+        for i in range(1, users + 1)])
+
+    def popular():  # 幂律: 编号越小越容易被关注
+        return int(users * rnd.random() ** 3) + 1
+
+    edges = set()
+    for follower in range(1, users + 1):
+        for _ in range(rnd.randint(0, 2 * follows_per_user)):
+            followed = popular()
+            if followed != follower:
+                edges.add((follower, followed))
+    db.session.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in edges])
+
+    start = datetime.utcnow() - timedelta(seconds=posts)
+    db.session.bulk_insert_mappings(Post, [
+        {'body': 'post {}'.format(i), 'timestamp': start + timedelta(seconds=i), 'user_id': popular()}
+        for i in range(posts)])
+    User.repair_counters()
+    db.session.commit()
+    timeline.rebuild_all()
+    search_index.reindex()
+    db.session.commit()
+    return len(edges)
+
+
+def percentile(sorted_values, p):
+    """最近秩法 (nearest-rank)"""
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(p / 100.0 * len(sorted_values)))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def login(app, username):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('Could not log in as {}'.format(username))
+    return client
+
+
+def drive(scenario, clients, users, requests, warmup, rnd):
+    """对一个页面发 warmup + requests 个请求, 返回统计结果"""
+    counter = QueryCounter()
+    latencies, queries, errors = [], [], 0
+
+    def target():  # 被访问的用户也按幂律选, 热门用户的主页访问得多
+        return 'user{}'.format(int(users * rnd.random() ** 3) + 1)
+
+    started = None
+    for i in range(warmup + requests):
+        if i == warmup:
+            started = time.perf_counter()
+        client = rnd.choice(clients)
+        if scenario == 'index':
+            path = '/index'
+        elif scenario == 'explore':
+            path = '/explore'
+        elif scenario == 'user':
+            path = '/user/' + target()
+        else:
+            path = '/follow/' + target()
+        event.listen(Engine, 'before_cursor_execute', counter)
+        counter.count = 0
+        t0 = time.perf_counter()
+        try:
+            response = client.get(path)
+        finally:
+            elapsed = time.perf_counter() - t0
+            event.remove(Engine, 'before_cursor_execute', counter)
+        if i < warmup:
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed * 1000)
+        queries.append(counter.count)
+    wall = time.perf_counter() - started if started is not None else 0.0
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+        'max_ms': latencies[-1] if latencies else 0.0,
+        'queries_per_request': sum(queries) / len(queries) if queries else 0.0,
+        'max_queries': max(queries) if queries else 0,
+        'throughput_rps': requests / wall if wall else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, max_regression):
+    """和之前的结果比较 p95, 返回变慢超过阈值的页面"""
+    regressions = []
+    print('\n{:<10} {:>14} {:>14} {:>9}'.format('page', 'baseline p95', 'current p95', 'change'))
+    for scenario, current in results['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(scenario)
+        if not old:
+            continue
+        change = current['p95_ms'] / max(old['p95_ms'], 1e-6) - 1
+        print('{:<10} {:>14.2f} {:>14.2f} {:>+8.0%}'.format(scenario, old['p95_ms'], current['p95_ms'], change))
+        if change > max_regression:
+            regressions.append(scenario)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=20, help='average follows per user')
+    parser.add_argument('--posts', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=20, help='logged-in users sending requests')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per page')
+    parser.add_argument('--warmup', type=int, default=20, help='untimed requests per page')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--db', default=None, help='SQLite file to use (default: a temporary file)')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None, help='previous JSON results to compare p95 against')
+    parser.add_argument('--max-regression', type=float, default=0.25)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.db is None:
+        tmpdir = tempfile.mkdtemp()
+        args.db = os.path.join(tmpdir, 'benchmark.db')
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.abspath(args.db)
+        WTF_CSRF_ENABLED = False
+        MAIL_WORKERS = 0
+
+    app = create_app(BenchmarkConfig)
+    rate_limiter.enabled = False  # 所有客户端都是 127.0.0.1
+    try:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            t0 = time.perf_counter()
+            edges = seed(args.users, args.follows, args.posts, args.seed)
+            print('seeded {} users, {} follows, {} posts in {:.1f}s'.format(
+                args.users, edges, args.posts, time.perf_counter() - t0))
+
+        rnd = random.Random(args.seed)
+        # 随机挑 --clients 个用户登录, 每个请求随机用其中一个
+        names = sorted({'user{}'.format(rnd.randint(1, args.users)) for _ in range(args.clients)})
+        clients = [login(app, name) for name in names]
+        results = {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'parameters': {k: getattr(args, k) for k in ('users', 'follows', 'posts', 'clients',
+                                                         'requests', 'warmup', 'seed')},
+            'scenarios': {},
+        }
+        print('\n{:<10} {:>8} {:>8} {:>8} {:>9} {:>8} {:>7}'.format(
+            'page', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'req/s', 'errors'))
+        for scenario in args.scenarios.split(','):
+            if scenario not in SCENARIOS:
+                parser.error('unknown scenario {}'.format(scenario))
+            stats = drive(scenario, clients, args.users, args.requests, args.warmup, rnd)
+            results['scenarios'][scenario] = stats
+            print('{:<10} {:>8.2f} {:>8.2f} {:>8.2f} {:>9.1f} {:>8.1f} {:>7}'.format(
+                scenario, stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+                stats['queries_per_request'], stats['throughput_rps'], stats['errors']))
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('\nresults written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print('p95 regressed more than {:.0%}: {}'.format(args.max_regression, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,6 +9,25 @@ class Config(object):
                               'sqlite:///' + os.path.join(basedir, 'app.db')  # 设置数据库路径
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # 数据库连接调优 见 app/db_tuning.py
+    SQLITE_POOL_SIZE = 5
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',  # 读和写互不阻塞
+        'synchronous': 'NORMAL',  # WAL 模式下足够安全, 少很多次 fsync
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,  # 负数表示 KiB, 约 64MB
+        'busy_timeout': 5000,  # 拿不到写锁时等 5 秒而不是马上报错
+        'temp_store': 'MEMORY',
+    }
+    DATABASE_POOL_SIZE = 10  # 以下只对 MySQL/PostgreSQL 这类服务器数据库生效
+    DATABASE_MAX_OVERFLOW = 20
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_TIMEOUT = 10
+    DATABASE_POOL_PRE_PING = True
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')  # 只读副本, 可以是另一个 SQLite 文件
+    SQLALCHEMY_BINDS = {'replica': DATABASE_REPLICA_URL} if DATABASE_REPLICA_URL else None
+    REPLICA_STICKY_SECONDS = 5  # 写过数据之后多少秒内都读主库
+
     '''
     Flask - SQLAlchemy插件从SQLALCHEMY_DATABASE_URI配置变量中获取应用的数据库的位置。 
     本处，我从DATABASE_URL环境变量中获取数据库URL，如果没有定义，
@@ -20,5 +39,109 @@ class Config(object):
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_WORKERS = 2  # 发信线程数, 0 表示不启动后台线程 (只用 flask mail send)
+    MAIL_BATCH_SIZE = 20  # 每个线程一次领多少封, 同一个 SMTP 连接发完
+    MAIL_MAX_ATTEMPTS = 5  # 临时性错误最多尝试几次
+    MAIL_RETRY_BACKOFF = 30  # 第 n 次失败后等 MAIL_RETRY_BACKOFF * 2**(n-1) 秒再试
+    MAIL_SEND_TIMEOUT = 300  # 领走之后多少秒没发完 (进程挂了), 别的线程可以重新领
+    MAIL_POLL_INTERVAL = 10  # 空闲时多少秒查一次发件箱
+    MAIL_DRAIN_TIMEOUT = 10  # 进程退出时最多等多少秒把到期的邮件发完
     ADMINS = ['hlf13655568862@gmail.com']
+
+    # 日志 见 app/log_pipeline.py
+    LOG_DIR = os.environ.get('LOG_DIR') or 'logs'
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text'  # text / json
+    LOG_MAX_BYTES = 10 * 1024 * 1024  # 日志文件多大轮转一次
+    LOG_BACKUP_COUNT = 10
+    LOG_QUEUE_SIZE = 10000  # 还没写出去的日志最多攒多少条, 满了就丢
+    LOG_MAIL_WINDOW = 600  # 相同的错误多少秒内只发一封邮件
+    LOG_MAIL_MAX_PER_WINDOW = 10  # 每个窗口最多发多少封错误邮件
+
+    # 性能统计 见 app/metrics.py
+    METRICS_ENABLED = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # Prometheus 抓取 /metrics 时带 Authorization: Bearer <token>
+    SLOW_QUERY_THRESHOLD = 0.1  # 超过多少秒的 SQL 写慢查询日志
+    SLOW_QUERY_EXPLAIN = True  # 慢查询日志里附带 EXPLAIN 的结果
+
     POSTS_PER_PAGE = 25
+    USERS_PER_PAGE = 50  # /username 用户目录每页多少人
+    API_MAX_PER_PAGE = 100  # /api/v1 的 ?limit= 最大值
+
+    # 首页时间线 见 app/timeline.py
+    TIMELINE_BACKEND = os.environ.get('TIMELINE_BACKEND') or 'database'  # database / memory
+    TIMELINE_MAX_LENGTH = 800  # 每个用户的时间线最多保留多少条
+    TIMELINE_FANOUT_LIMIT = 5000  # 粉丝数超过这个值的作者不推送, 读首页时再拉取
+    TIMELINE_CELEBRITY_TTL = 300  # 大V名单多少秒刷新一次
+
+    # last_seen 缓冲 见 app/last_seen.py
+    LAST_SEEN_GRANULARITY = 60  # 和数据库里的值相差超过多少秒才写回
+    LAST_SEEN_FLUSH_INTERVAL = 30  # 后台线程每隔多少秒批量写一次, 0 表示不启动后台线程
+    LAST_SEEN_FLUSH_THRESHOLD = 500  # 攒够多少个用户就提前写
+
+    # load_user 缓存 见 app/user_cache.py
+    USER_CACHE_BACKEND = os.environ.get('USER_CACHE_BACKEND') or 'local'  # local / shared
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300
+
+    # 头像 见 app/avatars.py
+    AVATAR_LOCAL = os.environ.get('AVATAR_LOCAL') is not None  # 用本站生成的 identicon 代替 gravatar
+    AVATAR_CACHE_DIR = os.environ.get('AVATAR_CACHE_DIR')  # 默认在 instance/avatars
+    AVATAR_CACHE_TIMEOUT = 365 * 24 * 3600
+
+    # 渲染结果缓存 见 app/fragment_cache.py
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND') or 'memory'  # memory / filesystem / none
+    FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024  # memory 和 filesystem 后端都按这个限制总大小
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR')  # 默认在 instance/fragments
+    PAGE_CACHE_TTL = 30  # /explore 整块动态列表缓存多少秒
+
+    # 全文搜索 见 app/search.py
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')  # fts5 / memory (只给开发和测试用) / none, 默认 SQLite 上 fts5, 别的 none
+    SEARCH_TOKENIZER = 'unicode61'  # 中文多的话可以用 trigram (SQLite 3.34+), 要重建 post_fts
+
+    # 用户名/邮箱占用检查 见 app/name_registry.py
+    NAME_BLOOM_CAPACITY = 100000  # 过滤器至少按这么多个名字分配, 用户多了会自动按两倍重建
+    NAME_BLOOM_ERROR_RATE = 0.01
+    NAME_BLOOM_REBUILD_INTERVAL = 600  # 多少秒从数据库重建一次, 带上别的进程注册的名字
+    NAME_CACHE_SIZE = 10000
+    NAME_CACHE_TTL = 60
+
+    # 密码哈希 见 app/passwords.py, 参数可以用 flask passwords calibrate 在本机上测出来
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2'  # pbkdf2 / scrypt / argon2
+    PASSWORD_PBKDF2_ITERATIONS = 150000
+    PASSWORD_SCRYPT_N = 2 ** 14
+    PASSWORD_SCRYPT_R = 8
+    PASSWORD_SCRYPT_P = 1
+    PASSWORD_ARGON2_TIME_COST = 2
+    PASSWORD_ARGON2_MEMORY_COST = 102400  # KiB
+    PASSWORD_ARGON2_PARALLELISM = 8
+    PASSWORD_HASH_WORKERS = 4  # 同时算哈希的线程数
+    PASSWORD_HASH_MAX_PENDING = 16  # 在算的加上排队的最多多少个
+    PASSWORD_HASH_TIMEOUT = 10  # 排不上队最多等多少秒, 之后返回 503
+
+    # 限流 见 app/rate_limit.py
+    RATE_LIMIT_ENABLED = True
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND') or 'memory'  # memory / shared
+    RATE_LIMITS = {}  # 按名字覆盖 routes.py 里的限额, 比如 {'login-username': '20/minute'}
+
+    # 首页实时更新 见 app/stream.py
+    STREAM_BACKEND = os.environ.get('STREAM_BACKEND') or 'local'  # local / shared
+    STREAM_HEARTBEAT = 15  # 多少秒没有事件就发一次心跳
+    STREAM_QUEUE_SIZE = 100  # 每个连接最多积压多少条, 满了让页面刷新
+    STREAM_MAX_CONNECTIONS = 100  # 每个进程最多多少个连接
+    STREAM_MAX_AGE = 300  # 一个连接最长多少秒, 之后浏览器重连
+    STREAM_RETRY = 5000  # 断开后浏览器等多少毫秒重连
+
+    # "可能想关注的人" 见 app/recommend.py, 用 flask recommend build 定时重算
+    RECOMMEND_TOP_K = 10  # 每个用户存几个
+    RECOMMEND_SHOW = 5  # 侧栏显示几个
+    RECOMMEND_SHARD_SIZE = 5000  # 一片算多少个用户 (稀疏矩阵的行数)
+    RECOMMEND_WORKERS = 0  # 并行算各片的进程数, 0 在当前进程里算
+
+    # /explore?sort=trending 见 app/trending.py, 用 flask trending compact 每几分钟重排一次
+    TRENDING_HALF_LIFE = 6 * 3600  # 活跃度的半衰期 (秒)
+    TRENDING_POST_WEIGHT = 1.0  # 发一条动态加多少
+    TRENDING_FOLLOW_WEIGHT = 3.0  # 被关注一次加多少
+    TRENDING_MIN_SCORE = 0.01  # 衰减到这以下的作者压缩时删掉
+    TRENDING_WINDOW = 48 * 3600  # 只排最近多少秒的动态
+    TRENDING_MAX_POSTS = 500  # 排行里最多多少条
+    TRENDING_POSTS_PER_AUTHOR = 3  # 每个作者最多几条
@@ -1,6 +1,9 @@
-from app import app, db  # 导入flask实例  导入数据库实例
+from app import create_app, db, cli  # 导入应用工厂  导入数据库实例
 from app.models import User, Post  # 导入 数据库的类
 
+app = create_app()  # flask run / flask 命令 / gunicorn microblog:app 都用这个实例
+cli.register(app)  # 注册自定义的 flask 命令
+
 
 # 创建了一个shell上下文环境
 @app.shell_context_processor
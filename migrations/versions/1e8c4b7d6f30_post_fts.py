@@ -0,0 +1,30 @@
+"""full-text index of post bodies
+
+Revision ID: 1e8c4b7d6f30
+Revises: 7d3e5f2a1b64
+Create Date: 2026-10-18 17:52:36.104529
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '1e8c4b7d6f30'
+down_revision = '7d3e5f2a1b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 只有 SQLite 有, 其他数据库上 SEARCH_BACKEND 默认是 'none'
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+               "body, content='post', content_rowid='id', tokenize='unicode61')")
+    op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")  # 索引已有的动态
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE post_fts')
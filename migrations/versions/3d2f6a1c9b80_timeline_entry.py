@@ -0,0 +1,49 @@
+"""home timeline entries
+
+Revision ID: 3d2f6a1c9b80
+Revises: 4abf0b13a762
+Create Date: 2026-10-18 10:12:41.208315
+
+"""
+from alembic import op
+from flask import current_app
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d2f6a1c9b80'
+down_revision = '4abf0b13a762'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline_entry',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['author_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_entry_user_timestamp', 'timeline_entry',
+                    ['user_id', 'timestamp', 'post_id'], unique=False)
+    # 给已有的用户建好时间线: 自己和关注的人最近的 TIMELINE_MAX_LENGTH 条动态
+    # 之后由发动态、关注、取关维护, 读首页时不再按需重建
+    conn = op.get_bind()
+    user = sa.table('user', sa.column('id', sa.Integer))
+    max_length = current_app.config.get('TIMELINE_MAX_LENGTH', 800)
+    for (user_id,) in conn.execute(sa.select([user.c.id])).fetchall():
+        conn.execute(sa.text(
+            'INSERT INTO timeline_entry (user_id, post_id, author_id, timestamp) '
+            'SELECT :user_id, id, user_id, timestamp FROM post '
+            'WHERE user_id = :user_id OR user_id IN '
+            '(SELECT followed_id FROM followers WHERE follower_id = :user_id) '
+            'ORDER BY timestamp DESC, id DESC LIMIT :limit'), user_id=user_id, limit=max_length)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_entry_user_timestamp', table_name='timeline_entry')
+    op.drop_table('timeline_entry')
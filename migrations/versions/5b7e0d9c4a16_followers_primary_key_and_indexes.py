@@ -0,0 +1,50 @@
+"""followers primary key and indexes
+
+Revision ID: 5b7e0d9c4a16
+Revises: a81c4e57d2f3
+Create Date: 2026-10-18 11:40:52.118903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0d9c4a16'
+down_revision = 'a81c4e57d2f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite 不能给已有的表加主键, 所以建一张新表, 去重后把数据搬过去
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index('ix_followers_followed_follower', 'followers',
+                    ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_followers_followed_follower', table_name='followers')
+    op.create_table('followers_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute('INSERT INTO followers_old (follower_id, followed_id) '
+               'SELECT follower_id, followed_id FROM followers')
+    op.drop_table('followers')
+    op.rename_table('followers_old', 'followers')
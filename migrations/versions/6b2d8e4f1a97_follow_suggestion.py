@@ -0,0 +1,33 @@
+"""follow suggestions
+
+Revision ID: 6b2d8e4f1a97
+Revises: 1e8c4b7d6f30
+Create Date: 2026-10-18 18:20:14.502718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b2d8e4f1a97'
+down_revision = '1e8c4b7d6f30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('follow_suggestion',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'rank')
+    )
+    # 用 flask recommend build 填充
+
+
+def downgrade():
+    op.drop_table('follow_suggestion')
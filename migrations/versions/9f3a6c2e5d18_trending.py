@@ -0,0 +1,61 @@
+"""trending scores and ranking
+
+Revision ID: 9f3a6c2e5d18
+Revises: 6b2d8e4f1a97
+Create Date: 2026-10-18 21:05:37.114306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f3a6c2e5d18'
+down_revision = '6b2d8e4f1a97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trending_score',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index(op.f('ix_trending_score_score'), 'trending_score', ['score'], unique=False)
+    op.create_table('trending_follow',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.create_index(op.f('ix_trending_follow_timestamp'), 'trending_follow', ['timestamp'], unique=False)
+    op.create_table('trending_entry',
+    sa.Column('rank', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.PrimaryKeyConstraint('rank')
+    )
+    # SQLite 上 logaddexp 是每个连接注册的 Python 函数 (app/trending.py), PostgreSQL 上建成 SQL 函数
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("""
+            CREATE FUNCTION logaddexp(a double precision, b double precision) RETURNS double precision AS $$
+                SELECT CASE WHEN a IS NULL THEN b WHEN b IS NULL THEN a
+                            ELSE GREATEST(a, b) + LN(1 + EXP(-ABS(a - b))) END
+            $$ LANGUAGE SQL IMMUTABLE
+        """)
+    # 用 flask trending compact 填充 trending_entry
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP FUNCTION logaddexp(double precision, double precision)')
+    op.drop_table('trending_entry')
+    op.drop_index(op.f('ix_trending_follow_timestamp'), table_name='trending_follow')
+    op.drop_table('trending_follow')
+    op.drop_index(op.f('ix_trending_score_score'), table_name='trending_score')
+    op.drop_table('trending_score')
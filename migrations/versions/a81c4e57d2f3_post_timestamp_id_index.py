@@ -0,0 +1,23 @@
+"""post (timestamp, id) index for keyset pagination
+
+Revision ID: a81c4e57d2f3
+Revises: 3d2f6a1c9b80
+Create Date: 2026-10-18 11:02:13.774120
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81c4e57d2f3'
+down_revision = '3d2f6a1c9b80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_timestamp_id', 'post', ['timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_timestamp_id', table_name='post')
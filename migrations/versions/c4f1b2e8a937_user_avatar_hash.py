@@ -0,0 +1,33 @@
+"""user avatar hash
+
+Revision ID: c4f1b2e8a937
+Revises: 5b7e0d9c4a16
+Create Date: 2026-10-18 12:25:07.431092
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f1b2e8a937'
+down_revision = '5b7e0d9c4a16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('avatar_hash', sa.String(length=32), nullable=True))
+    # 给已有的用户算好 email 的 md5
+    user = sa.table('user', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('avatar_hash', sa.String))
+    conn = op.get_bind()
+    rows = conn.execute(sa.select([user.c.id, user.c.email]).where(user.c.email.isnot(None))).fetchall()
+    for id, email in rows:
+        conn.execute(user.update().where(user.c.id == id).values(
+            avatar_hash=md5(email.lower().encode('utf-8')).hexdigest()))
+
+
+def downgrade():
+    op.drop_column('user', 'avatar_hash')
@@ -1,17 +1,158 @@
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from hashlib import md5
+import json
+import logging
+import math
+import os
+import queue
+import shutil
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from app import app, db
-from app.models import User, Post
+from unittest import mock
+from flask import g
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from config import Config
+from app import create_app, db, timeline, avatars, fragment_cache, mail_queue, metrics, user_cache, search_index, \
+    name_registry, passwords, rate_limiter, broker, recommender, trending
+from app import cli
+from app.cli import import_times
+from app.fragment_cache import FragmentCache, MemoryBackend, FileSystemBackend
+from app.log_pipeline import JSONFormatter, NonBlockingQueueHandler, ThrottledSMTPHandler
+from app.mail_queue import MailQueue
+from app.models import User, Post, OutboxMessage, TrendingScore, TrendingEntry, TrendingFollow
+from app.name_registry import BloomFilter
+from app.passwords import HasherBusy, PasswordHasher
+from app.rate_limit import RateLimiter, MemoryBackend as RateLimitMemoryBackend, \
+    SharedMemoryBackend as SharedRateLimitBackend
+from app.last_seen import LastSeenTracker
+from app.recommend import np as numpy
+from app.trending import EPOCH, logaddexp
+from app.pagination import keyset_paginate, encode_cursor, decode_cursor
+from app.search import SearchIndex, FTS5Backend, NullBackend, MemoryBackend as MemorySearchBackend
+from app.stream import Broker, LocalBackend as StreamLocalBackend, SharedMemoryBackend as SharedStreamBackend
+from app.timeline import TimelineStore
+from app.user_cache import UserCache, SharedMemoryBackend
+
+
+class QueryCounter(object):
+    """记录 with 块里数据库执行了哪些语句"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """本地假的 SMTP 服务器, 记下连接数和收到的邮件; fail_next 封回 451, reject 里的收件人回 550"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeSMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.fail_next = 0
+        self.reject = set()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 fake ESMTP')
+        recipients = []
+        for line in self.rfile:
+            command = line.decode('utf-8').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 fake')
+            elif verb == 'RCPT':
+                address = command.split(':', 1)[1].strip('<> ')
+                if address in self.server.reject:
+                    self.reply('550 no such user')
+                else:
+                    recipients.append(address)
+                    self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                if self.server.fail_next:
+                    self.server.fail_next -= 1
+                    self.reply('451 try again later')
+                else:
+                    self.server.messages.append((recipients, data))
+                    self.reply('250 queued')
+                recipients = []
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:  # MAIL, RSET, NOOP
+                recipients = [] if verb == 'RSET' else recipients
+                self.reply('250 ok')
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    MAIL_WORKERS = 0  # 测试里不起发信线程, 用 mail_queue.drain()
 
 
 class UserModelCase(unittest.TestCase):
+    @contextmanager
+    def assertMaxQueries(self, n):
+        """with 块里的 SQL 语句超过 n 条就失败, 用来发现 N+1 查询"""
+        with QueryCounter(db.engine) as counter:
+            yield counter
+        if counter.count > n:
+            self.fail('{} queries executed, expected at most {}:\n{}'.format(
+                counter.count, n, '\n'.join(counter.statements)))
+
     def setUp(self):
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.app = create_app(TestConfig)  # 每个测试一个新的应用, 改配置不会影响别的测试
+        # 请求之外也要用 db; 不推应用上下文, 否则 test client 的请求都共用这一个上下文里的 g
+        db.app = self.app
         db.create_all()
+        fragment_cache.clear()
+        user_cache.clear()  # 每个测试的数据库都是新的, id 会重复
+        name_registry.clear()
+        rate_limiter.clear()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        db.app = None
 
     def test_password_hashing(self):
         u = User(username='susan')
@@ -25,6 +166,31 @@ class UserModelCase(unittest.TestCase):
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
 
+    def test_avatar_hash(self):
+        u = User(username='john', email='john@example.com')
+        self.assertEqual(u.avatar_hash, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        self.assertEqual(u.avatar_hash, md5(b'susan@example.com').hexdigest())
+        self.assertIs(u.avatar(70), u.avatar(70))  # URL 已经缓存
+
+    def test_local_avatar(self):
+        local, cache_dir = avatars.local, avatars.cache_dir
+        avatars.local, avatars.cache_dir = True, tempfile.mkdtemp()
+        try:
+            u = User(username='john', email='john@example.com')
+            url = u.avatar(128)
+            self.assertEqual(url, '/avatar/d4c74594d841139328695756648b6bd6/128')
+            response = self.app.test_client().get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'image/svg+xml')
+            self.assertGreaterEqual(response.cache_control.max_age, 24 * 3600)
+            self.assertTrue(os.path.exists(os.path.join(
+                avatars.cache_dir, 'd4c74594d841139328695756648b6bd6-128.svg')))
+            self.assertEqual(self.app.test_client().get('/avatar/../1').status_code, 404)
+        finally:
+            shutil.rmtree(avatars.cache_dir)
+            avatars.local, avatars.cache_dir = local, cache_dir
+
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
         u2 = User(username='susan', email='susan@example.com')
@@ -48,6 +214,43 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count, u1.post_count), (0, 0, 0))
+
+        u1.follow(u2)
+        u1.follow(u2)  # 重复关注不会多算
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count), (0, 1))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count), (0, 0))
+
+        # 计数被改乱之后可以重新统计
+        u1.follow(u2)
+        db.session.add(Post(body='hi', author=u2))
+        u2.followed_count = 7
+        db.session.commit()
+        User.repair_counters()
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.follower_count), (1, 1))
+        self.assertEqual((u2.followed_count, u2.post_count), (0, 1))
+
+        # 发动态之后自己的主页和 API 马上是新的计数, 不会用 user_loader 缓存里的旧值
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1.set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        self.assertIn(b'0 posts.', client.get('/user/john').data)  # 缓存里有了 john
+        client.post('/index', data={'post': 'hello'})
+        self.assertIn(b'1 posts.', client.get('/user/john').data)
+        self.assertEqual(client.get('/api/v1/users/john').get_json()['posts'], 1)
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -86,6 +289,1261 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        for backend in ('database', 'memory'):
+            store = TimelineStore()
+            store.backend = TimelineStore.backends[backend](max_length=100)
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            u3 = User(username='mary', email='mary@example.com')
+            db.session.add_all([u1, u2, u3])
+            db.session.commit()
+            u1.followed.append(u2)
+            db.session.commit()
+
+            now = datetime.utcnow()
+            posts = []
+            for i, author in enumerate([u1, u2, u3, u2]):
+                p = Post(body='post {}'.format(i), author=author,
+                         timestamp=now + timedelta(seconds=i))
+                db.session.add(p)
+                db.session.flush()
+                store.push(p)
+                posts.append(p)
+            db.session.commit()
+            self.assertEqual(store.read(u1, 10)[0], [posts[3], posts[1], posts[0]])
+            self.assertEqual(store.read(u1, 10)[0], u1.followed_posts().all())
+
+            # 按键翻页
+            page, more = store.read(u1, 2)
+            self.assertTrue(more)
+            last = page[-1]
+            self.assertEqual(store.read(u1, 2, before=(last.timestamp, last.id)),
+                             ([posts[0]], False))
+
+            store.follow(u1, u3)  # 关注后补进对方的动态
+            self.assertIn(posts[2], store.read(u1, 10)[0])
+            store.unfollow(u1, u3)
+            self.assertNotIn(posts[2], store.read(u1, 10)[0])
+
+            store.backend.clear(u1.id)
+            store.rebuild(u1)
+            self.assertEqual(store.read(u1, 10)[0], u1.followed_posts().all())
+            self.tearDown()
+            self.setUp()
+
+    def test_timeline_is_bounded(self):
+        for backend in ('database', 'memory'):
+            store = TimelineStore()
+            store.backend = TimelineStore.backends[backend](max_length=3)
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            u3 = User(username='mary', email='mary@example.com')
+            db.session.add_all([u1, u2, u3])
+            db.session.commit()
+            u1.followed.append(u2)
+            db.session.commit()
+            store.rebuild(u1)
+            store.rebuild(u2)
+
+            now = datetime.utcnow()
+            posts = []
+            for i, author in enumerate([u2, u1, u2, u2, u1]):
+                p = Post(body='post {}'.format(i), author=author, timestamp=now + timedelta(seconds=i))
+                db.session.add(p)
+                db.session.flush()
+                store.push(p)
+                posts.append(p)
+            db.session.commit()
+            # 每个用户只留最新的 3 条, 推送时就删掉了旧的
+            self.assertEqual(store.backend.range(u1.id), [(p.timestamp, p.id) for p in posts[:1:-1]])
+            self.assertEqual(store.backend.range(u2.id), [(p.timestamp, p.id) for p in (posts[3], posts[2], posts[0])])
+            p = Post(body='mary', author=u3, timestamp=now - timedelta(days=1))
+            db.session.add(p)
+            db.session.commit()
+            store.follow(u1, u3)  # 补进来的旧动态也不会超长
+            self.assertEqual(len(store.backend.range(u1.id, limit=10)), 3)
+            self.tearDown()
+            self.setUp()
+
+    def test_memory_timeline_rebuilds_missing_lines(self):
+        store = TimelineStore()
+        store.backend = TimelineStore.backends['memory'](max_length=100)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.followed.append(u2)
+        now = datetime.utcnow()
+        old = [Post(body='old {}'.format(i), author=u2, timestamp=now - timedelta(minutes=i)) for i in range(3)]
+        db.session.add_all(old)
+        db.session.commit()
+        # 进程刚重启, john 的时间线还不在内存里; 推送不会建出一条只有新动态的时间线
+        p = Post(body='new', author=u2, timestamp=now + timedelta(seconds=1))
+        db.session.add(p)
+        db.session.flush()
+        store.push(p)
+        db.session.commit()
+        self.assertFalse(store.backend.exists(u1.id))
+        self.assertEqual([post.body for post in store.read(u1, 10)[0]], ['new', 'old 0', 'old 1', 'old 2'])
+        # 建过但是空的时间线不会每次读都重建
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        self.assertEqual(store.read(u3, 10), ([], False))
+        self.assertTrue(store.backend.exists(u3.id))
+
+    def test_timeline_pulls_celebrities(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        fanout_limit = timeline.fanout_limit
+        timeline.fanout_limit = 1  # susan 有一个粉丝就算大V
+        timeline._celebrities_loaded = 0
+        try:
+            p = Post(body='hello', author=u2)
+            db.session.add(p)
+            db.session.flush()
+            timeline.push(p)
+            db.session.commit()
+            self.assertFalse(timeline.backend.range(u1.id))  # 没有推送
+            self.assertEqual(timeline.read(u1, 10), ([p], False))  # 读时拉取
+        finally:
+            timeline.fanout_limit = fanout_limit
+            timeline._celebrities = frozenset()
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u, timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(7)]  # 时间戳有重复, 靠 id 区分
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        newest_first = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).all()
+
+        p1 = keyset_paginate(Post.query, 3)
+        self.assertEqual(p1.items, newest_first[:3])
+        self.assertIsNone(p1.prev_cursor)
+        p2 = keyset_paginate(Post.query, 3, before=decode_cursor(p1.next_cursor))
+        self.assertEqual(p2.items, newest_first[3:6])
+        p3 = keyset_paginate(Post.query, 3, before=decode_cursor(p2.next_cursor))
+        self.assertEqual(p3.items, newest_first[6:])
+        self.assertIsNone(p3.next_cursor)
+        back = keyset_paginate(Post.query, 3, after=decode_cursor(p3.prev_cursor))
+        self.assertEqual(back.items, p2.items)
+        back = keyset_paginate(Post.query, 3, after=decode_cursor(back.prev_cursor))
+        self.assertEqual(back.items, p1.items)
+        self.assertIsNone(back.prev_cursor)
+
+        # 旧的 ?page=N
+        self.assertEqual(keyset_paginate(Post.query, 3, page=2).items, p2.items)
+        self.assertIsNone(decode_cursor('not-a-cursor'))
+        cursor = encode_cursor(now, 42)
+        self.assertEqual(decode_cursor(cursor), (now, 42))
+
+    def test_last_seen_buffer(self):
+        tracker = LastSeenTracker()
+        tracker.app = self.app
+        tracker.flush_interval = 0  # 不启动后台线程, 手动 flush
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        start = u1.last_seen
+
+        # 没超过粒度的访问不写
+        tracker.touch(u1, now=start + timedelta(seconds=10))
+        self.assertEqual(tracker.flush(), 0)
+
+        later = start + timedelta(seconds=90)
+        tracker.touch(u1, now=later - timedelta(seconds=5))
+        tracker.touch(u1, now=later)  # 同一个用户只写最新的一次
+        tracker.touch(u2, now=later)
+        self.assertEqual(db.session.query(User.last_seen).filter_by(id=u1.id).scalar(), start)
+        tracker.refresh(u1)  # 页面上能看到缓冲里的值, 但不会弄脏 session
+        self.assertEqual(u1.last_seen, later)
+        self.assertFalse(db.session.dirty)
+
+        self.assertEqual(tracker.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, later)
+        self.assertEqual(u2.last_seen, later)
+
+    def test_user_cache(self):
+        cache = UserCache(self.app)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+        db.session.remove()
+
+        self.assertEqual(cache.load(user_id).username, 'john')  # 未命中, 查数据库
+        db.session.remove()
+        cached = cache.load(user_id)  # 命中, 不查数据库
+        self.assertEqual(cached.username, 'john')
+        self.assertIn(cached, db.session)
+        self.assertFalse(db.session.dirty)
+        self.assertEqual(cached.followed.count(), 0)  # 关系属性照常可用
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        cached.username = 'johnny'
+        db.session.commit()
+        cache.invalidate(cached)
+        db.session.remove()
+        self.assertEqual(cache.load(user_id).username, 'johnny')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        # 共享缓存: 另一个进程 (另一个 UserCache) 的本地 LRU 没有时从共享缓存读
+        cache.shared = SharedMemoryBackend()
+        cache.set(User.query.get(user_id))
+        other = UserCache(self.app)
+        other.shared = SharedMemoryBackend()
+        db.session.remove()
+        self.assertEqual(other.load(user_id).username, 'johnny')
+        self.assertEqual(other.stats()['shared_hits'], 1)
+        cache.invalidate(user_id)
+        self.assertIsNone(other.shared.get(user_id))
+
+        # 另一个进程改了名字: 本进程 LRU 里的旧条目版本对不上, 不会一直用到 TTL 过期
+        other.load(user_id)
+        db.session.remove()
+        u = User.query.get(user_id)
+        u.username = 'jon'
+        db.session.commit()
+        cache.invalidate(u)
+        db.session.remove()
+        self.assertEqual(other.load(user_id).username, 'jon')
+        db.session.remove()
+        hits = other.stats()['hits']
+        self.assertEqual(other.load(user_id).username, 'jon')  # 版本没变就还是本地命中
+        self.assertEqual(other.stats()['hits'], hits + 1)
+
+        # 计数在多个线程里也不会少加
+        counted = UserCache(self.app)
+        threads = [threading.Thread(target=lambda: [counted._count('hits') for _ in range(2000)]) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counted.stats()['hits'], 16000)
+
+    def test_feed_pages_query_count(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        users = [User(username='user{}'.format(i), email='user{}@example.com'.format(i))
+                 for i in range(6)]
+        for u in users:
+            u.set_password('cat')
+        db.session.add_all(users)
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+        now = datetime.utcnow()
+        db.session.add_all([Post(body='post {}'.format(i), author=users[i % 6],
+                                 timestamp=now + timedelta(seconds=i)) for i in range(30)])
+        db.session.commit()
+        timeline.rebuild(users[0])  # 相当于迁移时的回填; 上面的 Post 没有经过 timeline.push
+        db.session.commit()
+        db.session.remove()
+
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'user0', 'password': 'cat'})
+        client.get('/index')  # 预热 user_loader 缓存
+        # 不管一页有多少条动态、多少个作者, 语句数都是固定的
+        # 个人主页另外还有一个 is_following, 粉丝数和关注数直接读 user 上的计数; 首页和个人主页的推荐侧栏各一条
+        for url, limit in (('/index', 4), ('/explore', 2), ('/user/user1', 4)):
+            db.session.remove()
+            with self.assertMaxQueries(limit):
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'post 2', response.data)
+        # 无关的查询参数和第一页的各种写法都命中同一个缓存项, 不再查动态
+        hits = fragment_cache.stats()['page']['hits']
+        for url in ('/explore?utm_source=x', '/explore?page=1&_=123', '/explore?before=garbage'):
+            db.session.remove()
+            with self.assertMaxQueries(1):
+                self.assertIn(b'post 2', client.get(url).data)
+        self.assertEqual(fragment_cache.stats()['page']['hits'], hits + 3)
+
+        # 读首页不写数据库, 时间线是空的也一样 (数据库后端的时间线只由写入维护)
+        client.get('/logout')
+        client.post('/login', data={'username': 'user5', 'password': 'cat'})
+        for url in ('/index', '/index', '/api/v1/feed'):
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                self.assertEqual(client.get(url).status_code, 200)
+            self.assertFalse([sql for sql in counter.statements if not sql.lstrip().upper().startswith('SELECT')])
+
+    def test_fragment_cache(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        for backend in (MemoryBackend(), FileSystemBackend(tempfile.mkdtemp())):
+            cache = FragmentCache()
+            cache.backend = backend
+            u.username = 'john'
+            with self.app.test_request_context():
+                html = cache.render_post(p)
+                self.assertIn('hello', html)
+                self.assertEqual(cache.render_post(p), html)
+                self.assertEqual(cache.stats()['post']['hits'], 1)
+                u.username = 'johnny'  # 改了资料, 作者版本变了
+                self.assertIn('johnny', cache.render_post(p))
+                self.assertEqual(cache.stats()['post']['misses'], 2)
+
+                renders = []
+                render = lambda: renders.append(1) or 'page {}'.format(len(renders))
+                self.assertEqual(cache.page('/explore', render), 'page 1')
+                self.assertEqual(cache.page('/explore', render), 'page 1')
+                self.assertEqual(cache.page('/explore?before=x', render, stable=True), 'page 2')
+                cache.post_created()  # 新动态只影响第一页
+                self.assertEqual(cache.page('/explore', render), 'page 3')
+                self.assertEqual(cache.page('/explore?before=x', render, stable=True), 'page 2')
+                cache.profile_changed()
+                self.assertEqual(cache.page('/explore?before=x', render, stable=True), 'page 4')
+            if isinstance(backend, FileSystemBackend):
+                shutil.rmtree(backend.directory)
+
+    def test_fragment_cache_generations_are_shared(self):
+        directory = tempfile.mkdtemp()
+        try:
+            first, second = FragmentCache(), FragmentCache()  # 两个进程, 同一个缓存目录
+            first.backend, second.backend = FileSystemBackend(directory), FileSystemBackend(directory)
+            renders = []
+            render = lambda: renders.append(1) or 'page {}'.format(len(renders))
+            self.assertEqual(first.page('/explore', render), 'page 1')
+            self.assertEqual(second.page('/explore', render), 'page 1')
+            first.post_created()  # 另一个进程里发了动态
+            self.assertEqual(second.page('/explore', render), 'page 2')
+            second.profile_changed()
+            self.assertEqual(first.page('/explore', render), 'page 3')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_filesystem_backend_is_bounded(self):
+        directory = tempfile.mkdtemp()
+        try:
+            backend = FileSystemBackend(directory, max_bytes=1000)
+            backend.CLEANUP_EVERY = 10
+            backend.set('expired', 'x', ttl=1)
+            backend.bump('post')
+            now = time.time()
+            with mock.patch('time.time', return_value=now + 5):
+                for i in range(50):
+                    backend.set('key{}'.format(i), 'x' * 100)
+            size = sum(os.path.getsize(os.path.join(root, name))
+                       for root, dirs, files in os.walk(directory) if 'generations' not in root for name in files)
+            self.assertLessEqual(size, 1000 + 10 * 120)  # 最多比上限多出两次清理之间写的
+            self.assertFalse(os.path.exists(backend._path('expired')))
+            self.assertIsNone(backend.get('key0'))
+            self.assertEqual(backend.get('key49'), 'x' * 100)
+            self.assertNotEqual(backend.generation('post'), '0')  # 清理不动代数
+        finally:
+            shutil.rmtree(directory)
+
+    def test_memory_backend_is_bounded(self):
+        backend = MemoryBackend(max_bytes=100)
+        for i in range(20):
+            backend.set('key{}'.format(i), 'x' * 10)
+        self.assertLessEqual(backend.size, 100)
+        self.assertIsNone(backend.get('key0'))
+        self.assertEqual(backend.get('key19'), 'x' * 10)
+
+    def test_sqlite_pragmas(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.db')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        try:
+            with db.engine.connect() as conn:
+                self.assertEqual(conn.execute('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(conn.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+                self.assertEqual(conn.execute('PRAGMA busy_timeout').scalar(), 5000)
+            self.assertEqual(db.engine.pool.size(), self.app.config['SQLITE_POOL_SIZE'])
+        finally:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            shutil.rmtree(os.path.dirname(path))
+
+    def test_read_replica_routing(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + path}
+        try:
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            u1.set_password('cat')
+            db.session.add_all([u1, u2, Post(body='from primary', author=u1)])
+            db.session.commit()
+            # 副本里的数据故意和主库不一样, 看查询走了哪边
+            replica = db.get_engine(self.app, bind='replica')
+            db.metadata.create_all(replica)
+            replica.execute(User.__table__.insert(), id=u1.id, username='john')
+            replica.execute(Post.__table__.insert(), body='from replica', user_id=u1.id,
+                            timestamp=datetime.utcnow())
+
+            # 原始 SQL 的 SELECT 也是读, 不会让请求粘到主库上; 其他语句按写算
+            with self.app.test_request_context('/explore'):
+                g.use_replica = True
+                self.assertEqual(db.session.execute(db.text('SELECT body FROM post')).scalar(), 'from replica')
+                self.assertEqual(db.session.execute(db.text('WITH p AS (SELECT body FROM post) SELECT body FROM p')
+                                                    .execution_options(read_only=True)).scalar(), 'from replica')
+                self.assertFalse(g.get('db_write'))
+                db.session.execute(db.text('UPDATE post SET body = body'))
+                self.assertTrue(g.get('db_write'))
+                db.session.rollback()
+
+            client = self.app.test_client()
+            client.post('/login', data={'username': 'john', 'password': 'cat'})
+            self.assertIn(b'from replica', client.get('/explore').data)
+            client.get('/follow/susan')  # 写过数据之后一段时间内读主库
+            fragment_cache.clear()
+            self.assertIn(b'from primary', client.get('/explore').data)
+        finally:
+            self.app.config['SQLALCHEMY_BINDS'] = None
+            shutil.rmtree(os.path.dirname(path))
+
+    @contextmanager
+    def fake_smtp(self):
+        server = FakeSMTPServer()
+        state = mail_queue.mail_state()
+        saved = state.server, state.port, state.suppress
+        state.server, state.port, state.suppress = '127.0.0.1', server.port, False
+        try:
+            yield server
+        finally:
+            state.server, state.port, state.suppress = saved
+            server.close()
+
+    def test_mail_queue(self):
+        with self.app.app_context(), self.fake_smtp() as server:  # Flask-Mail 发信要有应用上下文
+            for i in range(3):
+                mail_queue.enqueue('hi {}'.format(i), 'admin@example.com', ['u{}@example.com'.format(i)],
+                                   'text', '<p>html</p>')
+            self.assertEqual(mail_queue.stats(), {'pending': 3})
+            self.assertEqual(mail_queue.drain(), 3)
+            self.assertEqual(server.connections, 1)  # 一个连接发完三封
+            self.assertEqual([r for r, _ in server.messages],
+                             [['u0@example.com'], ['u1@example.com'], ['u2@example.com']])
+
+            # 临时性错误: 退避之后重试
+            server.fail_next = 1
+            message = mail_queue.enqueue('retry', 'admin@example.com', ['susan@example.com'], 'text', None)
+            self.assertEqual(mail_queue.drain(), 0)
+            self.assertEqual((message.status, message.attempts), ('pending', 1))
+            self.assertGreater(message.next_attempt_at, datetime.utcnow())
+            self.assertEqual(mail_queue.drain(), 0)  # 还没到时间
+            message.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+            self.assertEqual(mail_queue.drain(), 1)
+            self.assertEqual((message.status, message.attempts), ('sent', 2))
+
+            # 永久性错误: 不再重试
+            server.reject.add('nobody@example.com')
+            message = mail_queue.enqueue('bounce', 'admin@example.com', ['nobody@example.com'], 'text', None)
+            self.assertEqual(mail_queue.drain(), 0)
+            self.assertEqual((message.status, message.attempts), ('failed', 1))
+            self.assertEqual(mail_queue.stats(), {'sent': 4, 'failed': 1})
+
+    def test_mail_queue_drains_on_shutdown(self):
+        path = os.path.join(tempfile.mkdtemp(), 'mail.db')  # 发信线程要用自己的连接
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+        self.app.config['MAIL_WORKERS'] = 1
+        try:
+            db.create_all()
+            queue = MailQueue(self.app)
+            with self.fake_smtp() as server:
+                for i in range(5):
+                    queue.enqueue('hi', 'admin@example.com', ['john@example.com'], 'text', None)
+                queue.shutdown(timeout=5)
+                self.assertEqual(len(queue._threads), 1)
+                self.assertFalse(queue._threads[0].is_alive())
+                self.assertEqual(len(server.messages), 5)
+            self.assertEqual(queue.stats(), {'sent': 5})
+            db.session.remove()
+            db.drop_all()
+        finally:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            self.app.extensions['mail_queue'] = mail_queue
+            shutil.rmtree(os.path.dirname(path))
+
+    def error_record(self, message, exception):
+        try:
+            raise exception
+        except Exception:
+            record = logging.LogRecord('app', logging.ERROR, __file__, 1, message, None, sys.exc_info())
+        return NonBlockingQueueHandler(queue.Queue()).prepare(record)  # 和经过队列之后的记录一样
+
+    def test_error_mail_is_throttled(self):
+        with self.fake_smtp() as server, mock.patch('app.log_pipeline.time') as clock:
+            clock.time.return_value = 1000.0
+            handler = ThrottledSMTPHandler(('127.0.0.1', server.port), 'no-reply@example.com',
+                                           ['admin@example.com'], 'Microblog Failure',
+                                           window=600, max_per_window=2)
+            for i in range(5):
+                handler.handle(self.error_record('Exception on /index [GET]', ZeroDivisionError('boom')))
+            self.assertEqual(len(server.messages), 1)  # 同样的错误只发一封
+            handler.handle(self.error_record('Exception on /explore [GET]', KeyError('x')))
+            handler.handle(self.error_record('Exception on /user [GET]', ValueError('y')))
+            self.assertEqual(len(server.messages), 2)  # 每个窗口最多两封
+
+            clock.time.return_value = 1601.0
+            handler.handle(self.error_record('Exception on /index [GET]', ZeroDivisionError('boom')))
+            self.assertEqual(len(server.messages), 3)
+            self.assertIn(b'4 more of this error suppressed', server.messages[-1][1])
+            self.assertIn(b'ZeroDivisionError: boom', server.messages[-1][1])
+
+    def test_log_queue_never_blocks(self):
+        handler = NonBlockingQueueHandler(queue.Queue(2))
+        logger = logging.getLogger('tests.log_queue')
+        logger.addHandler(handler)
+        logger.propagate = False
+        try:
+            for i in range(5):
+                logger.warning('message %d', i)
+        finally:
+            logger.removeHandler(handler)
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.queue.get_nowait().msg, 'message 0')
+
+    def test_json_log_format(self):
+        record = self.error_record('Exception on /index [GET]', ZeroDivisionError('boom'))
+        entry = json.loads(JSONFormatter().format(record))
+        self.assertEqual(entry['level'], 'ERROR')
+        self.assertEqual(entry['message'], 'Exception on /index [GET]')
+        self.assertTrue(entry['exception'].endswith('ZeroDivisionError: boom'))
+
+    def test_metrics(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        admin = User(username='admin', email=self.app.config['ADMINS'][0])
+        susan = User(username='susan', email='susan@example.com')
+        admin.set_password('cat')
+        susan.set_password('dog')
+        db.session.add_all([admin, susan, Post(body='hello', author=susan)])
+        db.session.commit()
+
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'susan', 'password': 'dog'})
+        self.assertEqual(client.get('/metrics').status_code, 403)  # 不是管理员
+        client.get('/logout')
+
+        client.post('/login', data={'username': 'admin', 'password': 'cat'})
+        before = metrics._endpoints['main.explore'].count if 'main.explore' in metrics._endpoints else 0
+        metrics.slow_query_threshold = 0  # 每条都算慢查询
+        try:
+            with self.assertLogs('app.slow_query', 'WARNING') as logs:
+                client.get('/explore')
+        finally:
+            metrics.slow_query_threshold = self.app.config['SLOW_QUERY_THRESHOLD']
+        self.assertTrue(any('FROM post' in line and 'SCAN' in line for line in logs.output))  # 带 EXPLAIN
+        stats = metrics._endpoints['main.explore']
+        self.assertEqual(stats.count, before + 1)
+        self.assertGreater(stats.sql_queries, 0)
+        self.assertGreater(stats.template_seconds, 0)
+        self.assertGreater(stats.response_bytes, 0)
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        text = response.get_data(as_text=True)
+        self.assertIn('microblog_request_duration_seconds_count{{endpoint="main.explore"}} {}'.format(
+            before + 1), text)
+        self.assertIn('# TYPE microblog_sql_queries_total counter', text)
+        self.assertIn('microblog_fragment_cache_misses_total{kind="page"}', text)
+
+        # 流式响应不能为了记响应大小把整个生成器读进内存
+        produced = []
+
+        def chunks(query):
+            for i in range(1000):
+                produced.append(i)
+                yield 'row\n'
+        sent = metrics._endpoints['main.username'].response_bytes if 'main.username' in metrics._endpoints else 0
+        with mock.patch('app.routes.export_users', chunks):
+            response = client.get('/username?format=csv', buffered=False)
+            self.assertLessEqual(len(produced), 1)  # stream_with_context 先取了第一块
+            self.assertEqual(len(response.get_data()), 4000)
+        self.assertEqual(metrics._endpoints['main.username'].response_bytes, sent)  # 算不出来, 记 0
+
+    def test_search(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        bodies = ['flask is great', 'I love flask and python', 'python only',
+                  'flask flask flask', 'nothing here', 'Flask again']
+        posts = [Post(body=body, author=u) for body in bodies]
+        db.session.add_all(posts)
+        db.session.flush()
+        for post in posts:
+            search_index.add(post)
+        db.session.commit()
+
+        for backend in (search_index.backend, MemorySearchBackend()):
+            self.assertEqual(backend.reindex(), 6)
+            db.session.commit()
+            search_index.backend, saved = backend, search_index.backend
+            try:
+                # 按相关度: 出现三次的最前面; 游标翻页不重复不遗漏
+                seen, cursor = [], None
+                while True:
+                    results = search_index.search('FLASK', 2, cursor=cursor)
+                    seen.extend(results.items)
+                    cursor = results.next_cursor
+                    if cursor is None:
+                        break
+                self.assertEqual(seen[0], posts[3])
+                self.assertEqual(sorted(p.id for p in seen), [posts[i].id for i in (0, 1, 3, 5)])
+                # 按时间: 新的在前
+                results = search_index.search('flask', 10, sort='recent')
+                self.assertEqual(results.items, [posts[5], posts[3], posts[1], posts[0]])
+                self.assertEqual(search_index.search('flask python', 10).items, [posts[1]])
+                self.assertEqual(search_index.search('"OR NEAR*', 10).items, [])  # 不会被当成查询语法
+                self.assertEqual(search_index.search('', 10).items, [])
+            finally:
+                search_index.backend = saved
+
+    def test_search_backend_follows_dialect(self):
+        try:
+            self.assertIsInstance(SearchIndex(self.app).backend, FTS5Backend)
+            # 别的数据库上没有 post_fts, 默认不建索引; 配了 fts5 也退回来, 免得发动态失败
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://localhost/microblog'
+            self.assertIsInstance(SearchIndex(self.app).backend, NullBackend)
+            self.app.config['SEARCH_BACKEND'] = 'fts5'
+            with self.assertLogs(self.app.logger, 'WARNING'):
+                self.assertIsInstance(SearchIndex(self.app).backend, NullBackend)
+            self.app.config['SEARCH_BACKEND'] = 'memory'
+            self.assertIsInstance(SearchIndex(self.app).backend, MemorySearchBackend)
+        finally:
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            self.app.config['SEARCH_BACKEND'] = None
+            self.app.extensions['search_index'] = search_index
+
+    def test_search_page(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        client.post('/index', data={'post': 'searching for needles'})  # 发动态时建索引
+        response = client.get('/search?q=needles')
+        self.assertIn(b'searching for needles', response.data)
+        self.assertNotIn(b'searching for needles', client.get('/search?q=haystack').data)
+
+    def test_user_directory(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        self.assertEqual(client.get('/username').status_code, 302)  # 要先登录
+        db.session.add_all([User(username='user{:03d}'.format(i), email='user{}@example.com'.format(i))
+                            for i in range(120)])
+        admin = User(username='admin', email='admin@example.com')
+        admin.set_password('cat')
+        db.session.add(admin)
+        db.session.commit()
+        client.post('/login', data={'username': 'admin', 'password': 'cat'})
+
+        with self.assertMaxQueries(2):  # load_user 命中缓存时只有目录这一条
+            html = client.get('/username').get_data(as_text=True)
+        self.assertIn('>admin<', html)
+        self.assertIn('>user048<', html)
+        self.assertNotIn('>user049<', html)  # 每页 50 个
+        html = client.get('/username?after=user048').get_data(as_text=True)
+        self.assertIn('>user049<', html)
+        self.assertNotIn('>user048<', html)
+
+        html = client.get('/username?q=user11').get_data(as_text=True)
+        self.assertEqual(html.count('>user11'), 10)
+        self.assertNotIn('>admin<', html)
+
+        response = client.get('/username?format=csv')
+        self.assertTrue(response.is_streamed)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'username,last_seen,followers,following,posts')
+        self.assertEqual(len(lines), 122)
+        self.assertTrue(lines[-1].startswith('user119,'))
+        self.assertEqual(len(client.get('/username?format=csv&q=user0').get_data(as_text=True).splitlines()), 101)
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        names = ['user{}'.format(i) for i in range(1000)]
+        for name in names:
+            bloom.add(name)
+        self.assertTrue(all(name in bloom for name in names))  # 没有假阴性
+        false_positives = sum('other{}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)  # 1% 左右
+
+    def test_name_registry(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.assertTrue(name_registry.exists('username', 'john'))
+        self.assertTrue(name_registry.exists('email', 'john@example.com'))
+        with self.assertMaxQueries(0):  # 过滤器建好之后, 没人用的名字和 LRU 里的名字都不查数据库
+            self.assertFalse(name_registry.exists('username', 'susan'))
+            self.assertTrue(name_registry.exists('username', 'john'))
+
+        u = User(username='susan', email='susan@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(name_registry.exists('username', 'susan'))  # 插入时加进了过滤器
+        u.username = 'susie'
+        db.session.commit()
+        self.assertTrue(name_registry.exists('username', 'susie'))
+        self.assertFalse(name_registry.exists('username', 'susan'))  # 旧名字空出来了
+
+        # 过期之后在后台线程里重建, 建好之前旧的过滤器照常回答, 不在请求里扫 user 表
+        db.session.execute(User.__table__.insert(), {'username': 'mary', 'email': 'mary@example.com'})
+        db.session.commit()
+        name_registry._built_at = 0
+        with self.app.app_context():
+            self.assertFalse(name_registry.exists('username', 'mary'))  # 旧的过滤器回答的, 里面还没有
+            name_registry.rebuilding.join()
+        self.assertIsNone(name_registry.rebuilding)
+        self.assertTrue(name_registry.exists('username', 'mary'))  # 别的进程注册的名字也有了
+
+    def test_name_registry_built_at_startup(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        client = self.app.test_client()
+        client.get('/login')  # 第一个请求之前建好
+        self.assertIsNotNone(name_registry._filters)
+        with self.assertMaxQueries(0):
+            self.assertFalse(name_registry.exists('username', 'susan'))
+
+        # 同时来的检查只有一个去建
+        name_registry.clear()
+        with mock.patch.object(name_registry, 'rebuild', wraps=name_registry.rebuild) as rebuild:
+            threads = [threading.Thread(target=name_registry.exists, args=('username', 'susan')) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(rebuild.call_count, 1)
+
+    def test_check_username_and_register(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/check_username?username=john').get_json(),
+                         {'username': 'john', 'available': False})
+        self.assertTrue(client.get('/api/check_username?username=susan').get_json()['available'])
+        self.assertEqual(client.get('/api/check_username?username=').status_code, 400)
+        for i in range(60):
+            client.get('/api/check_username?username=user{}'.format(i))
+        self.assertEqual(client.get('/api/check_username?username=mary').status_code, 429)  # 不能拿来枚举用户名
+        rate_limiter.clear()
+
+        form = {'username': 'john', 'email': 'x@example.com', 'password': 'cat', 'password2': 'cat'}
+        self.assertIn(b'Please use a different username.', client.post('/register', data=form).data)
+
+        # 过滤器不知道别的进程刚注册的名字, 提交时由唯一约束兜底
+        name_registry.exists('username', 'susan')
+        db.session.execute(User.__table__.insert(), {'username': 'susan', 'email': 's@example.com'})
+        db.session.commit()
+        form = {'username': 'susan', 'email': 'other@example.com', 'password': 'cat', 'password2': 'cat'}
+        response = client.post('/register', data=form)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Please use a different username or email address.', response.data)
+        self.assertEqual(User.query.filter_by(username='susan').count(), 1)
+
+    def test_password_methods(self):
+        hasher = PasswordHasher()
+        hasher.pbkdf2_iterations = 1000
+        hasher.scrypt_params = (2 ** 10, 8, 1)
+        pwhash = hasher.hash('cat')
+        self.assertTrue(pwhash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(hasher.verify(pwhash, 'cat'))
+        self.assertFalse(hasher.verify(pwhash, 'dog'))
+        self.assertFalse(hasher.needs_rehash(pwhash))
+
+        hasher.method = 'scrypt'
+        self.assertTrue(hasher.needs_rehash(pwhash))
+        pwhash2 = hasher.hash('cat')
+        self.assertTrue(pwhash2.startswith('scrypt:1024:8:1$'))
+        self.assertTrue(hasher.verify(pwhash2, 'cat'))
+        self.assertFalse(hasher.verify(pwhash2, 'dog'))
+        self.assertTrue(hasher.verify(pwhash, 'cat'))  # 换了算法, 旧的哈希还能验证
+        self.assertFalse(hasher.verify('scrypt:garbage', 'cat'))
+        self.assertFalse(hasher.verify(None, 'cat'))
+
+    def test_password_rehash_on_login(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.password_hash = generate_password_hash('cat', method='pbkdf2:sha256:1000')  # 旧参数算的
+        db.session.add(u)
+        db.session.commit()
+        saved = passwords.method, passwords.scrypt_params
+        passwords.method, passwords.scrypt_params = 'scrypt', (2 ** 10, 8, 1)
+        try:
+            client = self.app.test_client()
+            client.post('/login', data={'username': 'john', 'password': 'dog'})
+            self.assertTrue(User.query.get(u.id).password_hash.startswith('pbkdf2:'))  # 密码错了不动
+            response = client.post('/login', data={'username': 'john', 'password': 'cat'})
+            self.assertEqual(response.status_code, 302)
+            db.session.expire_all()
+            self.assertTrue(User.query.get(u.id).password_hash.startswith('scrypt:1024:8:1$'))
+            self.assertTrue(User.query.get(u.id).check_password('cat'))
+        finally:
+            passwords.method, passwords.scrypt_params = saved
+
+    def test_password_hasher_busy(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        saved = passwords._slots, passwords.timeout
+        passwords._slots, passwords.timeout = threading.BoundedSemaphore(1), 0.01
+        passwords._slots.acquire()  # 唯一的位置被占着
+        try:
+            with self.assertRaises(HasherBusy):
+                passwords.verify(u.password_hash, 'cat')
+            response = self.app.test_client().post('/login', data={'username': 'john', 'password': 'cat'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '5')
+            self.assertGreaterEqual(passwords.stats()['busy'], 2)
+        finally:
+            passwords._slots, passwords.timeout = saved
+
+    def test_rate_limit_sliding_window(self):
+        limiter = RateLimiter()
+        start = (int(time.time()) // 60 + 1) * 60  # 下一个窗口的开头
+        burst = [limiter.hit('login', '1.2.3.4', '10/minute', start + i * 0.1) for i in range(15)]
+        self.assertEqual(burst[:10], [None] * 10)
+        self.assertTrue(all(wait == 59 for wait in burst[10:]))  # 当前窗口已满, 等到窗口结束
+        self.assertIsNone(limiter.hit('login', '5.6.7.8', '10/minute', start + 2))  # 别的 key 不受影响
+        # 窗口交界处: 上一个窗口的 10 次还有一半算在滑动窗口里, 只能再来 5 次, 固定窗口会放进 10 次
+        after = [limiter.hit('login', '1.2.3.4', '10/minute', start + 90) for _ in range(10)]
+        self.assertEqual(after.count(None), 5)
+        self.assertEqual(after[5], 6)  # 上一个窗口再滑出去 6 秒, 4 + 5 + 1 正好不超过 10
+        self.assertIsNone(limiter.hit('login', '1.2.3.4', '10/minute', start + 90 + after[5]))
+        self.assertEqual(limiter.stats()['login'], {'allowed': 17, 'rejected': 10})
+
+        limiter.overrides = {'login': '2/second'}
+        self.assertEqual(limiter.hit('login', 'x', '10/minute', start), None)
+
+    def test_rate_limit_concurrent_hits(self):
+        class SlowBackend(RateLimitMemoryBackend):  # 读完计数之后停一下, 让并发的请求都挤进这个空档
+            def get(self, keys):
+                counts = RateLimitMemoryBackend.get(self, keys)
+                time.sleep(0.01)
+                return counts
+
+        limiter = RateLimiter()
+        limiter.backend = SlowBackend()
+        start = (int(time.time()) // 60) * 60 + 1
+        barrier = threading.Barrier(20)
+        results = []
+
+        def hit():
+            barrier.wait()
+            results.append(limiter.hit('login', '1.2.3.4', '10/minute', start))
+        threads = [threading.Thread(target=hit) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results.count(None), 10)  # 同时来的 20 个请求只放进 10 个
+        self.assertEqual(limiter.backend.get(['login:1.2.3.4:{}'.format(start // 60)]), [10])  # 被拒绝的不计数
+
+    def test_rate_limit_shared_backend(self):
+        a, b = RateLimiter(), RateLimiter()  # 两个进程
+        a.backend = SharedRateLimitBackend(prefix='test:')
+        b.backend = SharedRateLimitBackend(prefix='test:')
+        try:
+            now = (int(time.time()) // 60) * 60 + 1
+            for _ in range(3):
+                self.assertIsNone(a.hit('reset', 'me@example.com', '6/minute', now))
+                self.assertIsNone(b.hit('reset', 'me@example.com', '6/minute', now))
+            self.assertIsNotNone(a.hit('reset', 'me@example.com', '6/minute', now))
+            self.assertIsNotNone(b.hit('reset', 'me@example.com', '6/minute', now))
+        finally:
+            a.clear()
+
+    def test_rate_limit_login(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        client = self.app.test_client()
+        for _ in range(10):
+            self.assertEqual(client.post('/login', data={'username': 'john', 'password': 'dog'}).status_code, 302)
+        hashed = passwords.stats()['verified']
+        with self.assertMaxQueries(0):  # 被拒绝的请求不查数据库也不算哈希
+            response = client.post('/login', data={'username': 'John', 'password': 'cat'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(passwords.stats()['verified'], hashed)
+        self.assertEqual(client.get('/login').status_code, 200)  # GET 不限
+        self.assertEqual(client.post('/login', data={'username': 'susan', 'password': 'dog'}).status_code, 302)
+
+        for i in range(3):
+            client.post('/reset_password_request', data={'email': 'john@example.com'})
+        self.assertEqual(client.post('/reset_password_request', data={'email': 'john@example.com'}).status_code,
+                         429)
+        self.assertEqual(OutboxMessage.query.count(), 3)
+        self.assertIn('microblog_rate_limit_rejected_total{limit="login-username"} 1', metrics.render())
+
+    def test_api(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/v1/feed').status_code, 401)
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        self.assertEqual(client.get('/api/v1/users/nobody').get_json()['error'][:3], 'The')
+        self.assertEqual(client.put('/api/v1/users/john/follow').status_code, 400)
+
+        response = client.put('/api/v1/users/susan/follow')
+        self.assertEqual(response.get_json(), {'username': 'susan', 'following': True, 'followers': 1})
+        now = datetime.utcnow()
+        for i in range(5):
+            post = Post(body='post {}'.format(i), author=u2, timestamp=now + timedelta(seconds=i))
+            db.session.add(post)
+            db.session.flush()
+            timeline.push(post)
+        db.session.commit()
+
+        response = client.get('/api/v1/feed?limit=3')
+        data = response.get_json()
+        self.assertEqual([p['body'] for p in data['items']], ['post 4', 'post 3', 'post 2'])
+        self.assertEqual(data['items'][0]['author'], 'susan')
+        etag = response.headers['ETag']
+        older = client.get(data['next']).get_json()
+        self.assertEqual([p['body'] for p in older['items']], ['post 1', 'post 0'])
+        self.assertIsNone(older['next'])
+
+        # 没有变化: 304, 不加载动态, 不序列化
+        with mock.patch('app.api.post_to_dict') as serialize:
+            response = client.get('/api/v1/feed?limit=3', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        serialize.assert_not_called()
+
+        post = Post(body='post 5', author=u2, timestamp=now + timedelta(seconds=5))
+        db.session.add(post)
+        db.session.flush()
+        timeline.push(post)
+        db.session.commit()
+        response = client.get('/api/v1/feed?limit=3', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()['items'][0]['body'], 'post 5')
+
+        response = client.get('/api/v1/explore')
+        self.assertEqual(len(response.get_json()['items']), 6)
+        self.assertEqual(client.get('/api/v1/explore', headers={'If-None-Match': response.headers['ETag']})
+                         .status_code, 304)
+
+        response = client.get('/api/v1/users/susan')
+        self.assertEqual(response.get_json()['followers'], 1)
+        etag = response.headers['ETag']
+        self.assertEqual(client.get('/api/v1/users/susan', headers={'If-None-Match': etag}).status_code, 304)
+        self.assertEqual(client.delete('/api/v1/users/susan/follow').get_json()['following'], False)
+        response = client.get('/api/v1/users/susan', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['followers'], 0)
+        self.assertEqual(client.get('/api/v1/feed').get_json()['items'], [])
+
+    def test_stream_broker(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+        b = Broker()
+        b.backend = StreamLocalBackend()
+        b.backend.start(b._deliver)
+        b.queue_size, b.max_connections, b.heartbeat = 2, 1, 0.01
+
+        subscription = b.subscribe(u1)
+        self.assertIsNone(b.subscribe(u3))  # 超过连接数
+        self.assertEqual(b.stats()['rejected'], 1)
+        events = b.events(subscription)
+        self.assertEqual(next(events), 'retry: 5000\n\n')
+        self.assertEqual(next(events), ': ping\n\n')  # 没有事件时发心跳
+
+        now = datetime.utcnow()
+        for i, author in enumerate([u3, u2, u1]):  # 只收到关注的人的动态, 自己的也不推
+            b.publish_post(Post(id=i + 1, author=author, timestamp=now))
+        self.assertIn('"author": "susan"', next(events))
+        b.follow(u1, u3)
+        b.publish_post(Post(id=4, author=u3, timestamp=now))
+        self.assertTrue(next(events).startswith('id: 4\nevent: post\n'))
+        b.follow(u1, u3, following=False)
+        b.publish_post(Post(id=5, author=u3, timestamp=now))
+        self.assertTrue(subscription.queue.empty())
+
+        for i in range(3):  # 客户端读得太慢: 积压满了之后丢弃, 发完积压的就让页面刷新并断开
+            b.publish_post(Post(id=10 + i, author=u2, timestamp=now))
+        self.assertEqual(b.stats()['dropped'], 1)
+        self.assertEqual([line for e in events for line in e.split('\n') if line.startswith('event:')],
+                         ['event: post', 'event: post', 'event: reset'])
+        self.assertEqual(b.stats()['connections'], 0)
+        b.unsubscribe(subscription)  # 再调用一次也没关系
+        self.assertEqual(b.stats()['connections'], 0)
+        self.assertIsNotNone(b.subscribe(u3))
+
+    def test_stream_shared_backend(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        a, b = Broker(), Broker()  # 两个进程
+        for x in (a, b):
+            x.backend = SharedStreamBackend(poll_interval=0.05)
+            x.backend.start(x._deliver)
+        try:
+            subscription = b.subscribe(u1)
+            a.publish_post(Post(id=1, author=u2, timestamp=datetime.utcnow()))
+            self.assertEqual(subscription.queue.get(timeout=5)[1]['author'], 'susan')
+        finally:
+            a.backend.stop()
+            b.backend.stop()
+
+    def test_stream_feed(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        for u in (u1, u2):
+            u.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        john, susan = self.app.test_client(), self.app.test_client()
+        john.post('/login', data={'username': 'john', 'password': 'cat'})
+        susan.post('/login', data={'username': 'susan', 'password': 'cat'})
+        john.get('/follow/susan')
+        self.assertIn(b'new-posts', john.get('/index').data)
+
+        response = john.get('/stream/feed', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(broker.stats()['connections'], 1)
+        chunks = iter(response.response)
+        self.assertEqual(next(chunks), b'retry: 5000\n\n')
+        susan.post('/index', data={'post': 'hello'})
+        event = next(chunks).decode()
+        self.assertIn('event: post', event)
+        self.assertIn('"author": "susan"', event)
+        response.close()
+        self.assertEqual(broker.stats()['connections'], 0)
+
+        saved = broker.max_connections
+        broker.max_connections = 0
+        try:
+            self.assertEqual(john.get('/stream/feed').status_code, 503)
+        finally:
+            broker.max_connections = saved
+
+    def test_app_factory(self):
+        class OtherConfig(TestConfig):
+            POSTS_PER_PAGE = 7
+
+        other = create_app(OtherConfig)
+        self.assertEqual(other.config['POSTS_PER_PAGE'], 7)
+        self.assertNotEqual(self.app.config['POSTS_PER_PAGE'], 7)  # 两个应用的配置互不影响
+        self.assertIn('main.index', other.view_functions)
+        self.assertIn('auth.login', other.view_functions)
+        self.assertIn('api.feed', other.view_functions)
+        self.assertTrue({'db', 'metrics', 'blueprints'} <= set(other.extensions['startup']))
+        response = other.test_client().get('/index')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login', response.headers['Location'])
+
+        # 网页进程启动时不导入迁移、邮件和 jwt
+        env = dict(os.environ, DATABASE_URL='sqlite://')
+        env.pop('FLASK_RUN_FROM_CLI', None)
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys; from app import create_app; create_app(); '
+             'print("loaded:" + ",".join(m for m in ("flask_migrate", "alembic", "flask_mail", "jwt") if m in sys.modules))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, universal_newlines=True)
+        self.assertEqual(output.strip().splitlines()[-1], 'loaded:')
+
+        report = ('import time: self [us] | cumulative | imported package\n'
+                  'import time:       100 |        100 |     sqlalchemy.sql\n'
+                  'import time:        50 |        150 |   sqlalchemy\n'
+                  'import time:        20 |        170 | app\n')
+        self.assertEqual(import_times(report), [('sqlalchemy', 150), ('app', 20)])
+
+    def test_bulk_import(self):
+        cli.register(self.app)
+        runner = self.app.test_cli_runner()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            def write(name, text):
+                path = os.path.join(tmpdir, name)
+                with open(path, 'w') as f:
+                    f.write(text)
+                return path
+
+            users = write('users.csv', 'username,email,password,password_hash\n'
+                                       'john,john@example.com,cat,\n'
+                                       'susan,susan@example.com,,{}\n'
+                                       'john,other@example.com,dog,\n'  # 重复的用户名
+                                       'mary,not-an-email,cat,\n'.format(generate_password_hash('dog')))
+            result = runner.invoke(args=['import', 'users', users, '--workers', '0'])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn('Imported 2 users (2 skipped)', result.output)
+            john = User.query.filter_by(username='john').first()
+            susan = User.query.filter_by(username='susan').first()
+            self.assertTrue(john.check_password('cat'))
+            self.assertTrue(susan.check_password('dog'))
+            self.assertEqual(john.avatar_hash, md5(b'john@example.com').hexdigest())
+
+            posts = write('posts.jsonl', '\n'.join(json.dumps(record) for record in [
+                {'username': 'susan', 'body': 'imported flask post', 'timestamp': '2020-01-01T00:00:00Z'},
+                {'username': 'susan', 'body': 'another one'},
+                {'username': 'nobody', 'body': 'unknown author'},
+            ]) + '\nnot json\n')
+            result = runner.invoke(args=['import', 'posts', posts])
+            self.assertIn('Imported 2 posts (2 skipped)', result.output)
+            dated = write('dated.jsonl', '\n'.join(json.dumps(record) for record in [
+                {'username': 'susan', 'body': 'from shanghai', 'timestamp': '2020-01-01T10:00:00+08:00'},
+                {'username': 'susan', 'body': 'from shanghai', 'timestamp': '2020-01-01T02:00:00Z'},  # 同一时刻
+            ]))
+            result = runner.invoke(args=['import', 'posts', dated])
+            self.assertIn('Imported 1 posts (1 skipped)', result.output)
+            self.assertEqual(Post.query.filter_by(body='from shanghai').one().timestamp, datetime(2020, 1, 1, 2))
+            result = runner.invoke(args=['import', 'posts', dated])  # 重跑: 已经导入的跳过
+            self.assertIn('Imported 0 posts (2 skipped)', result.output)
+            follows = write('follows.jsonl', '{"follower": "john", "followed": "susan"}\n'
+                                             '{"follower": "john", "followed": "susan"}\n'
+                                             '{"follower": "john", "followed": "john"}\n')
+            result = runner.invoke(args=['import', 'follows', follows])
+            self.assertIn('Imported 1 follows (2 skipped)', result.output)
+            result = runner.invoke(args=['import', 'follows', follows])  # 重跑: 已经导入的跳过
+            self.assertIn('Imported 0 follows (3 skipped)', result.output)
+
+            # 计数、时间线和全文索引都补上了
+            john = User.query.filter_by(username='john').first()
+            susan = User.query.filter_by(username='susan').first()
+            self.assertEqual((susan.post_count, susan.follower_count, john.followed_count), (3, 1, 1))
+            self.assertEqual([p.body for p in timeline.read(john, 10)[0]],
+                             ['another one', 'from shanghai', 'imported flask post'])
+            self.assertEqual([p.body for p in search_index.search('flask', 10).items], ['imported flask post'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_recommendations(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        users = {name: User(username=name, email='{}@example.com'.format(name))
+                 for name in ('john', 'susan', 'mary', 'david', 'anna')}
+        users['john'].set_password('cat')
+        db.session.add_all(users.values())
+        db.session.commit()
+        for follower, followed in [('john', 'susan'), ('john', 'mary'), ('susan', 'david'), ('mary', 'david'),
+                                   ('mary', 'anna'), ('mary', 'john'), ('david', 'anna')]:
+            users[follower].follow(users[followed])
+        db.session.commit()
+
+        expected = [(users['john'].id, 0, users['david'].id, 2), (users['john'].id, 1, users['anna'].id, 1)]
+        results = recommender.compute(vectorized=False)
+        self.assertEqual([row for row in results if row[0] == users['john'].id], expected)
+        self.assertNotIn(users['john'].id, [row[2] for row in results if row[0] == users['mary'].id])  # 已经关注了
+        if numpy is not None:  # 向量化和纯 Python 的结果一样, 分片、进程池也一样
+            recommender.shard_size = 2
+            try:
+                self.assertEqual(sorted(recommender.compute(vectorized=True)), sorted(results))
+                self.assertEqual(sorted(recommender.compute(workers=2, vectorized=True)), sorted(results))
+            finally:
+                recommender.shard_size = self.app.config['RECOMMEND_SHARD_SIZE']
+        self.assertEqual(recommender.build()[:2], (len({row[0] for row in results}), len(results)))
+
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        with self.assertMaxQueries(1):
+            self.assertEqual([(u.username, score) for u, score in recommender.suggestions(users['john'])],
+                             [('david', 2), ('anna', 1)])
+        html = client.get('/index').data.decode()
+        self.assertIn('Who to follow', html)
+        self.assertIn('Followed by 2 people you follow', html)
+        client.get('/follow/david')  # 算完之后关注的不再显示
+        self.assertNotIn('/user/david">david', client.get('/user/susan').data.decode())
+        self.assertIn('/user/anna">anna', client.get('/user/susan').data.decode())
+
+    def test_trending(self):
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.assertAlmostEqual(logaddexp(0.0, 0.0), math.log(2))
+        self.assertAlmostEqual(logaddexp(1000.0, 1000.0), 1000.0 + math.log(2))  # 不溢出
+        self.assertEqual(logaddexp(None, 3.0), 3.0)
+        half_life = self.app.config['TRENDING_HALF_LIFE']
+        now = EPOCH + timedelta(days=100)
+        self.assertAlmostEqual(trending.scale(now) - trending.scale(now - timedelta(seconds=half_life)), math.log(2))
+
+        users = {name: User(username=name, email='{}@example.com'.format(name))
+                 for name in ('john', 'susan', 'mary', 'david')}
+        users['john'].set_password('cat')
+        db.session.add_all(users.values())
+        db.session.commit()
+        ids = {name: user.id for name, user in users.items()}
+        # 同一时刻两次发动态等于一次权重翻倍; 一个半衰期之前的只算一半
+        trending.record(ids['susan'], 'post', when=now)
+        trending.record(ids['susan'], 'post', when=now)
+        trending.record(ids['mary'], 'follow', when=now - timedelta(seconds=half_life))
+        trending.record(ids['david'], 'post', when=now - timedelta(days=30))
+        db.session.commit()
+        scores = dict(db.session.query(TrendingScore.user_id, TrendingScore.score))
+        self.assertAlmostEqual(trending.current(scores[ids['susan']], now), 2.0)
+        self.assertAlmostEqual(trending.current(scores[ids['mary']], now), 1.5)
+
+        posts = [Post(body='susan {}'.format(i), author=users['susan'], timestamp=now - timedelta(minutes=i))
+                 for i in range(4)]
+        posts.append(Post(body='mary', author=users['mary'], timestamp=now - timedelta(hours=1)))
+        posts.append(Post(body='mary old', author=users['mary'], timestamp=now - timedelta(days=3)))
+        posts.append(Post(body='david', author=users['david'], timestamp=now))
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(trending.compact(now=now), (1, 4))  # david 衰减完了; susan 最多三条, mary 的旧动态不在窗口里
+        ranking = db.session.query(Post.body, TrendingEntry.score).join(TrendingEntry, TrendingEntry.post_id == Post.id) \
+            .order_by(TrendingEntry.rank).all()
+        # susan 2.0, mary 1.5, susan 的第二条减半 1.0, 第三条 0.5
+        self.assertEqual([body for body, _ in ranking], ['susan 0', 'mary', 'susan 1', 'susan 2'])
+        self.assertAlmostEqual(math.exp(ranking[2][1] - trending.scale(now)), 1.0)
+        self.assertIsNone(TrendingScore.query.get(ids['david']))
+
+        # 页面上发动态、关注都记分
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'john', 'password': 'cat'})
+        client.post('/index', data={'post': 'hello'})
+        client.get('/follow/susan')
+        self.assertIsNotNone(TrendingScore.query.get(ids['john']))
+        self.assertGreater(TrendingScore.query.get(ids['susan']).score, scores[ids['susan']])
+
+        # 反复关注、取关刷不上去: 同一对在窗口里只有第一次加分
+        followed = TrendingScore.query.get(ids['susan']).score
+        for _ in range(5):
+            client.get('/unfollow/susan')
+            client.get('/follow/susan')
+        self.assertEqual(TrendingScore.query.get(ids['susan']).score, followed)
+        later = datetime.utcnow() + timedelta(seconds=self.app.config['TRENDING_WINDOW'] + 1)
+        trending.record_follow(ids['john'], ids['susan'], when=later)  # 过了窗口再关注又算一次
+        db.session.commit()
+        self.assertGreater(TrendingScore.query.get(ids['susan']).score, followed)
+
+        self.app.config['POSTS_PER_PAGE'] = 3
+        with self.assertMaxQueries(2):  # 登录用户、一页排行 (带作者)
+            html = client.get('/explore?sort=trending').data.decode()
+        self.assertIn('susan 0', html)
+        self.assertNotIn('susan 2', html)
+        self.assertIn('rank=3', html)
+        html = client.get('/explore?sort=trending&rank=3').data.decode()
+        self.assertIn('susan 2', html)
+        self.assertNotIn('rank=', html)
+        self.assertIn('hello', client.get('/explore').data.decode())  # 默认还是按时间
+
+        # 压缩时删掉窗口之前的关注记录
+        self.assertEqual(TrendingFollow.query.count(), 1)
+        trending.compact(now=later + timedelta(seconds=self.app.config['TRENDING_WINDOW'] + 1))
+        self.assertEqual(TrendingFollow.query.count(), 0)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)